@@ -0,0 +1,386 @@
+"""
+Бенчмарки гарячих шляхів гри: генерація лабіринту, пошук шляху, тік привидів,
+пряма видимість і малювання кадру (на невидимому екрані, SDL dummy).
+Для кожного випадку з матриці (розмір сітки × складність) рахуються mean/p50/p99,
+результати пишуться в JSON і за потреби порівнюються з еталонним файлом.
+
+Приклади:
+    python bench.py --out bench.json --save-baseline bench_baseline.json
+    python bench.py --baseline bench_baseline.json --threshold 0.25   # код виходу 1 при регресії
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from collections import deque
+
+# Малювання — на невидимому екрані, без вікна
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import pacman
+
+
+def percentile(sorted_values, q):
+    """Перцентиль q (0..100) з уже відсортованого списку (найближчий ранг)."""
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, round(q / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[k]
+
+def summarize(samples_ms):
+    s = sorted(samples_ms)
+    return {
+        'n': len(s),
+        'mean_ms': statistics.fmean(s),
+        'p50_ms': percentile(s, 50),
+        'p99_ms': percentile(s, 99),
+    }
+
+def timed(fn, repeat):
+    """Викликає fn() repeat разів і повертає часи викликів у мс."""
+    out = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        out.append((time.perf_counter() - t0) * 1000)
+    return out
+
+def make_level(w, h):
+    grid = pacman.generate_maze_braid(w, h)
+    pacman.add_ghost_pen(grid)
+    pacman._repair_after_pen(grid)
+    return grid
+
+def walkable(grid):
+    return [grid.xy(i) for i in grid.indices() if grid.cells[i] != pacman.WALL]
+
+# =====================
+# Випадки бенчмарку
+# =====================
+def bench_maze(w, h, difficulty, repeat):
+    return timed(lambda: make_level(w, h), repeat)
+
+def bench_bfs(w, h, difficulty, repeat):
+    grid = make_level(w, h)
+    cells = walkable(grid)
+    pairs = [(random.choice(cells), random.choice(cells)) for _ in range(repeat)]
+    it = iter(pairs)
+    return timed(lambda: pacman.find_path_step_bfs(grid, *next(it)), repeat)
+
+def bench_junctions(w, h, difficulty, repeat):
+    """
+    Запит маршруту привида (відстань + перший крок) через A* по графу розвилок.
+    Додатково: розкрито вузлів на запит проти клітинок BFS-рядка і прискорення
+    відносно BFS-рядка (таблиця маршрутів без кешу, як для першого запиту до цілі).
+    """
+    grid = make_level(w, h)
+    nav = pacman.NavTable(grid, max_cells=0, cache_targets=0)
+    jn = nav.junctions
+    pairs = [(random.randrange(nav.n), random.randrange(nav.n)) for _ in range(repeat)]
+    it = iter(pairs)
+    out = timed(lambda: jn.route(*next(it)), repeat)
+    bfs_ms = statistics.fmean(timed(lambda: nav._bfs_row(random.randrange(nav.n)), max(1, repeat // 20)))
+    return out, {
+        'junctions': len(jn.links),
+        'expanded_per_query': round(jn.expanded / jn.queries, 1),
+        'bfs_cells': nav.n,
+        'node_ratio': round(nav.n * jn.queries / max(1, jn.expanded)),
+        'speedup': round(bfs_ms / statistics.fmean(out)),
+    }
+
+def bench_los(w, h, difficulty, repeat):
+    grid = make_level(w, h)
+    cells = walkable(grid)
+    pairs = [(random.choice(cells), random.choice(cells)) for _ in range(repeat)]
+    it = iter(pairs)
+    return timed(lambda: pacman.line_of_sight(grid, *next(it)), repeat)
+
+def bench_visibility(w, h, difficulty, repeat):
+    """Побудова індексу видимості; додатково звітує пам'ять і кількість відрізків."""
+    grid = make_level(w, h)
+    out = []
+    for _ in range(repeat):
+        vis = pacman.VisibilityIndex(grid)
+        out.append(vis.build_ms)
+    return out, {'bytes': vis.nbytes, 'segments': vis.h_segments + vis.v_segments}
+
+def bench_ghost_tick(w, h, difficulty, repeat):
+    """Повний Game.update, у якому гарантовано відбувається тік привидів."""
+    game = pacman.Game(headless=True, policy=pacman.random_policy, grid_w=w, grid_h=h,
+                       difficulty=difficulty)
+    out = []
+    for _ in range(repeat):
+        if not game.pac.alive or game.win:
+            game.reset()
+        game.ghost_step_acc = pacman.GHOST_STEP_MS - 1
+        t0 = time.perf_counter()
+        game.update(1)
+        out.append((time.perf_counter() - t0) * 1000)
+    return out
+
+PELLET_DENSITIES = (0.5, 0.1, 0.01)
+
+def bfs_nearest_pellet(grid, pellets, start, limit=None):
+    """
+    Найближча пелета лабіринтом від start — BFS, як у greedy_policy: (позиція, кроків) або
+    (None, None). З limit=None — ще й словник відстаней до всіх досяжних клітинок.
+    """
+    cells, offsets = grid.cells, grid.offsets
+    s = grid.idx(*start)
+    dist = {s: 0}
+    q = deque([s])
+    found = None
+    while q:
+        i = q.popleft()
+        if found is None and i != s and grid.xy(i) in pellets:
+            found = (grid.xy(i), dist[i])
+            if limit is not None:
+                return found
+        for off in offsets:
+            j = i + off
+            if j not in dist and cells[j] != pacman.WALL:
+                dist[j] = dist[i] + 1
+                q.append(j)
+    return (found or (None, None)) + ((dist,) if limit is None else ())
+
+def bench_nearest_pellet(w, h, difficulty, repeat):
+    """
+    «Найближча пелета до клітинки»: кошики PelletStore.nearest проти BFS лабіринтом
+    (як у greedy_policy) при густоті пелет з PELLET_DENSITIES. Часи — nearest() при
+    найменшій густоті (запити — з клітинок без пелет, де й стоїть Пакмен); додатково для
+    кожної густоти — прискорення відносно BFS і на скільки кроків лабіринтом у середньому
+    довша дорога до манхеттенської найближчої (excess: стін nearest не знає).
+    Відповідь nearest звіряється з перебором усіх пелет.
+    """
+    grid = make_level(w, h)
+    cells = walkable(grid)
+    extra = {}
+    for density in PELLET_DENSITIES:
+        store = pacman.PelletStore(w, h, random.sample(cells, max(1, round(len(cells) * density))))
+        empty = [pos for pos in cells if pos not in store]
+        starts = [random.choice(empty) for _ in range(repeat)]
+        it = iter(starts)
+        out = timed(lambda: store.nearest(next(it)), repeat)
+        it = iter(starts)
+        bfs_ms = statistics.fmean(timed(lambda: bfs_nearest_pellet(grid, store, next(it), limit=True), repeat))
+        excess = []
+        for x, y in starts[:50]:
+            best = store.nearest((x, y))
+            if abs(best[0] - x) + abs(best[1] - y) != min(abs(px - x) + abs(py - y) for px, py in store):
+                raise RuntimeError(f"PelletStore.nearest({x}, {y}) -> {best}: не найближча")
+            _, steps, dist = bfs_nearest_pellet(grid, store, (x, y))
+            if steps is not None:
+                excess.append(dist[grid.idx(*best)] - steps)
+        extra[f'speedup@{density:g}'] = round(bfs_ms / statistics.fmean(out), 1)
+        extra[f'excess@{density:g}'] = round(statistics.fmean(excess), 1) if excess else 0
+    return out, extra
+
+GHOST_COUNTS = (4, 64, 256, 1024)
+
+def bench_ghost_swarm(w, h, difficulty, repeat):
+    """
+    Тік привидів при різній кількості привидів. Часи — для найбільшої кількості,
+    додатково звітуються тіки за секунду для кожної кількості з GHOST_COUNTS.
+    """
+    extra = {}
+    for n in GHOST_COUNTS:
+        game = pacman.Game(headless=True, policy=pacman.random_policy, grid_w=w, grid_h=h,
+                           difficulty=difficulty, ghost_count=n)
+        out = []
+        for _ in range(max(1, repeat // 4)):
+            game.pac.alive = True  # міряємо тік, а не кінець гри
+            game.ghost_step_acc = pacman.GHOST_STEP_MS - 1
+            t0 = time.perf_counter()
+            game.update(1)
+            out.append((time.perf_counter() - t0) * 1000)
+        extra[f'ticks_per_s@{n}'] = round(1000 / statistics.fmean(out))
+    return out, extra
+
+PLANNER_GHOSTS = 1500
+
+def paced_updates(game, frames):
+    """
+    update() і draw() кадр за кадром у темпі FPS, як у Game.run(): решту кадру головний
+    потік спить (там і працюють фонові потоки). Повертає часи update() у мс.
+    """
+    frame_ms = 1000 / pacman.FPS
+    out = []
+    deadline = time.perf_counter()
+    for _ in range(frames):
+        if not game.pac.alive or game.win:
+            game.reset()
+        t0 = time.perf_counter()
+        game.update(frame_ms)
+        out.append((time.perf_counter() - t0) * 1000)
+        game.draw()
+        deadline += frame_ms / 1000
+        pause = deadline - time.perf_counter()
+        if pause > 0:
+            time.sleep(pause)
+        else:
+            deadline = time.perf_counter()  # кадр затягнувся — не наздоганяємо
+    return out
+
+def bench_ghost_planner(w, h, difficulty, repeat):
+    """
+    Віконна гра з PLANNER_GHOSTS привидами в реальному темпі: update() з GhostPlanner
+    (тік привидів наперед у фоновому потоці, лише коли тік дорожчий за GHOST_AI_MIN_TICK_MS)
+    і без нього, на тому самому зерні. Часи — з потоком; додатково звітує, скільки тіків
+    пораховано наперед (planned), яку частку з них прийнято (used), відкинуті застарілі
+    знімки (stale) і mean/p99 update() без потоку.
+    """
+    extra = {}
+    for threaded in (False, True):
+        game = pacman.Game(policy=pacman.autopilot_policy, grid_w=w, grid_h=h,
+                           difficulty=difficulty, ghost_count=PLANNER_GHOSTS, seed=0)
+        game.planner = pacman.GhostPlanner() if threaded else None
+        out = paced_updates(game, repeat)
+        if not threaded:
+            off = summarize(out)
+            extra['mean_off_ms'] = round(off['mean_ms'], 3)
+            extra['p99_off_ms'] = round(off['p99_ms'], 3)
+    planner = game.planner
+    extra['planned'] = planner.planned
+    extra['used'] = round(planner.hits / max(1, planner.planned), 2)
+    extra['stale'] = planner.stale
+    return out, extra
+
+STALL_MS = 2000
+
+def bench_stall(w, h, difficulty, repeat):
+    """
+    Кадр після паузи STALL_MS (перетягування вікна, збирання сміття): dt обрізано, як у
+    Game.run(), а update() сам обмежує кількість кроків наздоганяння. Додатково звітує,
+    скільки кроків Пакмена й тіків привидів припало на такий кадр.
+    """
+    game = pacman.Game(headless=True, policy=pacman.random_policy, grid_w=w, grid_h=h,
+                       difficulty=difficulty)
+    out = []
+    steps = 0
+    for _ in range(repeat):
+        if not game.pac.alive or game.win:
+            game.reset()
+        game.pac_step_acc = game.ghost_step_acc = 0
+        before = game.pac_steps + game.ghost_ticks
+        t0 = time.perf_counter()
+        game.update(min(STALL_MS, pacman.MAX_FRAME_MS))
+        out.append((time.perf_counter() - t0) * 1000)
+        steps = max(steps, game.pac_steps + game.ghost_ticks - before)
+    return out, {'max_steps': steps}
+
+def bench_draw(w, h, difficulty, repeat):
+    game = pacman.Game(policy=pacman.random_policy, grid_w=w, grid_h=h, difficulty=difficulty)
+    out = []
+    for _ in range(repeat):
+        if not game.pac.alive or game.win:
+            game.reset()
+        game.update(1000 / pacman.FPS)
+        t0 = time.perf_counter()
+        game.draw()
+        out.append((time.perf_counter() - t0) * 1000)
+    return out
+
+CASES = {
+    'maze': (bench_maze, False),       # (функція, чи залежить від складності)
+    'bfs': (bench_bfs, False),
+    'junction_astar': (bench_junctions, False),
+    'nearest_pellet': (bench_nearest_pellet, False),
+    'line_of_sight': (bench_los, False),
+    'visibility_build': (bench_visibility, False),
+    'ghost_tick': (bench_ghost_tick, True),
+    'ghost_swarm': (bench_ghost_swarm, True),
+    'ghost_planner': (bench_ghost_planner, True),
+    'stall_frame': (bench_stall, True),
+    'draw': (bench_draw, True),
+}
+
+# =====================
+# Запуск і порівняння з еталоном
+# =====================
+def run_matrix(sizes, difficulties, cases, repeat):
+    results = {}
+    for w, h in sizes:
+        for name in cases:
+            fn, per_difficulty = CASES[name]
+            # для випадків, що не залежать від складності, — один прогін на розмір
+            for d in (difficulties if per_difficulty else [None]):
+                key = f"{name}/{w}x{h}" + (f"/d{d}" if d is not None else "")
+                r = max(1, repeat // 10) if name in ('maze', 'visibility_build') else repeat
+                out = fn(w, h, d if d is not None else 1, r)
+                # випадок може повернути (часи, додаткові показники)
+                samples, extra = out if isinstance(out, tuple) else (out, {})
+                res = results[key] = summarize(samples) | extra
+                print(f"{key:28s} mean {res['mean_ms']:9.4f}  p50 {res['p50_ms']:9.4f}  "
+                      f"p99 {res['p99_ms']:9.4f} ms  (n={res['n']})"
+                      + ''.join(f"  {k}={v}" for k, v in extra.items()))
+    return results
+
+def compare(results, baseline, threshold, metric):
+    """Список регресій: випадки, де metric гірший за еталон більш ніж на threshold."""
+    regressions = []
+    for key, base in baseline.get('results', {}).items():
+        cur = results.get(key)
+        if cur is None or base[metric] <= 0:
+            continue
+        ratio = cur[metric] / base[metric]
+        if ratio > 1 + threshold:
+            regressions.append((key, base[metric], cur[metric], ratio))
+    return regressions
+
+def main():
+    ap = argparse.ArgumentParser(description="Бенчмарки гарячих шляхів Pacman")
+    ap.add_argument('--sizes', default='27x21,55x41,101x81')
+    ap.add_argument('--difficulties', default='1,3,5')
+    ap.add_argument('--cases', default=','.join(CASES))
+    ap.add_argument('--repeat', type=int, default=200, help="вимірів на випадок")
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--out', default='bench.json')
+    ap.add_argument('--baseline', help="еталонний JSON для порівняння")
+    ap.add_argument('--threshold', type=float, default=0.25, help="допустиме погіршення (0.25 = +25%%)")
+    ap.add_argument('--metric', default='p50_ms', choices=['mean_ms', 'p50_ms', 'p99_ms'])
+    ap.add_argument('--save-baseline', help="також записати результати як новий еталон")
+    args = ap.parse_args()
+
+    random.seed(args.seed)
+    sizes = [tuple(int(v) for v in s.lower().split('x')) for s in args.sizes.split(',')]
+    difficulties = [int(d) for d in args.difficulties.split(',')]
+    cases = [c for c in args.cases.split(',') if c]
+    for c in cases:
+        if c not in CASES:
+            ap.error(f"невідомий випадок: {c} (є: {', '.join(CASES)})")
+
+    results = run_matrix(sizes, difficulties, cases, args.repeat)
+    report = {
+        'meta': {
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'repeat': args.repeat,
+            'seed': args.seed,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        },
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.metric)
+        for key, base, cur, ratio in regressions:
+            print(f"РЕГРЕСІЯ {key}: {args.metric} {base:.4f} -> {cur:.4f} мс (x{ratio:.2f})")
+        if regressions:
+            sys.exit(1)
+        print(f"Регресій немає (поріг +{args.threshold:.0%}, метрика {args.metric})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+Швидкий запис гри у файли без вікна: кадри Game.draw() малюються в поверхню в пам'яті
+(відеодрайвер SDL dummy), а фоновий потік пише їх на диск — сирими шматками або
+послідовністю PNG. Джерело кадрів — повтор журналу (--replay) або симуляція з політикою.
+
+Кожен кадр копіюється рівно один раз: буфер екрана (get_buffer) -> вільний буфер з пулу,
+без перетворення формату пікселів. Буферів у пулі обмежена кількість, тож якщо диск не
+встигає, гра чекає на записувач, а пам'ять не росте.
+
+Сирий формат: frames_NNNNN.raw по --chunk-frames кадрів підряд, без заголовків; розмір,
+порядок байтів пікселя й частоту кадрів описує capture.json. Наприклад, у відео:
+    cat capture/frames_*.raw | ffmpeg -f rawvideo -pixel_format bgr0 -video_size 648x504 \\
+        -framerate 60 -i - capture.mp4
+
+Приклад:
+    python capture.py --replay game.log --out capture
+    python capture.py --policy autopilot --seconds 60 --format png --out capture
+"""
+import argparse
+import json
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')  # без вікна: екран — поверхня в пам'яті
+
+import pacman
+
+CHUNK_FRAMES = 256   # кадрів в одному .raw
+QUEUE_FRAMES = 16    # скільки кадрів може чекати на запис
+PNG_LEVEL = 1        # стиснення zlib для PNG: 1 — утричі швидше за типове, файли трохи більші
+
+def pixel_format(surface):
+    """Порядок байтів 32-бітного пікселя в термінах ffmpeg ('bgr0', 'rgba', ...)."""
+    if surface.get_bytesize() != 4 or sys.byteorder != 'little':
+        raise ValueError("підтримуються лише 32-бітні поверхні на little-endian")
+    names = ''
+    masks = surface.get_masks()
+    for i in range(4):
+        byte = 0xff << (8 * i)
+        for name, mask in zip('rgba', masks):
+            if mask == byte:
+                names += name
+                break
+        else:
+            names += '0'  # невикористаний байт
+    return names
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+def encode_png(buf, size, pitch, pix_fmt, level=PNG_LEVEL):
+    """
+    RGB PNG із сирого 32-бітного буфера. Перестановка каналів — зрізами bytearray,
+    стиснення — zlib, який відпускає GIL, тож кілька записувачів справді працюють паралельно.
+    """
+    w, h = size
+    if pitch != w * 4:
+        view = memoryview(buf)
+        buf = b''.join(view[y * pitch:y * pitch + w * 4] for y in range(h))
+    rgb = bytearray(w * h * 3)
+    for i, channel in enumerate('rgb'):
+        rgb[i::3] = buf[pix_fmt.index(channel)::4]
+    row = w * 3
+    raw = bytearray((row + 1) * h)  # кожен рядок — байт фільтра (0) і пікселі
+    view = memoryview(rgb)
+    for y in range(h):
+        raw[y * (row + 1) + 1:(y + 1) * (row + 1)] = view[y * row:(y + 1) * row]
+    return (b'\x89PNG\r\n\x1a\n'
+            + _png_chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0))
+            + _png_chunk(b'IDAT', zlib.compress(raw, level))
+            + _png_chunk(b'IEND', b''))
+
+class FrameWriter:
+    """
+    Записувач кадрів у фонових потоках. push(surface) копіює пікселі поверхні у вільний
+    буфер і ставить його в чергу; потік пише буфер на диск і повертає його в пул.
+    fmt='raw' — шматки по chunk_frames кадрів (один потік, кадри підряд),
+    fmt='png' — frame_NNNNNN.png на кадр (writers потоків, кожен кодує свої кадри).
+    """
+
+    def __init__(self, out, surface, fmt='raw', chunk_frames=CHUNK_FRAMES, queue_frames=QUEUE_FRAMES,
+                 writers=1, png_level=PNG_LEVEL):
+        if fmt not in ('raw', 'png'):
+            raise ValueError(f"невідомий формат: {fmt}")
+        os.makedirs(out, exist_ok=True)
+        self.out, self.fmt, self.chunk_frames, self.png_level = out, fmt, chunk_frames, png_level
+        self.size = surface.get_size()
+        self.pitch = surface.get_pitch()
+        self.pix_fmt = pixel_format(surface)
+        frame_bytes = surface.get_buffer().length
+        writers = writers if fmt == 'png' else 1
+        self.free = queue.Queue()
+        for _ in range(queue_frames + writers):
+            self.free.put(bytearray(frame_bytes))
+        self.pending = queue.Queue()
+        self.frames = 0          # поставлено в чергу
+        self.written = 0         # записано на диск
+        self.bytes = 0
+        self.stalls = 0          # скільки разів push() чекав на вільний буфер
+        self.error = None
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, name=f'capture-writer-{i}', daemon=True)
+                        for i in range(writers)]
+        for t in self.threads:
+            t.start()
+
+    def push(self, surface):
+        if self.error is not None:
+            raise self.error
+        try:
+            buf = self.free.get_nowait()
+        except queue.Empty:
+            self.stalls += 1
+            buf = self.free.get()
+        buf[:] = surface.get_buffer()  # єдина копія кадру
+        self.pending.put((self.frames, buf))
+        self.frames += 1
+
+    def _run(self):
+        f = None
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+            index, buf = item
+            try:
+                if self.error is None:
+                    if self.fmt == 'raw':
+                        if index % self.chunk_frames == 0:
+                            if f is not None:
+                                f.close()
+                            name = f"frames_{index // self.chunk_frames:05d}.raw"
+                            f = open(os.path.join(self.out, name), 'wb')
+                        f.write(buf)
+                        n = len(buf)
+                    else:
+                        data = encode_png(buf, self.size, self.pitch, self.pix_fmt, self.png_level)
+                        with open(os.path.join(self.out, f"frame_{index:06d}.png"), 'wb') as png:
+                            png.write(data)
+                        n = len(data)
+                    with self.lock:
+                        self.written += 1
+                        self.bytes += n
+            except Exception as e:  # push() перекине помилку в головний потік
+                self.error = e
+            self.free.put(buf)  # буфер повертається в пул навіть після помилки
+        if f is not None:
+            f.close()
+
+    def close(self, fps):
+        """Дочекатися запису всіх кадрів і зберегти capture.json з описом формату."""
+        for _ in self.threads:
+            self.pending.put(None)
+        for t in self.threads:
+            t.join()
+        if self.error is not None:
+            raise self.error
+        with open(os.path.join(self.out, 'capture.json'), 'w') as f:
+            json.dump({
+                'format': self.fmt, 'frames': self.written, 'fps': fps,
+                'width': self.size[0], 'height': self.size[1], 'pitch': self.pitch,
+                'pixel_format': self.pix_fmt, 'chunk_frames': self.chunk_frames,
+            }, f, indent=2)
+
+def capture(args):
+    """Прогнати сесію з записом кадрів; повертає словник зі статистикою."""
+    writer = None
+
+    def on_frame(game):
+        nonlocal writer
+        game.draw()
+        if writer is None:
+            writer = FrameWriter(args.out, game.screen, args.format, args.chunk_frames, args.queue,
+                                 args.writers, args.png_level)
+        writer.push(game.screen)
+
+    t0 = time.perf_counter()
+    if args.replay:
+        r = pacman.replay(args.replay, on_frame=on_frame)
+        sim_ms, ok = r['sim_ms'], r['ok']
+        fps = r['frames'] * 1000 / max(sim_ms, 1)
+    else:
+        game = pacman.Game(policy=pacman.POLICIES[args.policy], difficulty=args.difficulty,
+                           seed=args.seed)
+        game.simulate(max_ms=args.seconds * 1000, dt=1000 / args.fps, on_frame=on_frame)
+        sim_ms, ok, fps = game.elapsed_ms, None, args.fps
+    render_s = time.perf_counter() - t0
+    if writer is None:
+        raise SystemExit("жодного кадру")
+    writer.close(round(fps, 3))
+    wall = time.perf_counter() - t0
+    return {
+        'frames': writer.written, 'sim_s': sim_ms / 1000, 'wall_s': wall, 'render_s': render_s,
+        'bytes': writer.bytes, 'stalls': writer.stalls, 'hash_ok': ok,
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description="Запис гри Pacman у файли без вікна")
+    ap.add_argument('--replay', metavar='LOG', help="журнал для повтору (інакше — симуляція)")
+    ap.add_argument('--policy', default='autopilot', choices=sorted(pacman.POLICIES))
+    ap.add_argument('--seconds', type=float, default=60, help="ліміт симульованого часу")
+    ap.add_argument('--difficulty', type=int, default=pacman.DEFAULT_DIFFICULTY)
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--fps', type=float, default=pacman.FPS, help="кадрів на секунду гри (симуляція)")
+    ap.add_argument('--format', choices=('raw', 'png'), default='raw')
+    ap.add_argument('--chunk-frames', type=int, default=CHUNK_FRAMES)
+    ap.add_argument('--queue', type=int, default=QUEUE_FRAMES, help="кадрів у черзі до записувача")
+    ap.add_argument('--writers', type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                    help="потоків-кодувальників PNG")
+    ap.add_argument('--png-level', type=int, default=PNG_LEVEL, choices=range(10))
+    ap.add_argument('--out', default='capture')
+    args = ap.parse_args()
+
+    r = capture(args)
+    fps = r['frames'] / r['wall_s']
+    print(f"{r['frames']} кадрів ({r['sim_s']:.1f} с гри) за {r['wall_s']:.2f} с: {fps:.0f} кадр/с "
+          f"(x{r['sim_s'] / r['wall_s']:.1f} від реального часу), {r['bytes'] / 2**20:.0f} МБ -> {args.out}; "
+          f"рендер {r['render_s']:.2f} с, очікувань записувача {r['stalls']}"
+          + ('' if r['hash_ok'] is None else f"; хеш стану: {'OK' if r['hash_ok'] else 'НЕ ЗБІГАЄТЬСЯ'}"))
+    return 0 if r['hash_ok'] is not False else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,25 @@
 import pygame as pg
+import argparse
+import cProfile
+import csv
+import hashlib
+import heapq
+import json
+import math
+import os
 import random
-from collections import deque, defaultdict
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from collections import deque, defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from itertools import chain, permutations
+from multiprocessing import shared_memory, util as mp_util
+from operator import sub
 
 
 # =====================
@@ -39,7 +57,10 @@ SETTINGS = load_settings()
 TILE = SETTINGS.get('TILE', 24)
 GRID_W = SETTINGS.get('GRID_W', 27)
 GRID_H = SETTINGS.get('GRID_H', 21)
-SCREEN_W, SCREEN_H = GRID_W * TILE, GRID_H * TILE
+# Вікно показує не більше VIEW_W × VIEW_H клітинок; більший лабіринт прокручується камерою
+VIEW_W = SETTINGS.get('VIEW_W', 41)
+VIEW_H = SETTINGS.get('VIEW_H', 31)
+SCREEN_W, SCREEN_H = min(GRID_W, VIEW_W) * TILE, min(GRID_H, VIEW_H) * TILE
 FPS = SETTINGS.get('FPS', 60)
 
 PAC_STEP_MS = SETTINGS.get('PAC_STEP_MS', 180)
@@ -50,6 +71,74 @@ PELLET_SCORE = SETTINGS.get('PELLET_SCORE', 10)
 # Складність за замовчуванням (число від 0 до 5)
 DEFAULT_DIFFICULTY = SETTINGS.get('DIFFICULTY', 1)
 
+# Кількість привидів (кольори повторюються по колу)
+GHOST_COUNT = SETTINGS.get('GHOST_COUNT', 4)
+
+# Таблиця маршрутів: до скількох прохідних клітинок будувати повну таблицю N×N,
+# і скільки цілей тримати в LRU-кеші, якщо лабіринт більший
+NAV_TABLE_MAX_CELLS = SETTINGS.get('NAV_TABLE_MAX_CELLS', 1000)
+NAV_CACHE_TARGETS = SETTINGS.get('NAV_CACHE_TARGETS', 256)
+# До скількох прохідних клітинок безголова гра (sweep, повтори) будує повну таблицю одразу:
+# на малому лабіринті вона коштує десятки мс, а на більшому короткої симуляції не окупить
+# (41x31, ~630 клітинок — ~160 мс) — там маршрути на вимогу через граф розвилок
+NAV_TABLE_HEADLESS_CELLS = SETTINGS.get('NAV_TABLE_HEADLESS_CELLS', 400)
+# Великий лабіринт: маршрути через A* по графу розвилок (1) чи BFS-рядки з LRU (0);
+# скільки орієнтирів (landmarks) для евристики A*
+NAV_JUNCTIONS = SETTINGS.get('NAV_JUNCTIONS', 1)
+NAV_LANDMARKS = SETTINGS.get('NAV_LANDMARKS', 8)
+
+# Скільки відрендерених написів тримати в кеші тексту
+TEXT_CACHE_SIZE = SETTINGS.get('TEXT_CACHE_SIZE', 64)
+
+# Зір привидів: 0 — завжди знають, де Пакмен; 1 — бачать лише вздовж коридорів і
+# переслідують місце, де бачили Пакмена востаннє, а інакше патрулюють
+GHOST_SIGHT = SETTINGS.get('GHOST_SIGHT', 0)
+
+# Профілювання кадру: скільки останніх кадрів тримати, і чи вмикати одразу (0/1)
+PROFILE_FRAMES = SETTINGS.get('PROFILE_FRAMES', 600)
+PROFILE = SETTINGS.get('PROFILE', 0)
+
+# Рівні: скільки наступних рівнів готувати у фоні (0 — генерувати під час R), каталог
+# дискового кешу рівнів (0 — без кешу) і скільки файлів одного розміру в ньому тримати
+LEVEL_POOL = SETTINGS.get('LEVEL_POOL', 2)
+LEVEL_CACHE_DIR = SETTINGS.get('LEVEL_CACHE_DIR', 'level_cache')
+LEVEL_CACHE_MAX = SETTINGS.get('LEVEL_CACHE_MAX', 64)
+
+# Рахувати наступний тік привидів наперед у фоновому потоці (0/1; лише гра з вікном)
+# і лише коли останній тік тривав не менше GHOST_AI_MIN_TICK_MS: дешевий тік (кілька привидів,
+# простий рівень) швидше порахувати на місці, ніж ділити GIL із рендером заради нього
+GHOST_AI_THREAD = SETTINGS.get('GHOST_AI_THREAD', 1)
+GHOST_AI_MIN_TICK_MS = SETTINGS.get('GHOST_AI_MIN_TICK_MS', 4)
+
+# Перемотування: пам'ять буфера знімків (байти, 0 - вимкнено), опорний кадр кожні
+# REWIND_KEYFRAME кроків, на скільки кроків назад перемотує Backspace
+REWIND_BUDGET = SETTINGS.get('REWIND_BUDGET', 4000000)
+REWIND_KEYFRAME = SETTINGS.get('REWIND_KEYFRAME', 64)
+REWIND_STEPS = SETTINGS.get('REWIND_STEPS', 20)
+
+# Низька затримка вводу: 1 - поворот виконується одразу, якщо до кроку Пакмена лишилось не більше
+# INPUT_GRACE_MS (або Пакмен стоїть), чи переробляє крок, зроблений не більше INPUT_GRACE_MS тому;
+# ввід опитується ще й між оновленням і малюванням кадру
+INPUT_LOWLAT = SETTINGS.get('INPUT_LOWLAT', 1)
+INPUT_GRACE_MS = SETTINGS.get('INPUT_GRACE_MS', 60)
+
+# Планувальник кадрів: найдовший кадр, який бачить симуляція (довша пауза - перетягування вікна,
+# збирання сміття - обрізається), скільки кроків Пакмена / тіків привидів можна наздогнати за кадр
+# і скільки мс спати між перевірками подій на нерухомому екрані GAME OVER / YOU WIN
+MAX_FRAME_MS = SETTINGS.get('MAX_FRAME_MS', 250)
+MAX_CATCHUP_STEPS = SETTINGS.get('MAX_CATCHUP_STEPS', 2)
+IDLE_WAIT_MS = SETTINGS.get('IDLE_WAIT_MS', 500)
+
+# Автопілот (F6): вмикати одразу (0/1), скільки пелет планувати наперед, за скільки кроків
+# лабіринтом привид уже вважається загрозою
+AUTOPILOT = SETTINGS.get('AUTOPILOT', 0)
+AUTOPILOT_TOUR = SETTINGS.get('AUTOPILOT_TOUR', 8)
+AUTOPILOT_DANGER = SETTINGS.get('AUTOPILOT_DANGER', 6)
+
+# Великі лабіринти малюються шматками CHUNK × CHUNK клітинок; у LRU-кеші не більше CHUNK_CACHE шматків
+CHUNK = SETTINGS.get('CHUNK', 16)
+CHUNK_CACHE = SETTINGS.get('CHUNK_CACHE', 32)
+
 # Кольори
 BLACK = (0, 0, 0)
 BLUE = (33, 33, 222)
@@ -87,20 +176,111 @@ DIFFICULTY_KEYS = {
 # Назви рівнів складності для відображення в HUD
 DIFFICULTY_NAMES = ['Novice', 'Apprentice', 'Adept', 'Expert', 'Master', 'Legendary']
 
+# =====================
+# Компактна сітка
+# =====================
+class Grid:
+    """
+    Сітка лабіринту в плаский bytearray з рамкою стін завтовшки в одну клітинку.
+
+    Клітинка (x, y) лежить за індексом (y+1)*stride + (x+1), тож сусіди — це
+    i + offsets[k] (у порядку DIR_LIST), а перевірка меж не потрібна: за краєм
+    карти завжди WALL. Для сумісності працює й старий доступ grid[y][x]
+    (рядок — memoryview на той самий буфер, тож запис теж іде в сітку).
+    """
+    __slots__ = ('w', 'h', 'stride', 'cells', 'offsets')
+
+    def __init__(self, w, h, fill=WALL):
+        self.w, self.h = w, h
+        self.stride = w + 2
+        self.cells = bytearray([WALL]) * (self.stride * (h + 2))
+        # Зсуви до сусідів у порядку DIR_LIST: ліво, право, верх, низ
+        self.offsets = (-1, 1, -self.stride, self.stride)
+        if fill != WALL:
+            for y in range(h):
+                start = self.idx(0, y)
+                self.cells[start:start+w] = bytes([fill]) * w
+
+    def idx(self, x, y):
+        return (y+1)*self.stride + x + 1
+
+    def xy(self, i):
+        y, x = divmod(i, self.stride)
+        return x - 1, y - 1
+
+    def get(self, x, y):
+        """Клітинка (x, y); для x = -1..w, y = -1..h повертає WALL рамки без перевірок."""
+        return self.cells[(y+1)*self.stride + x + 1]
+
+    def set(self, x, y, value):
+        self.cells[(y+1)*self.stride + x + 1] = value
+
+    def indices(self):
+        """Плоскі індекси всіх клітинок карти (без рамки), рядок за рядком."""
+        for y in range(self.h):
+            start = self.idx(0, y)
+            yield from range(start, start + self.w)
+
+    def copy(self):
+        g = Grid.__new__(Grid)
+        g.w, g.h, g.stride, g.offsets = self.w, self.h, self.stride, self.offsets
+        g.cells = bytearray(self.cells)
+        return g
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Сітка зі списку списків (старий формат)."""
+        g = cls(len(rows[0]), len(rows))
+        for y, row in enumerate(rows):
+            start = g.idx(0, y)
+            g.cells[start:start+g.w] = bytes(row)
+        return g
+
+    def to_bytes(self):
+        """Клітинки карти без рамки, рядок за рядком (w*h байтів)."""
+        return b''.join(self.cells[self.idx(0, y):self.idx(0, y) + self.w] for y in range(self.h))
+
+    @classmethod
+    def from_bytes(cls, w, h, data):
+        """Сітка з результату to_bytes(); ValueError, якщо даних не w*h байтів."""
+        if len(data) != w * h:
+            raise ValueError(f"сітка {w}x{h}: очікувалось {w*h} байтів, а є {len(data)}")
+        g = cls(w, h)
+        for y in range(h):
+            start = g.idx(0, y)
+            g.cells[start:start+w] = data[y*w:(y+1)*w]
+        return g
+
+    def __getitem__(self, y):
+        if not 0 <= y < self.h:
+            raise IndexError(y)
+        start = (y+1)*self.stride + 1
+        return memoryview(self.cells)[start:start+self.w]
+
+    def __len__(self):
+        return self.h
+
+    def __iter__(self):
+        for y in range(self.h):
+            yield self[y]
+
+    def __eq__(self, other):
+        return isinstance(other, Grid) and self.w == other.w and self.h == other.h and self.cells == other.cells
+
 # =====================
 # Допоміжні функції
 # =====================
 
-def in_bounds(x, y):
-    return 0 <= x < GRID_W and 0 <= y < GRID_H
+def in_bounds(x, y, w=GRID_W, h=GRID_H):
+    return 0 <= x < w and 0 <= y < h
 
 def manhattan(a, b):
     return abs(a[0]-b[0]) + abs(a[1]-b[1])
 
-def neighbors4(x, y):
+def neighbors4(x, y, w=GRID_W, h=GRID_H):
     for dx, dy in DIR_LIST:
         nx, ny = x+dx, y+dy
-        if in_bounds(nx, ny):
+        if in_bounds(nx, ny, w, h):
             yield nx, ny
 
 def line_of_sight(grid, a, b):
@@ -111,8 +291,9 @@ def line_of_sight(grid, a, b):
     sy = 1 if y0 < y1 else -1
     err = dx - dy
     x,y = x0,y0
+    cells, stride = grid.cells, grid.stride
     while True:
-        if grid[y][x] == WALL:
+        if cells[(y+1)*stride + x + 1] == WALL:
             return False
         if (x,y) == (x1,y1):
             return True
@@ -125,29 +306,30 @@ def line_of_sight(grid, a, b):
 def find_path_step_bfs(grid, start_pos, end_pos):
     """
     Знаходить перший крок найкоротшого шляху від start_pos до end_pos за допомогою BFS.
-    Враховує стіни.
+    Враховує стіни. Замість копіювання шляху для кожної клітинки зберігаємо лише
+    перший крок, яким до неї дійшли.
     """
-    q = deque([(start_pos, [])])  # Черга: (поточна_позиція, шлях_до_неї)
-    visited = {start_pos}
+    cells, offsets = grid.cells, grid.offsets
+    start, end = grid.idx(*start_pos), grid.idx(*end_pos)
+    q = deque([start])  # Черга плоских індексів
+    first = {start: -1}  # індекс -> перший крок від start (індекс у DIR_LIST)
 
     while q:
-        (x, y), path = q.popleft()
+        i = q.popleft()
 
-        if (x, y) == end_pos:
-            # Якщо шлях знайдено, повертаємо перший крок
-            if not path:
-                return (0, 0) # Вже на місці
-            return path[0]
+        if i == end:
+            # Якщо шлях знайдено, повертаємо перший крок ((0, 0), якщо вже на місці)
+            k = first[i]
+            return (0, 0) if k < 0 else DIR_LIST[k]
 
         # Додаємо сусідів до черги
-        for dx, dy in DIR_LIST:
-            nx, ny = x + dx, y + dy
-            
-            if in_bounds(nx, ny) and (nx, ny) not in visited and grid[ny][nx] != WALL:
-                visited.add((nx, ny))
-                new_path = path + [(dx, dy)]
-                q.append(((nx, ny), new_path))
-    
+        step = first[i]
+        for k, off in enumerate(offsets):
+            j = i + off
+            if j not in first and cells[j] != WALL:
+                first[j] = step if step >= 0 else k
+                q.append(j)
+
     # Якщо шлях не знайдено (дуже рідкісний випадок)
     return (0, 0)
 
@@ -157,103 +339,1170 @@ def find_path_step_bfs(grid, start_pos, end_pos):
 
 def _seal_outer_border(grid):
     """Суцільні стіни по краях (жодних виходів за карту)."""
-    w, h = GRID_W, GRID_H
+    w, h = grid.w, grid.h
     for x in range(w):
-        grid[0][x] = WALL
-        grid[h-1][x] = WALL
+        grid.set(x, 0, WALL)
+        grid.set(x, h-1, WALL)
     for y in range(h):
-        grid[y][0] = WALL
-        grid[y][w-1] = WALL
-
-def _remove_dead_ends(grid, forbid=set()):
-    """Прибирає всі тупики: кожна FLOOR-клітинка має ≥2 виходи. Зовнішню рамку не чіпаємо."""
-    w, h = GRID_W, GRID_H
-    changed = True
-    while changed:
-        changed = False
-        for y in range(1, h-1):
-            for x in range(1, w-1):
-                if (x, y) in forbid:
-                    continue
-                if grid[y][x] != FLOOR:
-                    continue
-                exits = 0
-                walls = []
-                for nx, ny in neighbors4(x, y):
-                    if grid[ny][nx] == FLOOR:
-                        exits += 1
-                    elif grid[ny][nx] == WALL and (nx, ny) not in forbid and 1 <= nx < w-1 and 1 <= ny < h-1:
-                        walls.append((nx, ny))
-                if exits >= 2:
-                    continue
-                if walls:
-                    wx, wy = random.choice(walls)
-                    grid[wy][wx] = FLOOR
-                    changed = True
+        grid.set(0, y, WALL)
+        grid.set(w-1, y, WALL)
+
+def _remove_dead_ends(grid, forbid=frozenset(), candidates=None, rng=random):
+    """
+    Прибирає всі тупики: кожна FLOOR-клітинка має ≥2 виходи. Зовнішню рамку не чіпаємо.
+    forbid — множина плоских індексів клітинок, які не можна змінювати.
+    candidates — плоскі індекси, які можуть бути тупиками (None — вся карта).
+
+    Працює через список роботи: відкриття стіни лише додає виходи сусідам, тож
+    новим тупиком може стати тільки щойно відкрита клітинка (і сама клітинка,
+    якій виходів усе ще мало) — повторно перевіряємо лише їх, без повних проходів.
+    """
+    w, h, stride = grid.w, grid.h, grid.stride
+    cells, offsets = grid.cells, grid.offsets
+    work = list(grid.indices() if candidates is None else candidates)
+    work.reverse()  # pop() з кінця — обходимо кандидатів у початковому порядку
+    while work:
+        i = work.pop()
+        if cells[i] != FLOOR or i in forbid:
+            continue
+        exits = 0
+        walls = []
+        for off in offsets:
+            j = i + off
+            c = cells[j]
+            if c == FLOOR:
+                exits += 1
+            elif c == WALL and j not in forbid:
+                y1, x1 = divmod(j, stride)  # координати з урахуванням рамки
+                if 2 <= x1 < w and 2 <= y1 < h:
+                    walls.append(j)
+        if exits >= 2 or not walls:
+            continue
+        j = rng.choice(walls)
+        cells[j] = FLOOR
+        work.append(j)
+        work.append(i)
     _seal_outer_border(grid)
 
-def generate_maze_braid(w, h):
+def generate_maze_braid(w, h, rng=random):
+    """
+    Лабіринт без тупиків: DFS-карвінг по «камерах» (непарні координати) і braid.
+    Карвінг ітеративний (явний стек замість рекурсії), тож великі карти не впираються
+    в ліміт рекурсії. З тим самим rng (напр. random.Random(seed)) результат відтворюваний.
+    """
     # Ініціалізація стінами
-    grid = [[WALL for _ in range(w)] for __ in range(h)]
-
-    # DFS-карвінг по «камерах» (непарні координати)
-    def carve(x, y):
-        dirs = [(2,0),(-2,0),(0,2),(0,-2)]
-        random.shuffle(dirs)
-        for dx, dy in dirs:
-            nx, ny = x+dx, y+dy
-            if 1 <= nx < w-1 and 1 <= ny < h-1 and grid[ny][nx] == WALL:
-                grid[y+dy//2][x+dx//2] = FLOOR
-                grid[ny][nx] = FLOOR
-                carve(nx, ny)
-
-    sx, sy = 1, 1
-    grid[sy][sx] = FLOOR
-    carve(sx, sy)
+    grid = Grid(w, h)
+    cells, stride = grid.cells, grid.stride
+
+    # Маска камер, які можна карвити (1 <= x < w-1, 1 <= y < h-1, обидві координати непарні)
+    chamber = bytearray(len(cells))
+    xs = range(1, w-1, 2)
+    for y in range(1, h-1, 2):
+        start = grid.idx(1, y)
+        chamber[start:start + 2*len(xs):2] = b'\x01' * len(xs)
+
+    # DFS з явним стеком ребер (звідки, куди). Сусідів кладемо у стек у зворотному
+    # порядку випадкової перестановки, тож обхід той самий, що й у рекурсивного
+    # «backtracker»-а. Перестановку беремо з готової таблиці одним rng.random().
+    perms = [p[::-1] for p in permutations((2, -2, 2*stride, -2*stride))]
+    n_perms = len(perms)
+    rnd = rng.random
+    start = grid.idx(1, 1)
+    cells[start] = FLOOR
+    degree = bytearray(len(cells))  # кількість прорізаних проходів у камери
+    visited = [start]
+    stack = []
+    push, pop = stack.append, stack.pop
+    i = start
+    while i >= 0:
+        for m in perms[int(rnd() * n_perms)]:
+            j = i + m
+            if chamber[j] and cells[j] == WALL:
+                push((i, j))
+        i = -1
+        while stack:
+            a, b = pop()
+            if cells[b] == WALL:
+                cells[(a + b) >> 1] = FLOOR  # стіна між камерами
+                cells[b] = FLOOR
+                degree[a] += 1
+                degree[b] = 1
+                visited.append(b)
+                i = b
+                break
+
+    # Тупики після карвінгу — лише камери з одним проходом
+    leaves = [i for i in visited if degree[i] < 2]
 
     # Braid до повного зникнення тупиків + закриття рамки
     _seal_outer_border(grid)
-    _remove_dead_ends(grid)
+    _remove_dead_ends(grid, candidates=leaves, rng=rng)
     return grid
 
+# Розмір клітки привидів (разом зі стінами)
+PEN_W, PEN_H = 7, 5
+
+def _pen_box(grid):
+    """Лівий верхній кут клітки привидів і її центр."""
+    cx, cy = grid.w//2, grid.h//2
+    return (cx - PEN_W//2, cy - PEN_H//2), (cx, cy)
+
 def add_ghost_pen(grid):
     # Створити клітку привидів у центрі з воротами
-    cx, cy = GRID_W//2, GRID_H//2
-    pen_w, pen_h = 7, 5
-    x0 = cx - pen_w//2
-    y0 = cy - pen_h//2
-    for y in range(y0, y0+pen_h):
-        for x in range(x0, x0+pen_w):
-            if x==x0 or x==x0+pen_w-1 or y==y0 or y==y0+pen_h-1:
-                grid[y][x] = WALL
+    (x0, y0), (cx, cy) = _pen_box(grid)
+    for y in range(y0, y0+PEN_H):
+        for x in range(x0, x0+PEN_W):
+            if x==x0 or x==x0+PEN_W-1 or y==y0 or y==y0+PEN_H-1:
+                grid.set(x, y, WALL)
             else:
-                grid[y][x] = PEN
+                grid.set(x, y, PEN)
     gate_x = cx
-    grid[y0][gate_x] = GATE
+    grid.set(gate_x, y0, GATE)
     return (gate_x, y0), (cx, cy)
 
-def _repair_after_pen(grid):
-    """Після вставки PEN/GATE прибрати нові тупики поза кліткою, не змінюючи контур клітки."""
+def _repair_after_pen(grid, rng=random):
+    """
+    Після вставки PEN/GATE прибрати нові тупики поза кліткою, не змінюючи контур клітки.
+    Змінилася лише область клітки, тож перевіряємо тільки її околицю, а не всю карту.
+    """
+    cells, offsets = grid.cells, grid.offsets
+    (x0, y0), _ = _pen_box(grid)
     forbid = set()
-    w, h = GRID_W, GRID_H
-    for y in range(h):
-        for x in range(w):
-            if grid[y][x] in (PEN, GATE):
-                forbid.add((x, y))
-    # Додати стіни, що межують із PEN (контур клітки)
-    for y in range(h):
-        for x in range(w):
-            if grid[y][x] == WALL:
-                for nx, ny in neighbors4(x, y):
-                    if grid[ny][nx] == PEN:
-                        forbid.add((x, y))
-                        break
-    _remove_dead_ends(grid, forbid=forbid)
+    candidates = []
+    for y in range(max(0, y0-1), min(grid.h, y0+PEN_H+1)):
+        for x in range(max(0, x0-1), min(grid.w, x0+PEN_W+1)):
+            i = grid.idx(x, y)
+            if cells[i] in (PEN, GATE):
+                forbid.add(i)
+            # Додати стіни, що межують із PEN (контур клітки)
+            elif cells[i] == WALL and any(cells[i+off] == PEN for off in offsets):
+                forbid.add(i)
+            elif cells[i] == FLOOR:
+                candidates.append(i)
+    _remove_dead_ends(grid, forbid=forbid, candidates=candidates, rng=rng)
+
+# =====================
+# Таблиця маршрутів між усіма парами клітинок
+# =====================
+NAV_UNREACHABLE = 0xFFFF  # відстань до недосяжної клітинки
+NO_STEP = 0xFF            # «кроку немає» в таблиці next-hop
+
+class NavTable:
+    """
+    Відстані та перші кроки (next-hop) між прохідними клітинками лабіринту.
+
+    Клітинки нумеруються компактно (лише не-стіни). Для кожної цілі t є рядок
+    dist[t*n + s] — довжина шляху від s до t, і hop[t*n + s] — індекс у DIR_LIST
+    першого кроку з s до t. Тож рішення привида — це O(1) пошук у таблиці.
+    Серед рівних шляхів обирається той самий крок, що й у find_path_step_bfs.
+
+    Якщо клітинок більше за max_cells, повна таблиця N×N не будується: маршрути
+    шукає A* по графу розвилок (JunctionGraph), а з junctions=False — рядки
+    рахуються BFS-ом від цілі на вимогу й тримаються в LRU-кеші на cache_targets цілей.
+
+    З defer=True конструктор не чекає на N BFS: повну таблицю будує фоновий потік
+    (build_full_async), а доти маршрути дають ті самі BFS-рядки на вимогу.
+    """
+
+    def __init__(self, grid, max_cells=NAV_TABLE_MAX_CELLS, cache_targets=NAV_CACHE_TARGETS, tables=None,
+                 junctions=NAV_JUNCTIONS, defer=False):
+        # tables — готові (dist, hop) повної таблиці цього ж лабіринту (напр. з кешу рівнів)
+        self.grid = grid
+        self.compact = array('i', [-1]) * len(grid.cells)  # плоский індекс сітки -> компактний
+        self.cells = []   # компактний індекс -> (x, y)
+        flat = []         # компактний індекс -> плоский індекс сітки
+        for i in grid.indices():
+            if grid.cells[i] != WALL:
+                self.compact[i] = len(flat)
+                flat.append(i)
+                self.cells.append(grid.xy(i))
+        n = self.n = len(flat)
+
+        # Сусіди кожної клітинки у порядку DIR_LIST: (індекс_напрямку, індекс_сусіда)
+        self.adj = []
+        for i in flat:
+            links = []
+            for k, off in enumerate(grid.offsets):
+                j = self.compact[i + off]
+                if j >= 0:
+                    links.append((k, j))
+            self.adj.append(tuple(links))
+
+        self.full = n <= max_cells
+        self.cache_targets = cache_targets
+        self._rows = OrderedDict()  # ціль -> (dist, hop), лише для лінивого режиму
+        self._lock = threading.Lock()  # кеш рядків спільний з потоком GhostPlanner
+        if tables is not None and len(tables[0]) == len(tables[1]) == n*n:
+            self.full = True  # готова таблиця (кеш, спільна пам'ять) — навіть більша за max_cells
+            self.dist, self.hop = tables
+        elif self.full and defer:
+            self.full = False  # до готовності таблиці — BFS-рядки на вимогу
+            self.deferred = True
+        elif self.full:
+            self.dist, self.hop = self._full_tables()
+        self.junctions = JunctionGraph(self) if (junctions and not self.full and not self.deferred) else None
+        self.bfs_rows = 0  # скільки рядків пораховано BFS-ом (для звіту)
+
+    deferred = False  # повна таблиця ще не побудована, але буде (defer=True)
+
+    def _full_tables(self):
+        """Повна таблиця: BFS від кожної цілі."""
+        n = self.n
+        dist = array('H', [NAV_UNREACHABLE]) * (n*n)
+        hop = bytearray([NO_STEP]) * (n*n)
+        for t in range(n):
+            row_dist, row_hop = self._bfs_row(t)
+            dist[t*n:(t+1)*n] = row_dist
+            hop[t*n:(t+1)*n] = row_hop
+        return dist, hop
+
+    def build_full_async(self, on_ready=None):
+        """Для defer=True: побудувати повну таблицю у фоновому потоці; on_ready() — коли готова."""
+        if self.deferred:
+            threading.Thread(target=self._build_full, args=(on_ready,), name="nav-table",
+                             daemon=True).start()
+
+    def _build_full(self, on_ready):
+        # таблиця стає видимою лише цілком готовою
+        self.dist, self.hop = self._full_tables()
+        self.full = True
+        self.deferred = False
+        with self._lock:
+            self._rows.clear()
+        if on_ready is not None:
+            on_ready()
+
+    def _bfs_row(self, t):
+        """BFS від цілі t: відстані до t і перший крок у бік t для кожної клітинки."""
+        n, adj = self.n, self.adj
+        dist = [NAV_UNREACHABLE] * n
+        dist[t] = 0
+        frontier = [t]
+        d = 0
+        while frontier:
+            d += 1
+            nxt = []
+            for u in frontier:
+                for _, v in adj[u]:
+                    if dist[v] == NAV_UNREACHABLE:
+                        dist[v] = d
+                        nxt.append(v)
+            frontier = nxt
+
+        # Перший крок — найменший індекс DIR_LIST серед сусідів, ближчих до цілі на 1
+        hop = bytearray([NO_STEP]) * n
+        for s in range(n):
+            ds = dist[s]
+            if ds == 0 or ds == NAV_UNREACHABLE:
+                continue
+            for k, v in adj[s]:
+                if dist[v] == ds - 1:
+                    hop[s] = k
+                    break
+        return array('H', dist), hop
+
+    def _row(self, t):
+        """(dist, hop, зсув) для цілі t."""
+        if self.full:
+            return self.dist, self.hop, t * self.n
+        with self._lock:
+            row = self._rows.get(t)
+            if row is None:
+                row = self._bfs_row(t)
+                self.bfs_rows += 1
+                self._rows[t] = row
+                if len(self._rows) > self.cache_targets:
+                    self._rows.popitem(last=False)
+            else:
+                self._rows.move_to_end(t)
+        return row[0], row[1], 0
+
+    def step(self, start_pos, end_pos):
+        """Перший крок найкоротшого шляху (як find_path_step_bfs): (dx, dy) або (0, 0)."""
+        s = self.compact[self.grid.idx(*start_pos)]
+        t = self.compact[self.grid.idx(*end_pos)]
+        if s < 0 or t < 0:
+            return (0, 0)
+        if self.junctions is not None:
+            k = self.junctions.route(s, t)[1]
+            return (0, 0) if k == NO_STEP else DIR_LIST[k]
+        _, hop, off = self._row(t)
+        k = hop[off + s]
+        return (0, 0) if k == NO_STEP else DIR_LIST[k]
+
+    def distance(self, a, b):
+        """Довжина шляху лабіринтом між a і b (NAV_UNREACHABLE, якщо шляху немає)."""
+        s = self.compact[self.grid.idx(*a)]
+        t = self.compact[self.grid.idx(*b)]
+        if s < 0 or t < 0:
+            return NAV_UNREACHABLE
+        if self.junctions is not None:
+            return self.junctions.route(s, t)[0]
+        dist, _, off = self._row(t)
+        return dist[off + s]
+
+class JunctionGraph:
+    """
+    Стиснений лабіринт: вузли — розвилки (клітинки з кількістю виходів ≠ 2, тобто
+    й глухі кути), ребра — коридори між ними з довжиною. Кожна клітинка коридору
+    знає свій коридор і зсув від його початку. У сплетеному лабіринті розвилок
+    близько 10% клітинок, а A* з евристикою орієнтирів (ALT: для орієнтира L
+    |d(L, j) - d(L, g)| — нижня межа відстані, що враховує стіни) розкриває з них
+    лише частину — у десятки й сотні разів менше вузлів, ніж BFS по клітинках.
+    Відповідь та сама, що й у NavTable: відстань і перший крок, а серед рівних
+    шляхів — найменший індекс DIR_LIST.
+    """
+    _FAR = 1 << 40
+
+    def __init__(self, nav, landmarks=NAV_LANDMARKS):
+        self.nav = nav
+        adj = nav.adj
+        n = nav.n
+        self.is_junction = bytearray(len(a) != 2 for a in adj)
+        self.corridor = array('i', [-1]) * n  # клітинка -> коридор (-1 для розвилок)
+        self.offset = array('i', bytes(4 * n))  # клітинка -> зсув від початку коридору
+        self.corridors = []  # (початок, кінець, довжина)
+        # розвилка -> [(напрямок, сусідня розвилка, довжина, коридор)]
+        self.links = {}
+        for j in range(n):
+            if self.is_junction[j]:
+                self._walk_from(j)
+        # Кільця без жодної розвилки: одна їхня клітинка стає розвилкою
+        for u in range(n):
+            if not self.is_junction[u] and self.corridor[u] < 0:
+                self.is_junction[u] = 1
+                self._walk_from(u)
+        self._pick_landmarks(landmarks)
+        self.queries = 0
+        self.expanded = 0  # скільки розвилок розкрив A* за всі запити
+
+    def _walk_from(self, j):
+        """Пройти всі коридори, що виходять з розвилки j (кожен коридор записується раз)."""
+        adj, is_junction = self.nav.adj, self.is_junction
+        links = self.links.setdefault(j, [])
+        for k, v in adj[j]:
+            prev, cur, length = j, v, 1
+            cells = []
+            while not is_junction[cur]:
+                cells.append(cur)
+                a, b = adj[cur]
+                prev, cur = cur, (b[1] if a[1] == prev else a[1])
+                length += 1
+            if cells and self.corridor[cells[0]] >= 0:
+                cid = self.corridor[cells[0]]  # коридор уже пройдено з іншого кінця
+            else:
+                cid = len(self.corridors)
+                self.corridors.append((j, cur, length))
+                for o, u in enumerate(cells, 1):
+                    self.corridor[u] = cid
+                    self.offset[u] = o
+            links.append((k, cur, length, cid))
+
+    def _dijkstra(self, sources):
+        """Відстані від джерел {розвилка: відстань} до всіх розвилок."""
+        far = self._FAR
+        dist = dict.fromkeys(self.links, far)
+        heap = [(d, j) for j, d in sources.items()]
+        heapq.heapify(heap)
+        for j, d in sources.items():
+            dist[j] = min(dist[j], d)
+        while heap:
+            d, j = heapq.heappop(heap)
+            if d > dist[j]:
+                continue
+            for _, v, length, _ in self.links[j]:
+                nd = d + length
+                if nd < dist[v]:
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        return dist
+
+    def _pick_landmarks(self, count):
+        """Орієнтири — найвіддаленіші розвилки (жадібно); для кожної розвилки — кортеж відстаней до них."""
+        junctions = list(self.links)
+        rows = []
+        if junctions:
+            nearest = dict.fromkeys(junctions, self._FAR)
+            pick = junctions[0]
+            for _ in range(min(count, len(junctions))):
+                row = self._dijkstra({pick: 0})
+                rows.append(row)
+                for j in junctions:
+                    nearest[j] = min(nearest[j], row[j])
+                # недосяжні розвилки (інша компонента) теж мають шанс стати орієнтиром
+                pick = max(junctions, key=nearest.__getitem__)
+        self.landmarks = {j: tuple(row[j] for row in rows) for j in junctions}
+
+    def _exits(self, u):
+        """Як клітинка u виходить на розвилки: [(розвилка, відстань, напрямок першого кроку)]."""
+        if self.is_junction[u]:
+            return [(u, 0, NO_STEP)]
+        a, b, length = self.corridors[self.corridor[u]]
+        o = self.offset[u]
+        (k1, v1), (k2, v2) = self.nav.adj[u]
+        # сусід ближче до початку коридору — або розвилка a, або клітинка зі зсувом o - 1
+        to_a = v1 if (v1 == a and o == 1) or (self.corridor[v1] == self.corridor[u] and self.offset[v1] == o - 1) else v2
+        ka, kb = (k1, k2) if to_a == v1 else (k2, k1)
+        return [(a, o, ka), (b, length - o, kb)]
+
+    def _landmark_dists(self, u):
+        """Відстані від орієнтирів до клітинки u (для коридору — через ближчий кінець)."""
+        if self.is_junction[u]:
+            return self.landmarks[u]
+        a, b, length = self.corridors[self.corridor[u]]
+        o = self.offset[u]
+        return tuple(min(x + o, y + length - o) for x, y in zip(self.landmarks[a], self.landmarks[b]))
+
+    def _search(self, sources, goals, toward):
+        """
+        A* від джерел {розвилка: відстань}, доки не розкрито всі розвилки goals
+        (поруч із клітинкою, чиї відстані до орієнтирів — toward); {розвилка: відстань}.
+        """
+        lm = self.landmarks
+        far = self._FAR
+        dist = {}
+        heap = []
+        for j, d in sources.items():
+            if d < dist.get(j, far):
+                dist[j] = d
+        for j, d in dist.items():
+            heap.append((d + max(map(abs, map(sub, lm[j], toward)), default=0), d, j))
+        heapq.heapify(heap)
+        done = {}
+        left = set(goals)
+        links = self.links
+        while heap and left:
+            _, d, j = heapq.heappop(heap)
+            if j in done:
+                continue
+            done[j] = d
+            left.discard(j)
+            self.expanded += 1
+            for _, v, length, _ in links[j]:
+                nd = d + length
+                if v not in done and nd < dist.get(v, far):
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd + max(map(abs, map(sub, lm[v], toward)), default=0), nd, v))
+        return done
+
+    def route(self, s, t):
+        """(відстань, індекс першого кроку в DIR_LIST) від клітинки s до t (компактні індекси)."""
+        self.queries += 1
+        if s == t:
+            return 0, NO_STEP
+        far = self._FAR
+        sources = {}
+        for j, d, _ in self._exits(t):
+            sources[j] = min(d, sources.get(j, far))
+        # Варіанти першого кроку з s: (напрямок, розвилка, відстань до неї, пряма відстань до t)
+        options = []
+        cs = -1 if self.is_junction[s] else self.corridor[s]
+        ct = -1 if self.is_junction[t] else self.corridor[t]
+        if cs >= 0:
+            for side, (j, d, k) in enumerate(self._exits(s)):
+                direct = far
+                if cs == ct:
+                    ot, os_ = self.offset[t], self.offset[s]
+                    # t у тому ж коридорі з боку цього виходу (0 — до початку коридору)
+                    if (side == 0) == (ot < os_):
+                        direct = abs(ot - os_)
+                options.append((k, j, d, direct))
+        else:
+            for k, v, length, cid in self.links[s]:
+                direct = far
+                if cid == ct:
+                    # t у цьому коридорі: зсув рахуємо від того кінця, з якого в нього зайшли
+                    ot = self.offset[t]
+                    direct = ot if self._enters_at_start(s, k, cid) else length - ot
+                options.append((k, v, length, direct))
+        goals = {j for _, j, _, _ in options}
+        dist = self._search(sources, goals, self._landmark_dists(s))
+        best = far
+        costs = []
+        for k, j, d, direct in options:
+            c = min(direct, d + dist.get(j, far))
+            costs.append((k, c))
+            best = min(best, c)
+        if best >= far:
+            return NAV_UNREACHABLE, NO_STEP
+        return best, min(k for k, c in costs if c == best)
+
+    def _enters_at_start(self, j, k, cid):
+        """Чи крок k з розвилки j веде в коридор cid з його початку (важливо для петель a == b)."""
+        a, b, length = self.corridors[cid]
+        if a != b:
+            return j == a
+        v = self.nav.compact[self.nav.grid.idx(*self.nav.cells[j]) + self.nav.grid.offsets[k]]
+        return self.offset[v] == 1
+
+class DistanceField:
+    """
+    Карта відстаней (Dijkstra map) від однієї клітинки — Пакмена — до всіх інших.
+    Спільна для всіх привидів: переслідувач просто спускається по градієнту.
+
+    Коли джерело зсувається на сусідню клітинку, кожна відстань змінюється рівно на ±1
+    (сітка — двочасткий граф). Зменшуються лише ті клітинки, для яких нове джерело
+    лежить на найкоротшому шляху до старого, — нащадки нової клітинки в старому
+    BFS-дереві. Тож зберігаємо stored[v] = d(v) - offset: усім +1 дає offset += 1,
+    а для нащадків stored -= 2. Оновлення коштує O(нащадків), а не O(карти).
+    """
+    _FAR = 1 << 40  # «недосяжно» для збережених значень
+
+    def __init__(self, nav, source):
+        self.nav = nav
+        self.rebuilds = 0
+        self.updates = 0
+        self.touched = 0  # скільки клітинок змінило останнє оновлення
+        self.rebuild(source)
+
+    def rebuild(self, source):
+        """Повний BFS від source."""
+        nav = self.nav
+        far = self._FAR
+        stored = [far] * nav.n
+        src = nav.compact[nav.grid.idx(*source)]
+        stored[src] = 0
+        frontier = [src]
+        d = 0
+        adj = nav.adj
+        while frontier:
+            d += 1
+            nxt = []
+            for u in frontier:
+                for _, v in adj[u]:
+                    if stored[v] == far:
+                        stored[v] = d
+                        nxt.append(v)
+            frontier = nxt
+        self.stored = stored
+        self.offset = 0
+        self.source = source
+        self.src = src
+        self.rebuilds += 1
+        self.touched = nav.n
+
+    def move_to(self, source):
+        """Перенести джерело; для сусідньої клітинки — інкрементально."""
+        if source == self.source:
+            return
+        if manhattan(source, self.source) != 1:
+            self.rebuild(source)
+            return
+        nav = self.nav
+        stored, adj = self.stored, nav.adj
+        new = nav.compact[nav.grid.idx(*source)]
+        # Нащадки new у старому BFS-дереві: шлях, де відстань щокроку зростає на 1
+        desc = [new]
+        seen = {new}
+        for u in desc:
+            du = stored[u] + 1
+            for _, v in adj[u]:
+                if stored[v] == du and v not in seen:
+                    seen.add(v)
+                    desc.append(v)
+        for v in desc:
+            stored[v] -= 2
+        self.offset += 1
+        self.source = source
+        self.src = new
+        self.updates += 1
+        self.touched = len(desc)
+
+    def snapshot(self):
+        """Незмінна копія поля (для потоку GhostPlanner): move_to() оригіналу її не зачіпає."""
+        f = DistanceField.__new__(DistanceField)
+        f.nav, f.offset, f.source, f.src = self.nav, self.offset, self.source, self.src
+        f.stored = self.stored[:]
+        f.rebuilds, f.updates, f.touched = self.rebuilds, self.updates, self.touched
+        return f
+
+    def distance(self, pos):
+        """Відстань від pos до джерела (NAV_UNREACHABLE, якщо недосяжно або стіна)."""
+        nav = self.nav
+        v = nav.compact[nav.grid.idx(*pos)]
+        if v < 0 or self.stored[v] >= self._FAR // 2:
+            return NAV_UNREACHABLE
+        return self.stored[v] + self.offset
+
+    def step(self, pos):
+        """Крок униз по градієнту (як NavTable.step до джерела): (dx, dy) або (0, 0)."""
+        nav = self.nav
+        v = nav.compact[nav.grid.idx(*pos)]
+        if v < 0:
+            return (0, 0)
+        stored = self.stored
+        target = stored[v] - 1
+        if target < -self.offset or stored[v] >= self._FAR // 2:
+            return (0, 0)
+        for k, u in nav.adj[v]:
+            if stored[u] == target:
+                return DIR_LIST[k]
+        return (0, 0)
+
+# =====================
+# Видимість
+# =====================
+class VisibilityIndex:
+    """
+    Індекс прямої видимості, побудований з готової сітки (після _repair_after_pen).
+
+    Кожна прохідна клітинка отримує номер свого горизонтального й вертикального
+    «відрізка коридору» — максимального ряду не-стін. Дві клітинки бачать одна одну,
+    якщо лежать на одному відрізку: для таких пар це рівно те, що дає line_of_sight,
+    але за O(1) замість трасування променя. Діагональна видимість не враховується —
+    у лабіринті на «камерах» її й так майже завжди перекриває стовпчик стіни.
+    """
+
+    def __init__(self, grid):
+        t0 = time.perf_counter()
+        self.grid = grid
+        cells, stride = grid.cells, grid.stride
+        self.hrun = array('i', [-1]) * len(cells)
+        self.vrun = array('i', [-1]) * len(cells)
+        run = -1
+        for y in range(grid.h):
+            prev_wall = True
+            for i in range(grid.idx(0, y), grid.idx(grid.w, y)):
+                if cells[i] == WALL:
+                    prev_wall = True
+                    continue
+                if prev_wall:
+                    run += 1
+                    prev_wall = False
+                self.hrun[i] = run
+        self.h_segments = run + 1
+        run = -1
+        for x in range(grid.w):
+            prev_wall = True
+            for i in range(grid.idx(x, 0), grid.idx(x, grid.h), stride):
+                if cells[i] == WALL:
+                    prev_wall = True
+                    continue
+                if prev_wall:
+                    run += 1
+                    prev_wall = False
+                self.vrun[i] = run
+        self.v_segments = run + 1
+        self.build_ms = (time.perf_counter() - t0) * 1000
+        self.nbytes = self.hrun.itemsize * len(self.hrun) + self.vrun.itemsize * len(self.vrun)
+
+    def visible(self, a, b):
+        """Чи бачать клітинки a і b одна одну (O(1))."""
+        i = self.grid.idx(*a)
+        j = self.grid.idx(*b)
+        h = self.hrun[i]
+        if h >= 0 and h == self.hrun[j]:
+            return True
+        v = self.vrun[i]
+        return v >= 0 and v == self.vrun[j]
+
+# =====================
+# Сховище пелет
+# =====================
+class PelletStore:
+    """
+    Множина пелет з O(1) додаванням, видаленням, кількістю й рівномірною випадковою
+    вибіркою (список + словник позицій, видалення — обмін з останнім елементом).
+    Для запитів «найближча пелета до клітинки» пелети ще й розкладені по кошиках
+    bucket × bucket клітинок, тож пошук оглядає лише кілька сусідніх кошиків.
+    Поводиться як set: in, len, ітерація, add/remove/discard.
+    """
+
+    def __init__(self, w, h, positions=(), bucket=8):
+        self.bucket = bucket
+        self.bw = (w + bucket - 1) // bucket
+        self.bh = (h + bucket - 1) // bucket
+        self._items = []
+        self._index = {}
+        self._buckets = [set() for _ in range(self.bw * self.bh)]
+        for pos in positions:
+            self.add(pos)
+
+    def _bucket_of(self, pos):
+        return self._buckets[(pos[1] // self.bucket) * self.bw + pos[0] // self.bucket]
+
+    def add(self, pos):
+        if pos in self._index:
+            return
+        self._index[pos] = len(self._items)
+        self._items.append(pos)
+        self._bucket_of(pos).add(pos)
+
+    def remove(self, pos):
+        i = self._index.pop(pos)  # KeyError, як у set.remove
+        last = self._items.pop()
+        if i < len(self._items):
+            self._items[i] = last
+            self._index[last] = i
+        self._bucket_of(pos).discard(pos)
+
+    def discard(self, pos):
+        if pos in self._index:
+            self.remove(pos)
+
+    def sample(self, rng=random):
+        """Випадкова пелета за O(1) (без копіювання множини в список)."""
+        return self._items[int(rng.random() * len(self._items))]
+
+    def snapshot(self):
+        """Незмінна копія для вибірки в іншому потоці (той самий порядок, тож і та сама sample())."""
+        return PelletSnapshot(self._items)
+
+    def nearest(self, pos):
+        """Найближча (манхеттенська відстань) пелета до pos або None, якщо пелет немає."""
+        if not self._items:
+            return None
+        x, y = pos
+        b = self.bucket
+        bx, by = x // b, y // b
+        best, best_d = None, None
+        r = 0
+        while True:
+            # Кошики на «кільці» r навколо (bx, by)
+            for cy in range(by - r, by + r + 1):
+                if not 0 <= cy < self.bh:
+                    continue
+                step = 1 if cy in (by - r, by + r) else 2 * r
+                for cx in range(bx - r, bx + r + 1, max(1, step)):
+                    if not 0 <= cx < self.bw:
+                        continue
+                    for p in self._buckets[cy * self.bw + cx]:
+                        d = abs(p[0] - x) + abs(p[1] - y)
+                        if best_d is None or d < best_d:
+                            best, best_d = p, d
+            # Усе за кільцем r щонайменше на r*b клітинок далі — далі шукати марно
+            if best_d is not None and best_d <= r * b:
+                return best
+            r += 1
+            if r > max(self.bw, self.bh):
+                return best
+
+    def __contains__(self, pos):
+        return pos in self._index
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+class PelletSnapshot:
+    """Знімок PelletStore: лише len і sample()."""
+    __slots__ = ('_items',)
+
+    def __init__(self, items):
+        self._items = tuple(items)
+
+    sample = PelletStore.sample
+
+    def __len__(self):
+        return len(self._items)
+
+# =====================
+# Рівні: фонова генерація й дисковий кеш
+# =====================
+@dataclass
+class Level:
+    """Готовий рівень: усе, що reset() інакше рахував би сам."""
+    w: int
+    h: int
+    seed: int
+    grid: Grid
+    gate_pos: tuple
+    spawn_points: list   # клітинки PEN у порядку сітки
+    pellets: list        # позиції пелет у порядку сітки
+    nav: NavTable = None
+
+def build_level(w, h, seed, nav_cells=NAV_TABLE_MAX_CELLS, defer=False, on_ready=None):
+    """
+    Згенерувати рівень для (w, h, seed): лабіринт, клітка, пелети, таблиця маршрутів
+    (повна — до nav_cells прохідних клітинок). З defer=True вона добудовується у фоні,
+    а on_ready(level) викликається, коли таблиця готова.
+    """
+    rng = random.Random(seed)
+    grid = generate_maze_braid(w, h, rng)
+    gate_pos, _ = add_ghost_pen(grid)
+    _repair_after_pen(grid, rng)  # приберемо потенційні тупики після вставки PEN
+    cells = grid.cells
+    # без пелет біля клітки
+    gx, gy = gate_pos
+    near_gate = {(x, y) for y in range(gy-2, gy+4) for x in range(gx-3, gx+4)}
+    pellets, spawn_points = [], []
+    for i in grid.indices():
+        if cells[i] == FLOOR:
+            pos = grid.xy(i)
+            if pos not in near_gate:
+                pellets.append(pos)
+        elif cells[i] == PEN:
+            spawn_points.append(grid.xy(i))
+    level = Level(w, h, seed, grid, gate_pos, spawn_points, pellets,
+                  NavTable(grid, max_cells=nav_cells, defer=defer))
+    level.nav.build_full_async(on_ready and (lambda: on_ready(level)))
+    return level
+
+# Таблиці для (роз)пакування по bits біт на значення: зсув значення в позицію k і назад
+def _bit_tables(bits):
+    per_byte = 8 // bits
+    mask = (1 << bits) - 1
+    shift = [bytes(((v & mask) << (k*bits)) for v in range(256)) for k in range(per_byte)]
+    unshift = [bytes(((v >> (k*bits)) & mask) for v in range(256)) for k in range(per_byte)]
+    return shift, unshift
+
+_BIT_TABLES = {1: _bit_tables(1), 2: _bit_tables(2)}
+
+def _pack_bits(values, bits):
+    """
+    Пакує байти-значення (кожне < 2**bits) по 8/bits у байт. Замість циклу по
+    значеннях: k-те значення кожної групи зсувається translate-ом, а групи
+    об'єднуються OR-ом великих цілих — усе на рівні C.
+    """
+    per_byte = 8 // bits
+    values = bytes(values) + bytes(-len(values) % per_byte)
+    n = len(values) // per_byte
+    shift = _BIT_TABLES[bits][0]
+    acc = 0
+    for k in range(per_byte):
+        acc |= int.from_bytes(values[k::per_byte].translate(shift[k]), 'little')
+    return acc.to_bytes(n, 'little')
+
+def _unpack_bits(packed, bits, count):
+    per_byte = 8 // bits
+    out = bytearray(len(packed) * per_byte)
+    unshift = _BIT_TABLES[bits][1]
+    for k in range(per_byte):
+        out[k::per_byte] = packed.translate(unshift[k])
+    return bytes(out[:count])
+
+LEVEL_MAGIC = b'PMLV'
+LEVEL_VERSION = 1
+# magic, версія, ширина, висота, сід, брама x, y, кількість спавнів, довжина стиснутої таблиці маршрутів
+_LEVEL_HEADER = struct.Struct('<4sBHHQHHHI')
+
+def save_level(level, path):
+    """
+    Записати рівень: сітка по 2 біти на клітинку, маска пелет по 1 біту,
+    спавни — парами uint16, таблиця маршрутів (якщо повна) — стиснута zlib.
+    Файл пишеться через тимчасовий і os.replace, тож паралельні процеси не бачать напівзапису.
+    """
+    w, h, grid = level.w, level.h, level.grid
+    mask = bytearray(w * h)
+    for x, y in level.pellets:
+        mask[y*w + x] = 1
+    nav = b''
+    if level.nav is not None and level.nav.full:
+        nav = zlib.compress(level.nav.dist.tobytes() + bytes(level.nav.hop), 6)
+    spawns = array('H', [c for pos in level.spawn_points for c in pos])
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(_LEVEL_HEADER.pack(LEVEL_MAGIC, LEVEL_VERSION, w, h, level.seed,
+                                   *level.gate_pos, len(level.spawn_points), len(nav)))
+        f.write(_pack_bits(grid.to_bytes(), 2))
+        f.write(_pack_bits(mask, 1))
+        f.write(spawns.tobytes())
+        f.write(nav)
+    os.replace(tmp, path)
+
+def load_level(path, nav_cells=NAV_TABLE_MAX_CELLS, defer=False, on_ready=None):
+    """
+    Прочитати рівень, записаний save_level(); None, якщо файл іншої версії.
+    Таблиця маршрутів з файлу береться як є, інакше будується як у build_level().
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, w, h, seed, gx, gy, n_spawns, nav_len = _LEVEL_HEADER.unpack_from(data)
+    if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+        return None
+    pos = _LEVEL_HEADER.size
+    expected = pos + (w*h + 3) // 4 + (w*h + 7) // 8 + 4*n_spawns + nav_len
+    if len(data) != expected:
+        raise ValueError(f"{path}: {len(data)} байтів замість {expected} (файл обрізаний або пошкоджений)")
+    size = (w*h + 3) // 4
+    grid = Grid.from_bytes(w, h, _unpack_bits(data[pos:pos+size], 2, w*h))
+    pos += size
+    size = (w*h + 7) // 8
+    mask = _unpack_bits(data[pos:pos+size], 1, w*h)
+    pos += size
+    pellets = [(i % w, i // w) for i in range(w*h) if mask[i]]
+    spawns = array('H')
+    spawns.frombytes(data[pos:pos + 4*n_spawns])
+    pos += 4*n_spawns
+    tables = None
+    if nav_len:
+        raw = zlib.decompress(data[pos:pos+nav_len])
+        dist = array('H')
+        dist.frombytes(raw[:len(raw) * 2 // 3])
+        tables = (dist, bytearray(raw[len(raw) * 2 // 3:]))
+    spawn_points = [(spawns[k], spawns[k+1]) for k in range(0, len(spawns), 2)]
+    level = Level(w, h, seed, grid, (gx, gy), spawn_points, pellets,
+                  NavTable(grid, max_cells=nav_cells, tables=tables, defer=defer))
+    level.nav.build_full_async(on_ready and (lambda: on_ready(level)))
+    return level
+
+class LevelPool:
+    """
+    Джерело рівнів для Game.reset(): рівень береться з пулу вже готових (генерує
+    фоновий потік), інакше з дискового кешу, і лише в крайньому разі генерується одразу.
+    Фоновий потік ділить GIL з головним, але головний цикл більшість кадру чекає
+    в clock.tick(), тож генерація встигає між кадрами, а не під час натискання R.
+    Таблиця маршрутів — до nav_cells клітинок; з defer=True рівень, якого ще немає в
+    пулі, віддається одразу, а його повна таблиця добудовується у фоні.
+    """
+
+    def __init__(self, w, h, cache_dir=LEVEL_CACHE_DIR, background=True, cache_max=LEVEL_CACHE_MAX,
+                 nav_cells=NAV_TABLE_MAX_CELLS, defer=False):
+        self.w, self.h = w, h
+        self.nav_cells, self.defer = nav_cells, defer
+        self.cache_dir = cache_dir or None
+        self.cache_max = cache_max
+        self.background = background
+        self._ready = {}        # сід -> Level
+        self._wanted = deque()  # сіди, які ще треба підготувати (перший — у роботі)
+        self._cond = threading.Condition()
+        self._thread = None
+        self.hits = self.disk_hits = self.misses = 0
+
+    def _path(self, seed):
+        return os.path.join(self.cache_dir, f"{self.w}x{self.h}_{seed}.lvl")
+
+    def cached_seeds(self):
+        """Сіди рівнів цього розміру, що вже лежать у кеші."""
+        if self.cache_dir is None or not os.path.isdir(self.cache_dir):
+            return []
+        prefix = f"{self.w}x{self.h}_"
+        seeds = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix) and name.endswith('.lvl'):
+                try:
+                    seeds.append(int(name[len(prefix):-4]))
+                except ValueError:
+                    pass  # чужий файл у каталозі кешу
+        return seeds
+
+    def _load_or_build(self, seed, defer=False):
+        """(рівень, чи з диска). defer — повну таблицю маршрутів добудувати у фоні."""
+        # таблицю, добудовану у фоні, теж кладемо в кеш
+        on_ready = self._save if self.cache_dir is not None else None
+        if self.cache_dir is not None:
+            try:
+                level = load_level(self._path(seed), self.nav_cells, defer, on_ready)
+                if level is not None:
+                    return level, True
+            except (OSError, ValueError, struct.error, zlib.error):
+                pass  # немає в кеші або файл пошкоджений — згенеруємо заново
+        level = build_level(self.w, self.h, seed, self.nav_cells, defer, on_ready)
+        self._save(level)
+        return level, False
+
+    def _save(self, level):
+        if self.cache_dir is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            save_level(level, self._path(level.seed))
+            self._trim_cache()
+        except OSError as e:
+            print(f"Кеш рівнів недоступний: {e}")
+            self.cache_dir = None
+
+    def _trim_cache(self):
+        """Лишити в кеші не більше cache_max найсвіжіших файлів цього розміру."""
+        paths = [self._path(s) for s in self.cached_seeds()]
+        if len(paths) <= self.cache_max:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.cache_max]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def prefetch(self, seeds):
+        """Попросити фоновий потік підготувати рівні з цими сідами."""
+        if not self.background:
+            return
+        with self._cond:
+            for seed in seeds:
+                if seed not in self._ready and seed not in self._wanted:
+                    self._wanted.append(seed)
+            self._cond.notify()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker, name="level-pool", daemon=True)
+            self._thread.start()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._wanted:
+                    self._cond.wait()
+                seed = self._wanted[0]
+            level, _ = self._load_or_build(seed)
+            with self._cond:
+                self._ready[seed] = level
+                self._wanted.popleft()
+                self._cond.notify_all()
+
+    def get(self, seed):
+        """Рівень із сідом seed (дочекається фонового потоку, якщо той саме його будує)."""
+        with self._cond:
+            if seed in self._wanted and self._wanted[0] != seed:
+                self._wanted.remove(seed)  # ще не почато — зробимо самі
+            while self._wanted and self._wanted[0] == seed:
+                self._cond.wait()
+            level = self._ready.pop(seed, None)
+        if level is not None:
+            self.hits += 1
+            return level
+        level, from_disk = self._load_or_build(seed, self.defer)
+        if from_disk:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+        return level
+
+class FixedLevel:
+    """Джерело рівнів замість LevelPool: кожен reset() отримує той самий готовий рівень."""
+
+    def __init__(self, level):
+        self.level = level
+        self.hits = self.disk_hits = self.misses = 0
+
+    def cached_seeds(self):
+        return []
+
+    def prefetch(self, seeds):
+        pass
+
+    def get(self, seed):
+        self.hits += 1
+        return self.level
+
+# =====================
+# Спільна пам'ять: один рівень на всі процеси
+# =====================
+SHARED_MAGIC = b'PMSH'
+SHARED_VERSION = 1
+# magic, версія, ширина, висота, сід, брама x, y, кількість спавнів, клітинок у таблиці маршрутів (0 — без неї)
+_SHARED_HEADER = struct.Struct('<4sBHHQHHHI')
+
+def _align8(n):
+    return (n + 7) & ~7
+
+class SharedLevel:
+    """
+    Готовий рівень, опублікований один раз у multiprocessing.shared_memory: клітинки
+    сітки (разом з рамкою, як у Grid.cells), маска пелет, спавни, брама і повна таблиця
+    маршрутів dist/hop. Воркери під'єднуються за name через attach_level() і читають
+    ці байти без копій, тож пам'ять під лабіринт і таблицю не множиться на кількість
+    процесів. Таблиця будується тут, якщо прохідних клітинок не більше nav_cells
+    (може бути більше за NAV_TABLE_MAX_CELLS: її все одно тримає лише один сегмент).
+    Сегмент живе, доки власник не викличе close().
+    """
+
+    def __init__(self, level, nav_cells=NAV_TABLE_MAX_CELLS):
+        nav = level.nav
+        if not nav.full and nav.n <= nav_cells:
+            nav = NavTable(level.grid, max_cells=nav.n, junctions=False)
+        n = nav.n if nav.full else 0
+        grid = level.grid
+        spawns = array('H', [c for pos in level.spawn_points for c in pos])
+        mask = bytearray(level.w * level.h)
+        for x, y in level.pellets:
+            mask[y*level.w + x] = 1
+        parts = [grid.cells, mask, spawns.tobytes()]
+        if n:
+            parts += [nav.dist.tobytes(), nav.hop]
+        header = _SHARED_HEADER.pack(SHARED_MAGIC, SHARED_VERSION, level.w, level.h, level.seed,
+                                     *level.gate_pos, len(level.spawn_points), n)
+        size = _align8(len(header)) + sum(_align8(len(part)) for part in parts)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.name = self.shm.name
+        self.nbytes = size
+        buf = self.shm.buf
+        buf[:len(header)] = header
+        pos = _align8(len(header))
+        for part in parts:
+            buf[pos:pos + len(part)] = part
+            pos += _align8(len(part))
+        del buf  # інакше close() не зможе звільнити сегмент
+
+    def close(self):
+        """Закрити й знищити сегмент (воркери, що вже під'єдналися, дочитують свої копії відображення)."""
+        detach_level(self.name)  # під'єднання в цьому ж процесі, якщо було
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+_ATTACHED = {}  # ім'я сегмента -> (SharedMemory, Level, memoryview рівня): одне під'єднання на процес
+
+def attach_level(name):
+    """
+    Рівень із сегмента SharedLevel. Grid.cells і таблиця маршрутів — memoryview лише
+    для читання прямо в спільну пам'ять; у процесі будуються тільки маленькі похідні
+    структури (сусіди клітинок, список пелет). Повторний виклик повертає той самий рівень.
+    Під'єднання живе до detach_level(name) або до завершення процесу (зокрема воркера
+    пулу процесів): тоді detach_level викликається сам.
+    """
+    if name in _ATTACHED:
+        return _ATTACHED[name][1]
+    shm = shared_memory.SharedMemory(name=name)
+    buf = shm.buf.toreadonly()
+    magic, version, w, h, seed, gx, gy, n_spawns, n = _SHARED_HEADER.unpack_from(buf)
+    if magic != SHARED_MAGIC or version != SHARED_VERSION:
+        buf.release()
+        shm.close()
+        raise ValueError(f"{name}: не сегмент рівня Pacman або інша версія")
+    pos = _align8(_SHARED_HEADER.size)
+
+    def take(size):
+        nonlocal pos
+        part = buf[pos:pos + size]
+        pos += _align8(size)
+        return part
+
+    grid = Grid.__new__(Grid)
+    grid.w, grid.h, grid.stride = w, h, w + 2
+    grid.offsets = (-1, 1, -grid.stride, grid.stride)
+    grid.cells = take(grid.stride * (h + 2))
+    mask = take(w * h)
+    spawns = take(4 * n_spawns).cast('H')
+    tables = (take(2 * n * n).cast('H'), take(n * n)) if n else None
+    pellets = [(i % w, i // w) for i in range(w*h) if mask[i]]
+    spawn_points = [(spawns[k], spawns[k+1]) for k in range(0, len(spawns), 2)]
+    level = Level(w, h, seed, grid, (gx, gy), spawn_points, pellets, NavTable(grid, tables=tables))
+    for view in (buf, mask, spawns):
+        view.release()
+    _ATTACHED[name] = (shm, level, (grid.cells,) + (tables or ()))
+    # SharedMemory.__del__ на виході з процесу не закриє сегмент, поки живі memoryview рівня
+    mp_util.Finalize(None, detach_level, args=(name,), exitpriority=0)
+    return level
+
+def detach_level(name):
+    """
+    Від'єднатися від сегмента attach_level(name): відпустити memoryview рівня (клітинки,
+    таблицю маршрутів), а тоді закрити відображення. Рівнем після цього користуватися не можна.
+    Якщо під'єднання немає — нічого не робить.
+    """
+    entry = _ATTACHED.pop(name, None)
+    if entry is None:
+        return
+    shm, level, views = entry
+    for view in views:
+        view.release()
+    shm.close()
 
 # =====================
 # Ігрові сутності + плавність
 # =====================
 class Pacman:
+    # __slots__: без __dict__ на кожен об'єкт — менше пам'яті й швидший доступ до полів
+    __slots__ = ('grid', 'x', 'y', 'color', 'score', 'alive', 'desired_dir', 'held_dir',
+                 'last_dir', 'single_step_queue', 'render_from', 'render_to', 'move_t')
+
     def __init__(self, grid, start):
         self.grid = grid
         self.x, self.y = start             
@@ -283,11 +1532,8 @@ class Pacman:
             self.held_dir = (0,0)
 
     def can_move(self, d):
-        nx, ny = self.x + d[0], self.y + d[1]
-        if not in_bounds(nx, ny):
-            return False
-        cell = self.grid[ny][nx]
-        return cell in (FLOOR, GATE, PEN)
+        # рамка сітки — стіни, тож перевірка меж не потрібна
+        return self.grid.get(self.x + d[0], self.y + d[1]) in (FLOOR, GATE, PEN)
 
     def step(self):
         chosen = None
@@ -329,178 +1575,1679 @@ class Pacman:
         ry = (fy*(1-t) + ty*t) * TILE + TILE//2
         return int(rx), int(ry)
 
-class Ghost:
-    def __init__(self, grid, start, color):
-        self.grid = grid
-        self.x, self.y = start
-        self.color = color
-        self.role = None  # Роль буде призначена в класі Game
-        self.dir = random.choice(DIR_LIST)
-        self.memory_seen = None
+ROLES = ('CHASER', 'AMBUSHER')
+CHASER, AMBUSHER = 0, 1
+# Параметри поведінки привидів (спільні з vecenv.py): засідка — на скільки клітинок уперед
+# від Пакмена, патруль — коли Пакмен далі за PATROL_RADIUS і зі зсувами PATROL_OFFSETS по осях,
+# кулдаун обміну ролями на рівні 5
+AMBUSH_AHEAD = 4
+PATROL_RADIUS = 7
+PATROL_OFFSETS = (-4, -3, -2, 2, 3, 4)
+ROLE_SWAP_COOLDOWN_MS = 3000
+STAND = len(DIR_LIST)           # індекс «без руху» у масиві напрямків
+STEPS = DIR_LIST + [(0, 0)]     # індекс напрямку -> (dx, dy)
+STEP_INDEX = {d: k for k, d in enumerate(STEPS)}
+
+class GhostSwarm:
+    """
+    Усі привиди гри у вигляді структури масивів: координати, напрямки, ролі й колір
+    кожного привида лежать в окремих пакованих масивах, тож привидів можуть бути тисячі.
+    Усі привиди крокують на одному тіку, тому прогрес анімації move_t спільний
+    (у привида, що не рушив, render_from == render_to, і t на нього не впливає),
+    а інтерполяція позицій для малювання рахується для всіх разом.
+    occupancy — просторовий хеш «плоский індекс клітинки -> кількість привидів у ній»
+    для перевірки зіткнень і запитів «хто в цій клітинці» за O(1).
+    """
 
-        # Плавність
-        self.render_from = (self.x, self.y)
-        self.render_to = (self.x, self.y)
+    def __init__(self, grid, starts, nav=None, rng=random):
+        self.grid = grid
+        self.nav = nav  # NavTable лабіринту (якщо є — шляхи беруться з таблиці)
+        self.rng = rng  # генератор випадковості для патруля
+        n = self.n = len(starts)
+        self.x = array('i', [p[0] for p in starts])
+        self.y = array('i', [p[1] for p in starts])
+        # Плавність: звідки привид іде до (x, y)
+        self.fx = array('i', self.x)
+        self.fy = array('i', self.y)
         self.move_t = 1.0
+        self.dir = bytearray(rng.randrange(len(DIR_LIST)) for _ in range(n))
+        self.role = bytearray(n)  # ROLES[role[i]]; ролі призначає Game
+        self.color = bytearray(i % len(GHOST_COLORS) for i in range(n))
+        self.memory_seen = [None] * n
+        self.occupancy = defaultdict(int)
+        for i in range(n):
+            self.occupancy[grid.idx(self.x[i], self.y[i])] += 1
+
+    def __len__(self):
+        return self.n
+
+    def pos(self, i):
+        return (self.x[i], self.y[i])
+
+    def count_at(self, pos):
+        """Скільки привидів у клітинці pos."""
+        return self.occupancy.get(self.grid.idx(*pos), 0)
+
+    def assign_roles(self, difficulty):
+        """Рівні 0–1: усі переслідувачі; 2+: перша половина — переслідувачі, решта — засідники."""
+        half = self.n if difficulty <= 1 else self.n // 2
+        self.role[:half] = bytes([CHASER]) * half
+        self.role[half:] = bytes([AMBUSHER]) * (self.n - half)
+
+    def begin_tick(self):
+        """Поточні клітинки стають початком анімації (tick() викликає це сам)."""
+        self.fx[:] = self.x
+        self.fy[:] = self.y
+        self.move_t = 0.0
+
+    def tick_anim(self, dt_ms):
+        self.move_t = min(1.0, self.move_t + (dt_ms / GHOST_STEP_MS))
 
-    def step_ai(self, difficulty_level, pac_pos, pac_dir, all_pellets):
-        """Головний метод ШІ, що керує поведінкою привида."""
+    def render_positions(self):
+        """Піксельні центри всіх привидів (лерп між from/to зі спільним t)."""
+        t = self.move_t
+        s = 1 - t
+        half = TILE // 2
+        return [(int((fx*s + tx*t) * TILE + half), int((fy*s + ty*t) * TILE + half))
+                for fx, fy, tx, ty in zip(self.fx, self.fy, self.x, self.y)]
+
+    def advance(self, order_rng, difficulty_level, pac_pos, pac_dir, all_pellets, pac_field=None, sight=None):
+        """Повний тік привидів: випадковий порядок ходів і крок кожного активного привида."""
+        order = list(range(self.n))
+        order_rng.shuffle(order)
+        # --- Рівень 0: Активний лише один привид ---
+        if difficulty_level == 0:
+            order = [0] if self.n else []
+        self.tick(order, difficulty_level, pac_pos, pac_dir, all_pellets, pac_field, sight)
+
+    def restore(self, x, y, dirs, role, memory=None):
+        """Поставити привидів у збережений стан (перемотування); анімацію завершено."""
+        self.x, self.y = array('i', x), array('i', y)
+        self.fx, self.fy = array('i', x), array('i', y)
+        self.move_t = 1.0
+        self.dir, self.role = bytearray(dirs), bytearray(role)
+        self.memory_seen = list(memory) if memory is not None else [None] * self.n
+        self.occupancy = defaultdict(int)
+        for i in range(self.n):
+            self.occupancy[self.grid.idx(self.x[i], self.y[i])] += 1
+
+    def clone(self):
+        """Копія стану (масиви, хеш, генератор патруля) — задній буфер для GhostPlanner."""
+        c = GhostSwarm.__new__(GhostSwarm)
+        c.grid, c.nav, c.n, c.move_t = self.grid, self.nav, self.n, self.move_t
+        c.rng = random.Random()
+        c.rng.setstate(self.rng.getstate())
+        c.x, c.y, c.fx, c.fy = array('i', self.x), array('i', self.y), array('i', self.fx), array('i', self.fy)
+        c.dir, c.role, c.color = bytearray(self.dir), bytearray(self.role), self.color
+        c.memory_seen = self.memory_seen[:]
+        c.occupancy = self.occupancy.copy()
+        return c
+
+    def adopt(self, other):
+        """Зробити стан other (порахований наперед клон) поточним: лише обмін посиланнями."""
+        self.x, self.y, self.fx, self.fy = other.x, other.y, other.fx, other.fy
+        self.dir, self.memory_seen, self.occupancy = other.dir, other.memory_seen, other.occupancy
+        self.move_t = other.move_t
+        self.rng.setstate(other.rng.getstate())
+
+    def tick(self, order, difficulty_level, pac_pos, pac_dir, all_pellets, pac_field=None, sight=None):
+        """
+        Один тік ШІ для привидів з order (у цьому порядку). Найчастіший випадок —
+        звичайне переслідування по спільній DistanceField — пораховано прямо в циклі
+        на локальних змінних; решта (засідка, патруль, зір, застрягання) іде через step_ai.
+        """
+        self.begin_tick()
+        step_ai = self.step_ai
+        if pac_field is None or sight is not None:
+            for i in order:
+                step_ai(i, difficulty_level, pac_pos, pac_dir, all_pellets, pac_field, sight)
+            return
+        xs, ys, roles, dirs, occ = self.x, self.y, self.role, self.dir, self.occupancy
+        nav = pac_field.nav
+        compact, adj = nav.compact, nav.adj
+        stored, offset = pac_field.stored, pac_field.offset
+        far = pac_field._FAR // 2
+        stride = self.grid.stride
+        offsets = self.grid.offsets
+        ambush = difficulty_level >= 2
+        patrol_radius = PATROL_RADIUS if difficulty_level >= 3 else None
+        for i in order:
+            x, y = xs[i], ys[i]
+            k = (y+1)*stride + x + 1
+            v = compact[k]
+            if v < 0 or (ambush and roles[i] == AMBUSHER):
+                step_ai(i, difficulty_level, pac_pos, pac_dir, all_pellets, pac_field, sight)
+                continue
+            sv = stored[v]
+            if sv >= far or sv + offset == 0 or (patrol_radius is not None and sv + offset > patrol_radius):
+                step_ai(i, difficulty_level, pac_pos, pac_dir, all_pellets, pac_field, sight)
+                continue
+            # Переслідувач: крок униз по градієнту (перший у порядку DIR_LIST)
+            for d, u in adj[v]:
+                if stored[u] == sv - 1:
+                    break
+            dx, dy = DIR_LIST[d]
+            dirs[i] = d
+            occ[k] -= 1
+            if not occ[k]:
+                del occ[k]
+            xs[i] = x + dx
+            ys[i] = y + dy
+            occ[k + offsets[d]] += 1
+
+    def distance_to(self, i, pos):
+        """Відстань від привида i до pos: лабіринтом, якщо є таблиця маршрутів, інакше манхеттенська."""
+        if self.nav is not None:
+            return self.nav.distance(self.pos(i), pos)
+        return manhattan(self.pos(i), pos)
+
+    def step_ai(self, i, difficulty_level, pac_pos, pac_dir, all_pellets, pac_field=None, sight=None):
+        """
+        Головний метод ШІ, що керує поведінкою привида i.
+        pac_field — спільна DistanceField від Пакмена (якщо є): відстані до Пакмена
+        й крок переслідування беруться з неї, а не рахуються окремо для кожного привида.
+        sight — VisibilityIndex для режиму зору (None — привид завжди знає, де Пакмен).
+        """
+        x, y = self.x[i], self.y[i]
+        pos = (x, y)
+        role = self.role[i]
         target = pac_pos  # Ціль за замовчуванням - Пакмен
+        w, h = self.grid.w, self.grid.h
+        if pac_field is not None:
+            pac_dist = pac_field.distance(pos)
+        else:
+            pac_dist = self.distance_to(i, pac_pos)
 
         # --- Рівень 2+: Логіка для випередження (Ambush) ---
-        if difficulty_level >= 2 and self.role == 'AMBUSHER':
-            # Цілимось на 4 клітинки вперед від Пакмена
-            ax = pac_pos[0] + pac_dir[0] * 4
-            ay = pac_pos[1] + pac_dir[1] * 4
-            # Обмежуємо ціль межами карти
-            ax = max(1, min(GRID_W - 2, ax))
-            ay = max(1, min(GRID_H - 2, ay))
+        if difficulty_level >= 2 and role == AMBUSHER:
+            if pac_field is not None:
+                # Цілимось на AMBUSH_AHEAD клітинок вперед від Пакмена, але лише прохідними
+                # клітинками по прямій — ціль завжди досяжна, а не в стіні
+                ax, ay = pac_pos
+                for _ in range(AMBUSH_AHEAD):
+                    nx, ny = ax + pac_dir[0], ay + pac_dir[1]
+                    if pac_field.distance((nx, ny)) == NAV_UNREACHABLE:
+                        break
+                    ax, ay = nx, ny
+            else:
+                # Цілимось на AMBUSH_AHEAD клітинок вперед від Пакмена
+                ax = pac_pos[0] + pac_dir[0] * AMBUSH_AHEAD
+                ay = pac_pos[1] + pac_dir[1] * AMBUSH_AHEAD
+                # Обмежуємо ціль межами карти
+                ax = max(1, min(w - 2, ax))
+                ay = max(1, min(h - 2, ay))
             target = (ax, ay)
 
-        # --- Рівень 3+: Логіка патрулювання для "CHASER" ---
+        # --- Рівень 3+: патруль для "CHASER", рівень 4+: і для "AMBUSHER" ---
+        # (якщо Пакмен далеко, дистанція > PATROL_RADIUS)
         is_patrolling = False
-        if difficulty_level >= 3 and self.role == 'CHASER':
-            # Якщо Пакмен далеко (дистанція > 7), переходимо в патруль
-            if manhattan(self.pos, pac_pos) > 7:
+        if pac_dist > PATROL_RADIUS:
+            if difficulty_level >= 3 and role == CHASER:
                 is_patrolling = True
-
-        # --- Рівень 4+: Логіка патрулювання для "AMBUSHER" ---
-        if difficulty_level >= 4 and self.role == 'AMBUSHER':
-            if manhattan(self.pos, pac_pos) > 7:
+            if difficulty_level >= 4 and role == AMBUSHER:
                 is_patrolling = True
 
+        # --- Режим зору: переслідуємо місце, де востаннє бачили Пакмена ---
+        if sight is not None:
+            memory = self.memory_seen[i]
+            if sight.visible(pos, pac_pos):
+                memory = pac_pos
+            elif memory == pos:
+                memory = None  # дійшли туди, а Пакмена не видно — слід загублено
+            self.memory_seen[i] = memory
+            is_patrolling = memory is None
+            if memory is not None and memory != pac_pos:
+                target = memory
+
         # --- Визначення цілі для патрулювання ---
         if is_patrolling:
             # Рівень 4+: патрулюємо по клітинках з пелетами
             if difficulty_level >= 4 and all_pellets:
-                target = random.choice(list(all_pellets))
+                target = all_pellets.sample(self.rng)
             # Рівень 3: просто випадковий рух по мапі
             else:
-                lx = max(1, min(GRID_W - 2, self.x + random.choice([-4, -3, -2, 2, 3, 4])))
-                ly = max(1, min(GRID_H - 2, self.y + random.choice([-4, -3, -2, 2, 3, 4])))
+                lx = max(1, min(w - 2, x + self.rng.choice(PATROL_OFFSETS)))
+                ly = max(1, min(h - 2, y + self.rng.choice(PATROL_OFFSETS)))
                 target = (lx, ly)
 
         # --- Вибір наступного кроку до цілі ---
-        step = find_path_step_bfs(self.grid, self.pos, target)
-        
+        if pac_field is not None and target == pac_pos:
+            step = pac_field.step(pos)  # спуск по спільному градієнту
+        elif self.nav is not None:
+            step = self.nav.step(pos, target)
+        else:
+            step = find_path_step_bfs(self.grid, pos, target)
+
         # Якщо застрягли, робимо будь-який можливий хід
         if step == (0, 0):
             valid = []
-            for dx, dy in DIR_LIST:
-                nx, ny = self.x + dx, self.y + dy
-                if in_bounds(nx, ny) and self.grid[ny][nx] != WALL:
-                    valid.append((dx, dy))
+            k = self.grid.idx(x, y)
+            for d, off in zip(DIR_LIST, self.grid.offsets):
+                if self.grid.cells[k + off] != WALL:
+                    valid.append(d)
             if valid:
-                step = random.choice(valid)
+                step = self.rng.choice(valid)
+
+        self.dir[i] = STEP_INDEX[step]
+        if step != (0, 0):
+            occ = self.occupancy
+            k = self.grid.idx(x, y)
+            occ[k] -= 1
+            if not occ[k]:
+                del occ[k]
+            self.x[i] = x + step[0]
+            self.y[i] = y + step[1]
+            occ[self.grid.idx(x + step[0], y + step[1])] += 1
+
+class GhostPlanner:
+    """
+    Рахує наступний тік привидів наперед у фоновому потоці. На знімку стану
+    (клон GhostSwarm, копії поля відстаней, пелет і генератора порядку) потік робить
+    той самий advance(), що й головний цикл, у задній буфер. На межі тіку гра
+    порівнює ключ знімка з поточним станом: збіг — результат просто приймається
+    (adopt), інакше (Пакмен устиг рушити, змінилися ролі тощо) тік рахується як
+    звичайно. Тож результат завжди той самий, що й без потоку.
+    Знімок, який застарів ще до тіку (крок Пакмена, reset, перемотування), гра
+    скасовує одразу (cancel): ще не розпочатий розрахунок не запуститься взагалі,
+    а вже розпочатий дорахує, але місце під новий знімок звільняється негайно.
+    tick_ms — скільки тривав останній тік (тут чи в потоці); поки він дешевший за
+    min_tick_ms, наперед нічого не рахується.
+    """
 
-        self.dir = step
+    def __init__(self, min_tick_ms=GHOST_AI_MIN_TICK_MS):
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ghost-ai')
+        self.min_tick_ms = min_tick_ms
+        self.tick_ms = 0.0
+        self.key = None
+        self.future = None
+        self.planned = self.hits = 0
+        self.stale = 0  # знімків, відкинутих як застарілі
+
+    def worth_planning(self):
+        return self.future is None and self.tick_ms >= self.min_tick_ms
+
+    @staticmethod
+    def _run(back, order_rng, args):
+        t0 = time.perf_counter()
+        back.advance(order_rng, *args)
+        return back, order_rng, (time.perf_counter() - t0) * 1000
+
+    def plan(self, key, swarm, order_rng, difficulty, pac_pos, pac_dir, pellets, pac_field, sight):
+        """Почати рахувати тік для стану з ключем key."""
+        rng = random.Random()
+        rng.setstate(order_rng.getstate())
+        args = (difficulty, pac_pos, pac_dir, pellets.snapshot(), pac_field.snapshot(), sight)
+        self.key = key
+        self.future = self.pool.submit(self._run, swarm.clone(), rng, args)
+        self.planned += 1
+
+    def cancel(self):
+        """Відкинути поточний знімок (він уже не відповідає стану гри)."""
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+            self.stale += 1
+
+    def take(self, key):
+        """(задній буфер, генератор порядку) для тіку з ключем key або None, якщо знімка немає чи він застарів."""
+        if self.future is None:
+            return None
+        if key != self.key:
+            self.cancel()
+            return None
+        future, self.future = self.future, None
+        self.hits += 1
+        back, order_rng, self.tick_ms = future.result()
+        return back, order_rng
+
+    def advance(self, swarm, order_rng, *args):
+        """Тік на місці (знімка немає чи він застарів) із заміром тривалості."""
+        t0 = time.perf_counter()
+        swarm.advance(order_rng, *args)
+        self.tick_ms = (time.perf_counter() - t0) * 1000
 
-        # для анімації:
-        self.render_from = (self.x, self.y)
-        self.x += step[0]
-        self.y += step[1]
-        self.render_to = (self.x, self.y)
-        self.move_t = 0.0
+class Ghost:
+    """
+    Один привид як вид на рядок GhostSwarm: зручний доступ g.pos, g.role, g.dir...
+    для коду поза гарячими циклами (хеш стану, налагодження).
+    """
+    __slots__ = ('swarm', 'i')
 
-    def tick_anim(self, dt_ms):
-        self.move_t = min(1.0, self.move_t + (dt_ms / GHOST_STEP_MS))
+    def __init__(self, swarm, i):
+        self.swarm = swarm
+        self.i = i
 
     @property
     def pos(self):
-        return (self.x, self.y)
+        return self.swarm.pos(self.i)
+
+    @property
+    def x(self):
+        return self.swarm.x[self.i]
+
+    @property
+    def y(self):
+        return self.swarm.y[self.i]
+
+    @property
+    def dir(self):
+        return STEPS[self.swarm.dir[self.i]]
+
+    @property
+    def role(self):
+        return ROLES[self.swarm.role[self.i]]
+
+    @role.setter
+    def role(self, value):
+        self.swarm.role[self.i] = ROLES.index(value)
+
+    @property
+    def color(self):
+        return GHOST_COLORS[self.swarm.color[self.i]]
+
+    @property
+    def memory_seen(self):
+        return self.swarm.memory_seen[self.i]
+
+    def distance_to(self, pos):
+        return self.swarm.distance_to(self.i, pos)
 
     def render_pos_px(self):
-        fx, fy = self.render_from
-        tx, ty = self.render_to
-        t = self.move_t
-        rx = (fx*(1-t) + tx*t) * TILE + TILE//2
-        ry = (fy*(1-t) + ty*t) * TILE + TILE//2
+        s = self.swarm
+        t = s.move_t
+        rx = (s.fx[self.i]*(1-t) + s.x[self.i]*t) * TILE + TILE//2
+        ry = (s.fy[self.i]*(1-t) + s.y[self.i]*t) * TILE + TILE//2
         return int(rx), int(ry)
 
+# =====================
+# Детермінізм: потоки випадковості, запис вводу й повтор
+# =====================
+class RngStreams:
+    """
+    Окремий random.Random для кожної підсистеми, усі виведені з одного сіда.
+    Так, наприклад, зміна кількості викликів у патрулі не зсуває генерацію лабіринту.
+    """
+    NAMES = ('maze', 'spawn', 'order', 'patrol', 'policy')
+
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = random.randrange(2**63)
+        self.seed = seed
+        for name in self.NAMES:
+            setattr(self, name, random.Random(f"{seed}:{name}"))
+
+# Клавіші, що впливають на стан гри (лише їх і записуємо)
+RECORDED_KEYS = set(DIRS) | set(DIFFICULTY_KEYS) | {pg.K_r, pg.K_ESCAPE, pg.K_BACKSPACE, pg.K_F6}
+
+LOG_MAGIC = b'PMRL'
+LOG_VERSION = 3
+# magic, версія, сід, складність, ширина, висота, кількість привидів, а далі налаштування, від яких
+# залежить сам перебіг гри: PAC_STEP_MS, GHOST_STEP_MS, GHOST_SIGHT, MAX_CATCHUP_STEPS,
+# INPUT_LOWLAT, INPUT_GRACE_MS
+_LOG_HEADER = struct.Struct('<4sBQBHHHHHBBBH')
+
+def _log_settings():
+    return PAC_STEP_MS, GHOST_STEP_MS, GHOST_SIGHT, MAX_CATCHUP_STEPS, INPUT_LOWLAT, INPUT_GRACE_MS
+_LOG_EVENT = struct.Struct('<IBI')  # кадр, тип (0 — KEYDOWN, 1 — KEYUP), клавіша
+
+class InputRecorder:
+    """
+    Компактний бінарний журнал гри: сід і налаштування в заголовку, dt кожного кадру
+    (uint16, стиснуті zlib) і події клавіатури з номером кадру, а в кінці — хеш
+    фінального стану для перевірки повтору.
+    """
+
+    def __init__(self, game):
+        self.seed = game.rng.seed
+        self.difficulty = game.difficulty
+        self.size = (game.grid_w, game.grid_h)
+        self.ghost_count = game.ghost_count
+        self.policy = policy_name(game.policy)
+        self.dts = array('H')
+        self.events = []
+
+    def frame(self, dt):
+        """Початок кадру з кроком dt (мс, ціле)."""
+        self.dts.append(min(int(dt), 0xFFFF))
+
+    def event(self, e, after_update=False):
+        # подія, опитана після update(), діє так само, як на початку наступного кадру
+        if e.type in (pg.KEYDOWN, pg.KEYUP) and e.key in RECORDED_KEYS:
+            frame = len(self.dts) - 1 + after_update
+            self.events.append((frame, 0 if e.type == pg.KEYDOWN else 1, e.key))
+
+    def save(self, path, final_hash):
+        dt_blob = zlib.compress(self.dts.tobytes(), 9)
+        ev_blob = zlib.compress(b''.join(_LOG_EVENT.pack(*ev) for ev in self.events), 9)
+        policy = self.policy.encode()
+        with open(path, 'wb') as f:
+            f.write(_LOG_HEADER.pack(LOG_MAGIC, LOG_VERSION, self.seed, self.difficulty,
+                                     self.size[0], self.size[1], self.ghost_count, *_log_settings()))
+            f.write(struct.pack('<B', len(policy)) + policy)
+            f.write(struct.pack('<II', len(self.dts), len(dt_blob)) + dt_blob)
+            f.write(struct.pack('<II', len(self.events), len(ev_blob)) + ev_blob)
+            f.write(final_hash)
+
+def load_log(path):
+    """Прочитати журнал, записаний InputRecorder.save()."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, seed, difficulty, w, h, ghosts, *settings = _LOG_HEADER.unpack_from(data)
+    if magic != LOG_MAGIC or version != LOG_VERSION:
+        raise ValueError(f"{path}: це не журнал гри (або невідома версія)")
+    if tuple(settings) != _log_settings():
+        raise ValueError(f"{path}: записано з іншими PAC_STEP_MS/GHOST_STEP_MS/GHOST_SIGHT/"
+                         f"MAX_CATCHUP_STEPS/INPUT_LOWLAT/INPUT_GRACE_MS")
+    pos = _LOG_HEADER.size
+    n = data[pos]
+    policy = data[pos+1:pos+1+n].decode()
+    pos += 1 + n
+    n_frames, size = struct.unpack_from('<II', data, pos)
+    pos += 8
+    dts = array('H')
+    dts.frombytes(zlib.decompress(data[pos:pos+size]))
+    pos += size
+    n_events, size = struct.unpack_from('<II', data, pos)
+    pos += 8
+    raw = zlib.decompress(data[pos:pos+size])
+    events = [_LOG_EVENT.unpack_from(raw, k * _LOG_EVENT.size) for k in range(n_events)]
+    pos += size
+    return {
+        'seed': seed, 'difficulty': difficulty, 'size': (w, h), 'ghost_count': ghosts, 'policy': policy,
+        'dts': dts, 'events': events, 'final_hash': data[pos:pos+32],
+    }
+
+def replay(path, on_frame=None):
+    """
+    Повтор журналу без рендеру й без обмеження кадрів — так швидко, як дозволяє CPU.
+    on_frame(game) викликається після кожного кадру; тоді гра створюється з рендером
+    (для запису кадрів без вікна потрібен SDL_VIDEODRIVER=dummy, див. capture.py).
+    Повертає словник: гра, кадри, симульовані мс, секунди реального часу, чи збігся хеш.
+    """
+    log = load_log(path)
+    w, h = log['size']
+    game = Game(headless=on_frame is None, policy=POLICIES.get(log['policy']), grid_w=w, grid_h=h,
+                difficulty=log['difficulty'], seed=log['seed'], ghost_count=log['ghost_count'])
+    events = log['events']
+    k = 0
+    t0 = time.perf_counter()
+    for frame, dt in enumerate(log['dts']):
+        while k < len(events) and events[k][0] == frame:
+            _, kind, key = events[k]
+            game.handle_event(pg.event.Event(pg.KEYDOWN if kind == 0 else pg.KEYUP, key=key))
+            k += 1
+        game.update(dt)
+        game.elapsed_ms += dt
+        game.frames += 1
+        if on_frame is not None:
+            on_frame(game)
+    # події, опитані вже після update() останнього кадру
+    for _, kind, key in events[k:]:
+        game.handle_event(pg.event.Event(pg.KEYDOWN if kind == 0 else pg.KEYUP, key=key))
+    wall = time.perf_counter() - t0
+    return {
+        'game': game,
+        'frames': len(log['dts']),
+        'sim_ms': sum(log['dts']),
+        'wall_s': wall,
+        'ok': game.state_hash() == log['final_hash'],
+    }
+
+# =====================
+# Перемотування
+# =====================
+
+# Спільна частина кожного знімка: Пакмен (x, y, напрямок), рахунок, прапорці, акумулятори
+# кроків і кулдаун ролей (таймери), лічильники кроків. Прапорці: живий | перемога << 1 |
+# складність << 2 | (таймер k — int) << (5 + k): dt буває і int, і float, а тип важливий для state_hash()
+_REWIND_STATE = struct.Struct('<HHbbIBdddII')
+# Прапорці дельти: привиди рушили (по байту на привида), змінилися ролі
+_RW_GHOSTS, _RW_ROLES = 1, 2
+
+class RewindBuffer:
+    """
+    Кільцевий буфер знімків стану на кожному дискретному кроці (крок Пакмена або тік
+    привидів). Кожні keyframe_every кроків — опорний кадр: повний стан (пелети бітовою
+    маскою, координати, напрямки й ролі привидів), стиснутий zlib. Між ними — дельти:
+    з'їдені пелети, Пакмен, рахунок, таймери, а після тіку привидів — по байту на
+    привида (зсув * 8 + напрямок). Будь-який крок у вікні відновлюється з опорного
+    кадру й не більше ніж keyframe_every дельт. Дельти групи лежать підряд в одному
+    bytearray (плюс масив їхніх кінців), тож накладних витрат на кожен крок майже
+    немає. Коли пам'ять перевищує budget байтів,
+    з початку вікна відкидається найстаріша група «опорний кадр + його дельти».
+    Генератори випадковості не зберігаються: після перемотування гра продовжується з
+    їхнього поточного стану — так само детерміновано, тож повтор журналу збігається.
+    """
+
+    def __init__(self, budget=REWIND_BUDGET, keyframe_every=REWIND_KEYFRAME):
+        self.budget = budget
+        self.keyframe_every = keyframe_every
+        self.groups = deque()  # [номер першого кроку, опорний кадр, дельти підряд, кінці дельт]
+        self.nbytes = 0
+        self.last = -1  # номер останнього записаного кроку
+        self.eaten = []  # пелети, з'їдені після останнього знімка
+        # Привиди на момент останнього знімка (з ним порівнюється наступний)
+        self._ticks = self._x = self._y = self._role = None
+
+    def __len__(self):
+        return self.last - self.groups[0][0] + 1 if self.groups else 0
+
+    def clear(self):
+        self.groups.clear()
+        self.nbytes = 0
+        self.last = -1
+        self.eaten.clear()
+
+    def bytes_per_step(self):
+        """Середня пам'ять на крок у вікні (байти знімків разом із масивом кінців дельт)."""
+        return self.nbytes / len(self) if self.groups else 0.0
+
+    def _remember(self, game):
+        swarm = game.swarm
+        self._ticks = game.ghost_ticks
+        self._x, self._y = array('i', swarm.x), array('i', swarm.y)
+        self._role = bytes(swarm.role)
+
+    @staticmethod
+    def _state(game):
+        pac = game.pac
+        timers = (game.pac_step_acc, game.ghost_step_acc, game.ghost_role_swap_cooldown)
+        flags = pac.alive | (game.win << 1) | (game.difficulty << 2)
+        for k, t in enumerate(timers):
+            flags |= isinstance(t, int) << (5 + k)
+        return _REWIND_STATE.pack(pac.x, pac.y, pac.last_dir[0], pac.last_dir[1], pac.score, flags,
+                                  *timers, game.pac_steps, game.ghost_ticks)
+
+    @staticmethod
+    def _memory(swarm, w):
+        return array('i', [-1 if m is None else m[1]*w + m[0] for m in swarm.memory_seen]).tobytes()
+
+    def _keyframe(self, game):
+        swarm, w = game.swarm, game.grid_w
+        mask = bytearray(w * game.grid_h)
+        for x, y in game.pellets:
+            mask[y*w + x] = 1
+        parts = [self._state(game), _pack_bits(mask, 1),
+                 array('H', swarm.x).tobytes(), array('H', swarm.y).tobytes(),
+                 bytes(swarm.dir), bytes(swarm.role)]
+        if game.sight is not None:
+            parts.append(self._memory(swarm, w))
+        return zlib.compress(b''.join(parts), 1)
+
+    def _delta(self, game):
+        swarm = game.swarm
+        flags = 0
+        parts = [self._state(game), struct.pack('<H', len(self.eaten)),
+                 array('H', [c for pos in self.eaten for c in pos]).tobytes()]
+        if game.ghost_ticks != self._ticks:
+            # між двома знімками не більше одного тіку: кожен привид зсунувся щонайбільше на клітинку
+            flags |= _RW_GHOSTS
+            parts.append(bytes(STEP_INDEX[(x - px, y - py)] * 8 + d
+                               for x, y, px, py, d in zip(swarm.x, swarm.y, self._x, self._y, swarm.dir)))
+            if game.sight is not None:
+                parts.append(self._memory(swarm, game.grid_w))
+        if swarm.role != self._role:
+            flags |= _RW_ROLES
+            parts.append(bytes(swarm.role))
+        return bytes([flags]) + b''.join(parts)
+
+    def record(self, game):
+        """Знімок після кроку Пакмена чи тіку привидів (і одразу після reset())."""
+        self.last += 1
+        if not self.groups or self.last - self.groups[-1][0] >= self.keyframe_every:
+            blob = self._keyframe(game)
+            self.groups.append([self.last, blob, bytearray(), array('I')])
+            self.nbytes += len(blob)
+        else:
+            blob = self._delta(game)
+            _, _, deltas, ends = self.groups[-1]
+            deltas += blob
+            ends.append(len(deltas))
+            self.nbytes += len(blob) + ends.itemsize
+        self.eaten.clear()
+        if game.ghost_ticks != self._ticks or self.last == self.groups[-1][0]:
+            self._remember(game)
+        else:
+            self._role = bytes(game.swarm.role)
+        # Бюджет: відкидаємо найстаріші групи, але поточну лишаємо завжди
+        while self.nbytes > self.budget and len(self.groups) > 1:
+            self._drop(self.groups.popleft())
+
+    def drop_last(self):
+        """Забрати знімок останнього кроку (гра цей крок переробила)."""
+        group = self.groups[-1]
+        _, _, deltas, ends = group
+        if ends:
+            keep = ends[-2] if len(ends) > 1 else 0
+            self.nbytes -= len(deltas) - keep + ends.itemsize
+            del deltas[keep:]
+            ends.pop()
+        elif len(self.groups) > 1:
+            self._drop(self.groups.pop())
+        else:
+            return
+        self.last -= 1
+        self.eaten.clear()
+
+    def _drop(self, group):
+        self.nbytes -= len(group[1]) + len(group[2]) + group[3].itemsize * len(group[3])
+
+    def _decode(self, group, game):
+        """Стан на останньому кроці групи: (стан, маска пелет, x, y, напрямки, ролі, пам'ять)."""
+        w, h, n = game.grid_w, game.grid_h, game.swarm.n
+        data = zlib.decompress(group[1])
+        st = _REWIND_STATE.unpack_from(data)
+        pos = _REWIND_STATE.size
+        size = (w*h + 7) // 8
+        mask = bytearray(_unpack_bits(data[pos:pos+size], 1, w*h))
+        pos += size
+        x, y = array('H'), array('H')
+        x.frombytes(data[pos:pos+2*n])
+        y.frombytes(data[pos+2*n:pos+4*n])
+        pos += 4*n
+        dirs = bytearray(data[pos:pos+n])
+        role = bytearray(data[pos+n:pos+2*n])
+        pos += 2*n
+        memory = array('i', data[pos:pos+4*n]) if game.sight is not None else None
+        deltas = group[2]
+        for start, end in zip(chain((0,), group[3]), group[3]):
+            blob = deltas[start:end]
+            flags = blob[0]
+            st = _REWIND_STATE.unpack_from(blob, 1)
+            pos = 1 + _REWIND_STATE.size
+            (k,) = struct.unpack_from('<H', blob, pos)
+            eaten = array('H', blob[pos+2:pos+2+4*k])
+            pos += 2 + 4*k
+            for j in range(0, 2*k, 2):
+                mask[eaten[j+1]*w + eaten[j]] = 0
+            if flags & _RW_GHOSTS:
+                for i, b in enumerate(blob[pos:pos+n]):
+                    dx, dy = STEPS[b >> 3]
+                    x[i] += dx
+                    y[i] += dy
+                    dirs[i] = b & 7
+                pos += n
+                if memory is not None:
+                    memory = array('i', blob[pos:pos+4*n])
+                    pos += 4*n
+            if flags & _RW_ROLES:
+                role = bytearray(blob[pos:pos+n])
+        return st, mask, x, y, dirs, role, memory
+
+    def restore(self, game, back):
+        """
+        Перемотати гру на back кроків назад (не далі за початок вікна); кроки після
+        цієї точки відкидаються — гра продовжується звідти. Повертає, на скільки перемотано.
+        """
+        if not self.groups:
+            return 0
+        target = max(self.groups[0][0], self.last - back)
+        while self.groups[-1][0] > target:
+            self._drop(self.groups.pop())
+        group = self.groups[-1]
+        k = target - group[0]
+        _, _, deltas, ends = group
+        if k < len(ends):
+            keep = ends[k-1] if k else 0
+            self.nbytes -= len(deltas) - keep + ends.itemsize * (len(ends) - k)
+            del deltas[keep:]
+            del ends[k:]
+        st, mask, x, y, dirs, role, memory = self._decode(group, game)
+        moved, self.last = self.last - target, target
+
+        px, py, dx, dy, score, flags, *timers, pac_steps, ghost_ticks = st
+        timers = [int(t) if flags >> (5 + k) & 1 else t for k, t in enumerate(timers)]
+        w = game.grid_w
+        pac = game.pac
+        pac.x, pac.y, pac.last_dir = px, py, (dx, dy)
+        pac.score, pac.alive = score, bool(flags & 1)
+        pac.render_from = pac.render_to = (px, py)
+        pac.move_t = 1.0
+        pac.single_step_queue.clear()
+        game.win, game.difficulty = bool(flags & 2), flags >> 2 & 7
+        game.pac_step_acc, game.ghost_step_acc, game.ghost_role_swap_cooldown = timers
+        game.pac_steps, game.ghost_ticks = pac_steps, ghost_ticks
+        game.pellets = PelletStore(w, game.grid_h, [(i % w, i // w) for i, v in enumerate(mask) if v])
+        if memory is not None:
+            memory = [None if m < 0 else (m % w, m // w) for m in memory]
+        game.swarm.restore(x, y, dirs, role, memory)
+        game.pac_field.rebuild(pac.pos)
+        self.eaten.clear()
+        self._remember(game)
+        return moved
+
+# =====================
+# Політики керування Пакменом (для безголової симуляції)
+# =====================
+# Політика — це функція policy(game) -> (dx, dy) або None.
+# Вона викликається перед кожним кроком Пакмена; None означає «відпустити клавішу».
+
+def random_policy(game):
+    """Випадкове блукання: тримає напрямок, а на розвилках обирає випадковий (без розвороту)."""
+    pac = game.pac
+    options = [d for d in DIR_LIST if pac.can_move(d)]
+    if not options:
+        return None
+    back = (-pac.last_dir[0], -pac.last_dir[1])
+    forward = [d for d in options if d != back]
+    return game.rng.policy.choice(forward or options)
+
+def greedy_policy(game):
+    """Жадібна політика: перший крок до найближчої пелети (BFS лабіринтом)."""
+    grid, pellets = game.grid, game.pellets
+    cells, offsets = grid.cells, grid.offsets
+    start = grid.idx(*game.pac.pos)
+    q = deque([start])
+    first = {start: None}
+    while q:
+        i = q.popleft()
+        if i != start and grid.xy(i) in pellets:
+            return first[i]
+        step = first[i]
+        for d, off in zip(DIR_LIST, offsets):
+            j = i + off
+            if j not in first and cells[j] != WALL:
+                first[j] = step or d
+                q.append(j)
+    return None
+
+class Autopilot:
+    """
+    Політика-автопілот для довгих прогонів: грає сама й добре, а коштує мало.
+    План — тур по пелетах: BFS від Пакмена до найближчої пелети, від неї — до
+    наступної, і так tour пелет (клітинки з привидами оминаються, пелети на вже
+    прокладеному шляху не рахуються). Кроки плану виконуються без жодного пошуку,
+    доки тур не пройдено, Пакмен не зійшов з плану (клавіші, перемотування, новий
+    рівень) або не з'явилась загроза — привид ближче за danger кроків лабіринтом
+    (BFS від Пакмена з обмеженим радіусом). Тоді багатоджерельний BFS від привидів
+    поблизу дає карту їхніх відстаней, і для кожного сусіднього кроку рахується, як
+    далеко звідти можна втекти клітинками, куди Пакмен встигає раніше за привидів;
+    обирається крок із найдовшою втечею (за рівності — на пелету, прямо). Час
+    кожного виклику міряється окремо (stats()), щоб не плутати його з часом кадру.
+    """
+
+    def __init__(self, tour=AUTOPILOT_TOUR, danger=AUTOPILOT_DANGER):
+        self.tour = tour
+        self.danger = danger
+        self.game = None       # план чинний лише для цієї гри
+        self.generation = None # ... і цього її покоління (reset/перемотування)
+        self.plan = deque()    # кроки плану (індекси DIR_LIST)
+        self.expect = -1       # клітинка, з якої має бути наступний крок плану
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.calls = self.replans = self.evasions = 0
+        self.total_s = 0.0
+        self.recent = array('d', bytes(8 * 1024))  # кільце часів останніх викликів, с
+
+    def stats(self):
+        """Власний час автопілота на крок Пакмена: середній і p99 (мкс), перепланування, ухиляння."""
+        n = min(self.calls, len(self.recent))
+        recent = sorted(self.recent[:n])
+        return {
+            'calls': self.calls,
+            'mean_us': self.total_s / self.calls * 1e6 if self.calls else 0.0,
+            'p99_us': recent[min(n - 1, int(n * 0.99))] * 1e6 if n else 0.0,
+            'replans': self.replans,
+            'evasions': self.evasions,
+        }
+
+    def __call__(self, game):
+        t0 = time.perf_counter()
+        d = self._decide(game)
+        spent = time.perf_counter() - t0
+        self.recent[self.calls % len(self.recent)] = spent
+        self.calls += 1
+        self.total_s += spent
+        return d
+
+    def _decide(self, game):
+        grid = game.grid
+        start = grid.idx(*game.pac.pos)
+        ghosts, threat = self._nearby_ghosts(grid, start, game.swarm.occupancy)
+        if threat:
+            self.plan.clear()
+            self.evasions += 1
+            return self._evade(game, start, ghosts)
+        if (game is not self.game or game.generation != self.generation
+                or start != self.expect or not self.plan):
+            self.game, self.generation = game, game.generation
+            self._replan(game, start)
+            if not self.plan:
+                return None
+        k = self.plan.popleft()
+        self.expect = start + grid.offsets[k]
+        return DIR_LIST[k]
+
+    def _nearby_ghosts(self, grid, start, occ):
+        """
+        Клітинки привидів не далі за 2*danger кроків від start (BFS з обмеженою глибиною)
+        і чи є серед них загроза — привид не далі за danger.
+        """
+        cells, offsets = grid.cells, grid.offsets
+        found = [start] if start in occ else []
+        threat = bool(found)
+        seen = {start}
+        frontier = [start]
+        for depth in range(1, 2 * self.danger + 1):
+            if depth > self.danger and not threat:
+                break  # загрози немає — далі шукати не треба
+            nxt = []
+            for i in frontier:
+                for off in offsets:
+                    j = i + off
+                    if j not in seen and cells[j] != WALL:
+                        seen.add(j)
+                        nxt.append(j)
+                        if j in occ:
+                            found.append(j)
+                            threat = threat or depth <= self.danger
+            frontier = nxt
+        return found, threat
+
+    def _evade(self, game, start, ghosts):
+        """Крок із найдовшою втечею від привидів (багатоджерельний BFS від них + BFS втечі)."""
+        grid, pellets = game.grid, game.pellets
+        cells, offsets = grid.cells, grid.offsets
+        limit = 4 * self.danger
+        gd = dict.fromkeys(ghosts, 0)
+        frontier = list(gd)
+        for d in range(1, limit + 1):
+            nxt = []
+            for i in frontier:
+                for off in offsets:
+                    j = i + off
+                    if j not in gd and cells[j] != WALL:
+                        gd[j] = d
+                        nxt.append(j)
+            frontier = nxt
+        far = limit + 1
+        horizon = 2 * self.danger
+        last = game.pac.last_dir
+        best, best_score = None, None
+        for k, off in enumerate(offsets):
+            v = start + off
+            if cells[v] == WALL or gd.get(v, far) <= 1:
+                continue
+            # Втеча: клітинки, куди Пакмен (крок t) приходить раніше за привидів
+            seen = {start, v}
+            frontier = [v]
+            reach = count = 0
+            for t in range(2, horizon + 1):
+                nxt = []
+                for i in frontier:
+                    for o in offsets:
+                        j = i + o
+                        if j not in seen and cells[j] != WALL and gd.get(j, far) > t:
+                            seen.add(j)
+                            nxt.append(j)
+                if not nxt:
+                    break
+                reach, count = t, count + len(nxt)
+                frontier = nxt
+            score = (reach, count, grid.xy(v) in pellets, DIR_LIST[k] == last)
+            if best_score is None or score > best_score:
+                best, best_score = k, score
+        return None if best is None else DIR_LIST[best]
+
+    def _replan(self, game, start):
+        """Новий тур: до tour найближчих по черзі пелет, оминаючи клітинки з привидами."""
+        grid, pellets = game.grid, game.pellets
+        cells, offsets = grid.cells, grid.offsets
+        occ = game.swarm.occupancy
+        plan = self.plan
+        plan.clear()
+        self.replans += 1
+        taken = set()  # клітинки вже прокладеного шляху
+        src = start
+        for _ in range(self.tour):
+            came = {src: -1}  # клітинка -> напрямок, яким у неї прийшли
+            q = deque([src])
+            found = -1
+            while q:
+                i = q.popleft()
+                if i != src and i not in taken and grid.xy(i) in pellets:
+                    found = i
+                    break
+                for k, off in enumerate(offsets):
+                    j = i + off
+                    if j not in came and cells[j] != WALL and j not in occ:
+                        came[j] = k
+                        q.append(j)
+            if found < 0:
+                break
+            leg = []
+            i = found
+            while i != src:
+                k = came[i]
+                leg.append(k)
+                taken.add(i)
+                i -= offsets[k]
+            plan.extend(reversed(leg))
+            src = found
+        self.expect = start
+
+autopilot_policy = Autopilot()
+
+POLICIES = {
+    'random': random_policy,
+    'greedy': greedy_policy,
+    'autopilot': autopilot_policy,
+}
+
+def policy_name(policy):
+    """Ім'я політики з POLICIES ('' — ручне керування)."""
+    for name, fn in POLICIES.items():
+        if fn is policy:
+            return name
+    return ''
+
+# =====================
+# Атлас спрайтів
+# =====================
+def draw_pacman_shape(surface, px, py, color, direction, tile=TILE):
+    """Пакмен із «щелепою» у напрямку руху, центр у (px, py), для клітинки tile пікселів."""
+    radius = tile//2 - 2
+    pg.draw.circle(surface, color, (px,py), radius)
+    # простенька «щелепа» у напрямку руху
+    dx, dy = direction
+    if (dx,dy) != (0,0):
+        open_amt = tile//4  # виріз (6 пікселів при клітинці 24)
+        mouth_rect = pg.Rect(px-2, py-2, 4, 4)
+        if dx<0: mouth_rect.x -= radius-open_amt
+        if dx>0: mouth_rect.x += radius-open_amt
+        if dy<0: mouth_rect.y -= radius-open_amt
+        if dy>0: mouth_rect.y += radius-open_amt
+        pg.draw.rect(surface, BLACK, mouth_rect)
+
+def draw_ghost_shape(surface, gx, gy, color, direction, tile=TILE):
+    """Привид (тіло, голова, бахрома, очі з зіницями в напрямку руху), центр у (gx, gy), для клітинки tile пікселів."""
+    body_w = tile - 4
+    body_h = tile - 2
+    left = gx - body_w//2
+    top  = gy - body_h//2
+
+    # Тіло: округлений прямокутник
+    rect = pg.Rect(left, top, body_w, body_h)
+    pg.draw.rect(surface, color, rect, border_radius=body_w//3)
+
+    # Напівкругла «голова» (додаємо коло зверху)
+    head_r = body_w//2
+    pg.draw.circle(surface, color, (gx, top+head_r//2), head_r//2 + 2)
+
+    # «Бахрома» знизу: 4 півкола
+    scallops = 4
+    step = body_w // scallops
+    for i in range(scallops):
+        cx = left + step//2 + i*step
+        cy = top + body_h - 1
+        pg.draw.circle(surface, color, (cx, cy), step//2)
+
+    # Очі
+    eye_offset_x = body_w//5
+    eye_y = top + body_h//3
+    eye_r = max(3, body_w//8)
+    # зіниці — у напрямку руху
+    dx, dy = direction
+    pupil_dx = dx * max(1, eye_r//3)
+    pupil_dy = dy * max(1, eye_r//3)
+
+    # Ліве око
+    ex1, ey1 = gx - eye_offset_x, eye_y
+    pg.draw.circle(surface, WHITE, (ex1, ey1), eye_r)
+    pg.draw.circle(surface, BLACK, (ex1 + pupil_dx, ey1 + pupil_dy), eye_r//2)
+    # Праве око
+    ex2, ey2 = gx + eye_offset_x, eye_y
+    pg.draw.circle(surface, WHITE, (ex2, ey2), eye_r)
+    pg.draw.circle(surface, BLACK, (ex2 + pupil_dx, ey2 + pupil_dy), eye_r//2)
+
+class SpriteAtlas:
+    """
+    Заздалегідь намальовані спрайти для одного розміру клітинки: привиди для кожного
+    кольору й напрямку очей (DIR_LIST і «стоїть»), Пакмен для кожного напрямку.
+    Кожна сутність малюється одним blit. Атласи кешуються за розміром TILE, тож
+    SpriteAtlas.for_tile(TILE) сам перебудує спрайти, якщо TILE змінився.
+    """
+    _by_tile = {}
+    DIRECTIONS = DIR_LIST + [(0, 0)]
+
+    def __init__(self, tile):
+        self.tile = tile
+        self.half = tile * 3 // 4  # запас, щоб бахрома й голова привида влізли в спрайт
+        self._pacman = {}
+        self._ghosts = {}
+        for d in self.DIRECTIONS:
+            self.pacman(YELLOW, d)
+            for color in GHOST_COLORS:
+                self.ghost(color, d)
+
+    @classmethod
+    def for_tile(cls, tile):
+        atlas = cls._by_tile.get(tile)
+        if atlas is None:
+            atlas = cls._by_tile[tile] = cls(tile)
+        return atlas
+
+    def _blank(self):
+        return pg.Surface((2*self.half, 2*self.half), pg.SRCALPHA)
+
+    def pacman(self, color, direction):
+        key = (color, direction)
+        sprite = self._pacman.get(key)
+        if sprite is None:
+            sprite = self._blank()
+            draw_pacman_shape(sprite, self.half, self.half, color, direction, self.tile)
+            if pg.display.get_surface() is not None:
+                sprite = sprite.convert_alpha()
+            self._pacman[key] = sprite
+        return sprite
+
+    def ghost(self, color, direction):
+        key = (color, direction)
+        sprite = self._ghosts.get(key)
+        if sprite is None:
+            sprite = self._blank()
+            draw_ghost_shape(sprite, self.half, self.half, color, direction, self.tile)
+            if pg.display.get_surface() is not None:
+                sprite = sprite.convert_alpha()
+            self._ghosts[key] = sprite
+        return sprite
+
+# =====================
+# Кеш тексту й шрифтів
+# =====================
+class TextCache:
+    """
+    Відрендерені написи з LRU-витісненням за ключем (текст, розмір, колір, жирність).
+    Шрифти завантажуються ліниво при першому використанні й далі перевикористовуються.
+    Лічильники hits/misses і час завантаження шрифтів дозволяють виміряти ефект.
+    """
+
+    def __init__(self, max_items=TEXT_CACHE_SIZE, face="arial"):
+        self.max_items = max_items
+        self.face = face
+        self._fonts = {}
+        self._surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.font_load_ms = 0.0
+
+    def font(self, size, bold=False):
+        key = (size, bold)
+        font = self._fonts.get(key)
+        if font is None:
+            t0 = time.perf_counter()
+            font = self._fonts[key] = pg.font.SysFont(self.face, size, bold=bold)
+            self.font_load_ms += (time.perf_counter() - t0) * 1000
+        return font
+
+    def render(self, text, size, color, bold=False):
+        key = (text, size, color, bold)
+        surf = self._surfaces.get(key)
+        if surf is not None:
+            self.hits += 1
+            self._surfaces.move_to_end(key)
+            return surf
+        self.misses += 1
+        surf = self._surfaces[key] = self.font(size, bold).render(text, True, color)
+        if len(self._surfaces) > self.max_items:
+            self._surfaces.popitem(last=False)
+        return surf
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'cached': len(self._surfaces),
+            'fonts': len(self._fonts),
+            'font_load_ms': self.font_load_ms,
+        }
+
+# =====================
+# Інструментування кадру
+# =====================
+def _noop(*args):
+    pass
+
+class FrameProfiler:
+    """
+    Час кожної фази кадру в кільцевому буфері фіксованого розміру.
+
+    Фази відмічаються викликом lap(phase): час від попередньої відмітки додається
+    до фази поточного кадру. Коли профілювання вимкнене, lap — порожня функція,
+    тож хуки в run()/update()/draw() майже нічого не коштують.
+    """
+    PHASES = ('events', 'pacman', 'ghosts', 'draw_grid', 'entities', 'hud', 'flip')
+
+    def __init__(self, size=PROFILE_FRAMES, target_ms=1000 / FPS):
+        self.size = size
+        self.target_ms = target_ms
+        self.phases = {p: array('d', [0.0]) * size for p in self.PHASES}
+        self.frame_ms = array('d', [0.0]) * size
+        self.count = 0          # скільки кадрів записано всього
+        self.dropped = 0        # кадри, довші за 1.5 × цільового
+        self._current = dict.fromkeys(self.PHASES, 0.0)
+        self._t = 0.0
+        self.profile = None     # активний cProfile.Profile
+        self.enabled = False
+        self.lap = _noop
+        self.set_enabled(bool(PROFILE))
+
+    def set_enabled(self, on):
+        self.enabled = on
+        self.lap = self._lap if on else _noop
+        if on:
+            self._current = dict.fromkeys(self.PHASES, 0.0)
+            self._t = time.perf_counter()
+
+    def _lap(self, phase):
+        t = time.perf_counter()
+        self._current[phase] += (t - self._t) * 1000
+        self._t = t
+
+    def begin_frame(self, dt):
+        """Початок кадру: зберегти фази попереднього кадру й тривалість dt."""
+        if not self.enabled:
+            return
+        i = self.count % self.size
+        cur = self._current
+        for p in self.PHASES:
+            self.phases[p][i] = cur[p]
+            cur[p] = 0.0
+        self.frame_ms[i] = dt
+        if dt > self.target_ms * 1.5:
+            self.dropped += 1
+        self.count += 1
+        self._t = time.perf_counter()
+
+    def _window(self, values):
+        return sorted(values[:min(self.count, self.size)])
+
+    def summary(self):
+        """p50/p99 для кожної фази (мс) за вікно буфера."""
+        out = {}
+        for p in self.PHASES + ('frame',):
+            values = self._window(self.frame_ms if p == 'frame' else self.phases[p])
+            if values:
+                out[p] = {'p50': values[len(values) // 2], 'p99': values[min(len(values) - 1, len(values) * 99 // 100)]}
+        return out
+
+    def dropped_in_window(self):
+        n = min(self.count, self.size)
+        return sum(1 for v in self.frame_ms[:n] if v > self.target_ms * 1.5)
+
+    def toggle_cprofile(self):
+        """Увімкнути cProfile або зупинити й зберегти pstats у файл (повертає шлях)."""
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            return None
+        self.profile.disable()
+        path = time.strftime('profile_%Y%m%d_%H%M%S.pstats')
+        self.profile.dump_stats(path)
+        self.profile = None
+        return path
+
+    def export(self, basename=None):
+        """Записати кадри буфера в CSV і зведення в JSON; повертає базове ім'я файлів."""
+        basename = basename or time.strftime('frames_%Y%m%d_%H%M%S')
+        n = min(self.count, self.size)
+        first = self.count - n
+        with open(basename + '.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('frame', 'frame_ms') + self.PHASES)
+            for k in range(first, self.count):
+                i = k % self.size
+                writer.writerow([k, f"{self.frame_ms[i]:.3f}"] + [f"{self.phases[p][i]:.4f}" for p in self.PHASES])
+        with open(basename + '.json', 'w') as f:
+            json.dump({
+                'frames': n,
+                'frames_total': self.count,
+                'dropped_total': self.dropped,
+                'dropped_in_window': self.dropped_in_window(),
+                'target_ms': self.target_ms,
+                'phases_ms': self.summary(),
+            }, f, indent=2)
+        return basename
+
+class InputLatency:
+    """
+    Гістограма затримки керування: від натискання стрілки до показу кадру, у якому
+    Пакмен уже рушив у цьому напрямку. press() — натискання (мітка часу), stepped() —
+    після кожного кроку Пакмена, presented() — після display.flip/update. Натискання,
+    що за max_ms так і не дало руху (напр., у стіну), не рахуються.
+    """
+
+    def __init__(self, bucket_ms=5, max_ms=1000):
+        self.bucket_ms = bucket_ms
+        self.max_ms = max_ms
+        self.counts = array('I', [0]) * (max_ms // bucket_ms + 1)  # останній кошик — «max_ms і більше»
+        self.total = 0
+        self.mark = None   # (мс натискання, напрямок), ще без руху
+        self.moved = None  # мс натискання, рух якого вже є, але ще не показаний
+
+    @staticmethod
+    def now_ms():
+        return time.perf_counter() * 1000
+
+    def press(self, d):
+        self.mark = (self.now_ms(), d)
+
+    def stepped(self, pac):
+        if self.mark is None:
+            return
+        t, d = self.mark
+        if pac.render_from != pac.render_to and pac.last_dir == d:
+            self.moved = t
+            self.mark = None
+        elif self.now_ms() - t > self.max_ms:
+            self.mark = None
+
+    def presented(self):
+        if self.moved is not None:
+            self.add(self.now_ms() - self.moved)
+            self.moved = None
+
+    def add(self, ms):
+        self.counts[min(len(self.counts) - 1, int(ms // self.bucket_ms))] += 1
+        self.total += 1
+
+    def percentile(self, q):
+        """Верхня межа кошика, у який потрапляє перцентиль q (мс)."""
+        if not self.total:
+            return 0.0
+        rank = max(1, math.ceil(self.total * q / 100))
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= rank:
+                return (i + 1) * self.bucket_ms
+        return self.max_ms
+
+    def summary(self):
+        return {'n': self.total, 'p50_ms': self.percentile(50), 'p90_ms': self.percentile(90),
+                'p99_ms': self.percentile(99)}
+
+    def export(self, basename=None):
+        """Гістограма в CSV (кошики) і зведення в JSON; повертає базове ім'я файлів."""
+        basename = basename or time.strftime('latency_%Y%m%d_%H%M%S')
+        with open(basename + '.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('from_ms', 'to_ms', 'count'))
+            for i, c in enumerate(self.counts):
+                writer.writerow((i * self.bucket_ms, (i + 1) * self.bucket_ms, c))
+        with open(basename + '.json', 'w') as f:
+            json.dump(self.summary() | {'bucket_ms': self.bucket_ms, 'lowlat': INPUT_LOWLAT,
+                                        'grace_ms': INPUT_GRACE_MS}, f, indent=2)
+        return basename
+
+# =====================
+# Шаруватий рендер лабіринту
+# =====================
+FLOOR_COLOR = (10, 10, 10)
+
+def draw_tile(surface, cell, rect):
+    """Одна клітинка лабіринту: стіна, підлога або ворота."""
+    if cell == WALL:
+        pg.draw.rect(surface, BLUE, rect)
+    else:
+        pg.draw.rect(surface, FLOOR_COLOR, rect)
+        if cell == GATE:
+            pg.draw.rect(surface, GREY, rect)
+
+def draw_pellet(surface, cx, cy):
+    pg.draw.circle(surface, WHITE, (cx, cy), 3)
+
+class Camera:
+    """
+    Вікно view (пікселі) над картою map (пікселі). follow() центрує його на точці,
+    не виходячи за край карти; якщо карта вміщується у вікно, зсув завжди (0, 0).
+    """
+
+    def __init__(self, view_size, map_size):
+        self.view_w, self.view_h = view_size
+        self.map_w, self.map_h = map_size
+        self.x = self.y = 0
+
+    def follow(self, pos):
+        px, py = pos
+        self.x = max(0, min(self.map_w - self.view_w, px - self.view_w // 2))
+        self.y = max(0, min(self.map_h - self.view_h, py - self.view_h // 2))
+
+    def to_screen(self, pos):
+        return pos[0] - self.x, pos[1] - self.y
+
+    def rect(self):
+        """Видима частина карти у пікселях карти."""
+        return pg.Rect(self.x, self.y, self.view_w, self.view_h)
+
+class LayeredRenderer:
+    """
+    Шари кадру: статичний лабіринт (малюється раз на reset), шар пелет (клітинка
+    стирається лише тоді, коли пелету з'їли) і їхня композиція background.
+    Щокадру відновлюється фон лише під минулими спрайтами, HUD і з'їденими пелетами,
+    а на дисплей ідуть тільки ці брудні прямокутники (pg.display.update(rects)).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.maze = pg.Surface(size).convert()
+        self.pellet_layer = pg.Surface(size, pg.SRCALPHA).convert_alpha()
+        self.background = pg.Surface(size).convert()
+        self.prev_rects = []     # де були спрайти/HUD минулого кадру
+        self.pending = []        # клітинки з'їдених пелет, ще не виведені на екран
+        self.full_redraw = True
+
+    def rebuild(self, grid, pellets):
+        """Намалювати статичні шари заново (після reset)."""
+        maze = self.maze
+        # Тло
+        maze.fill(BLACK)
+        # Стіни / підлога / ворота
+        for y in range(grid.h):
+            for x in range(grid.w):
+                draw_tile(maze, grid.get(x, y), (x*TILE, y*TILE, TILE, TILE))
+        # Пелети
+        self.pellet_layer.fill((0, 0, 0, 0))
+        for (x,y) in pellets:
+            draw_pellet(self.pellet_layer, x*TILE + TILE//2, y*TILE + TILE//2)
+        self.background.blit(maze, (0, 0))
+        self.background.blit(self.pellet_layer, (0, 0))
+        self.prev_rects = []
+        self.pending = []
+        self.full_redraw = True
+
+    def erase_pellet(self, pos):
+        """Стерти з'їдену пелету з шару й перескласти фон лише в її клітинці."""
+        x, y = pos
+        rect = pg.Rect(x*TILE, y*TILE, TILE, TILE)
+        self.pellet_layer.fill((0, 0, 0, 0), rect)
+        self.background.blit(self.maze, rect, rect)
+        self.background.blit(self.pellet_layer, rect, rect)
+        self.pending.append(rect)
+
+    def restore_pellet(self, pos):
+        """Повернути пелету (крок Пакмена скасовано)."""
+        x, y = pos
+        rect = pg.Rect(x*TILE, y*TILE, TILE, TILE)
+        draw_pellet(self.pellet_layer, x*TILE + TILE//2, y*TILE + TILE//2)
+        self.background.blit(self.maze, rect, rect)
+        self.background.blit(self.pellet_layer, rect, rect)
+        self.pending.append(rect)
+
+    def invalidate(self):
+        """Наступний кадр перемалювати повністю (напр., після втрати вмісту вікна)."""
+        self.full_redraw = True
+
+    def draw_background(self, screen, camera):
+        # Лабіринт і пелети вже складені у фоні — один blit на весь екран
+        screen.blit(self.background, (0, 0))
+
+    def restore(self, screen):
+        """Повернути фон під минулими спрайтами та з'їденими пелетами."""
+        bg = self.background
+        for rect in self.prev_rects:
+            screen.blit(bg, rect, rect)
+        for rect in self.pending:
+            screen.blit(bg, rect, rect)
+
+    def commit(self, rects):
+        """Завершити кадр: повертає брудні прямокутники й запам'ятовує поточні."""
+        dirty = self.prev_rects + self.pending + rects
+        self.prev_rects = rects
+        self.pending = []
+        self.full_redraw = False
+        return dirty
+
+class ChunkedRenderer:
+    """
+    Рендер для лабіринтів, більших за вікно. Лабіринт разом із пелетами малюється
+    шматками CHUNK × CHUNK клітинок: шматок будується, коли вперше потрапляє в кадр,
+    і тримається в LRU-кеші на CHUNK_CACHE шматків (пам'ять обмежена незалежно від
+    розміру карти). Щокадру на екран ідуть лише шматки, що перетинають камеру.
+    Камера рухається разом із Пакменом, тож кадр завжди перемальовується повністю.
+    """
+    full_redraw = True
+
+    def __init__(self, size, chunk=CHUNK, cache_size=CHUNK_CACHE):
+        self.size = size
+        self.chunk = chunk
+        self.chunk_px = chunk * TILE
+        self.cache_size = cache_size
+        self.chunks = OrderedDict()  # (cx, cy) -> Surface
+        self.grid = None
+        self.pellets = ()
+        self.built = 0  # скільки шматків намальовано (для профілювання)
+
+    def rebuild(self, grid, pellets):
+        self.grid = grid
+        self.pellets = pellets
+        self.chunks.clear()
+
+    def _build_chunk(self, cx, cy):
+        surf = pg.Surface((self.chunk_px, self.chunk_px)).convert()
+        surf.fill(BLACK)
+        grid, pellets = self.grid, self.pellets
+        x0, y0 = cx * self.chunk, cy * self.chunk
+        for y in range(y0, min(y0 + self.chunk, grid.h)):
+            for x in range(x0, min(x0 + self.chunk, grid.w)):
+                lx, ly = (x - x0) * TILE, (y - y0) * TILE
+                draw_tile(surf, grid.get(x, y), (lx, ly, TILE, TILE))
+                if (x, y) in pellets:
+                    draw_pellet(surf, lx + TILE//2, ly + TILE//2)
+        self.built += 1
+        return surf
+
+    def _chunk(self, cx, cy):
+        surf = self.chunks.get((cx, cy))
+        if surf is None:
+            surf = self.chunks[(cx, cy)] = self._build_chunk(cx, cy)
+            if len(self.chunks) > self.cache_size:
+                self.chunks.popitem(last=False)
+        else:
+            self.chunks.move_to_end((cx, cy))
+        return surf
+
+    def erase_pellet(self, pos):
+        # Якщо шматка немає в кеші — його й так буде побудовано вже без цієї пелети
+        x, y = pos
+        surf = self.chunks.get((x // self.chunk, y // self.chunk))
+        if surf is not None:
+            rect = ((x % self.chunk) * TILE, (y % self.chunk) * TILE, TILE, TILE)
+            draw_tile(surf, self.grid.get(x, y), rect)
+
+    def restore_pellet(self, pos):
+        x, y = pos
+        surf = self.chunks.get((x // self.chunk, y // self.chunk))
+        if surf is not None:
+            draw_pellet(surf, (x % self.chunk) * TILE + TILE//2, (y % self.chunk) * TILE + TILE//2)
+
+    def invalidate(self):
+        pass
+
+    def draw_background(self, screen, camera):
+        cp = self.chunk_px
+        view = camera.rect()
+        screen.fill(BLACK)
+        for cy in range(view.top // cp, (view.bottom - 1) // cp + 1):
+            for cx in range(view.left // cp, (view.right - 1) // cp + 1):
+                screen.blit(self._chunk(cx, cy), (cx * cp - camera.x, cy * cp - camera.y))
+
+    def restore(self, screen):
+        pass
+
+    def commit(self, rects):
+        return rects
+
 # =====================
 # Гра
 # =====================
 class Game:
-    def __init__(self):
-        pg.init()
-        pg.display.set_caption("Pacman — Python / pygame")
-        self.screen = pg.display.set_mode((SCREEN_W, SCREEN_H))
-        self.clock = pg.time.Clock()
-        self.font = pg.font.SysFont("arial", 20)
-        self.big_font = pg.font.SysFont("arial", 64, bold=True)
-
-        self.difficulty = DEFAULT_DIFFICULTY
+    def __init__(self, headless=False, policy=None, grid_w=GRID_W, grid_h=GRID_H, difficulty=None,
+                 seed=None, ghost_count=GHOST_COUNT, level=None):
+        # headless=True — без вікна, шрифтів і pg.init(): лише ігрова логіка для симуляцій
+        # level — готовий рівень (напр. attach_level()): його грає кожен reset()
+        t0 = time.perf_counter()
+        if level is not None:
+            grid_w, grid_h = level.w, level.h
+        self.headless = headless
+        self.policy = policy
+        self.grid_w, self.grid_h = grid_w, grid_h
+        self.ghost_count = ghost_count
+        # Вікно— не більше VIEW_W × VIEW_H клітинок, решту лабіринту показує камера
+        self.screen_w, self.screen_h = min(grid_w, VIEW_W) * TILE, min(grid_h, VIEW_H) * TILE
+        self.camera = Camera((self.screen_w, self.screen_h), (grid_w * TILE, grid_h * TILE))
+        # Рівні: у грі з вікном — фонова підготовка наперед і дисковий кеш,
+        # у безголовій — просто генерація під час reset()
+        if level is not None:
+            self.levels = FixedLevel(level)
+        elif headless:
+            self.levels = LevelPool(grid_w, grid_h, cache_dir=None, background=False,
+                                    nav_cells=min(NAV_TABLE_MAX_CELLS, NAV_TABLE_HEADLESS_CELLS))
+        else:
+            # рівень, якого ще немає в пулі, не чекає на повну таблицю маршрутів
+            self.levels = LevelPool(grid_w, grid_h, background=LEVEL_POOL > 0, defer=True)
+            cached = self.levels.cached_seeds()
+            if seed is None and cached:
+                seed = random.choice(cached)  # перший рівень одразу з кешу
+        # Уся випадковість гри — з потоків одного сіда (None — випадковий сід).
+        # Перший рівень має сід гри, наступні — з потоку 'maze'
+        self.rng = RngStreams(seed)
+        self.level_seeds = deque([self.rng.seed])
+        self.recorder = None  # InputRecorder, якщо гра записується
+        if not headless:
+            pg.init()
+            pg.display.set_caption("Pacman — Python / pygame")
+            self.screen = pg.display.set_mode((self.screen_w, self.screen_h))
+            self.clock = pg.time.Clock()
+            # Шрифти вантажаться ліниво, при першому малюванні тексту
+            self.text = TextCache()
+            self.overlay = None  # напівпрозоре затемнення, створюється один раз
+            if grid_w > VIEW_W or grid_h > VIEW_H:
+                self.renderer = ChunkedRenderer((self.screen_w, self.screen_h))
+            else:
+                self.renderer = LayeredRenderer((self.screen_w, self.screen_h))
+        else:
+            self.renderer = None
+
+        self.difficulty = DEFAULT_DIFFICULTY if difficulty is None else difficulty
         self.ghost_role_swap_cooldown = 0 
+        # Профілювання фаз кадру (F3 — панель, F9 — cProfile, F10 — експорт)
+        self.profiler = FrameProfiler()
+        self.profiler_lines = []
+        self.latency = InputLatency()  # затримка «стрілка -> рух на екрані»
+        # Наступний тік привидів рахується наперед у фоновому потоці (лише гра з вікном)
+        self.planner = GhostPlanner() if (GHOST_AI_THREAD and not headless) else None
+        # Буфер перемотування (Backspace); None, якщо REWIND_BUDGET = 0
+        self.rewind = RewindBuffer() if REWIND_BUDGET else None
+        self.generation = 0  # змінюється при reset() і перемотуванні (ключ для GhostPlanner)
         self.reset()
+        self.startup_ms = (time.perf_counter() - t0) * 1000
 
-    def reset(self):
-        # Генерація лабіринту й клітки
-        self.grid = generate_maze_braid(GRID_W, GRID_H)
-        self.gate_pos, pen_center = add_ghost_pen(self.grid)
-        _repair_after_pen(self.grid)  # приберемо потенційні тупики після вставки PEN
+    def next_level_seed(self):
+        """Сід наступного рівня; заодно просить пул підготувати LEVEL_POOL наступних."""
+        while len(self.level_seeds) < LEVEL_POOL + 1:
+            self.level_seeds.append(self.rng.maze.getrandbits(63))
+        seed = self.level_seeds.popleft()
+        self.levels.prefetch(self.level_seeds)
+        return seed
 
-        # Пелети
-        self.pellets = set()
-        for y in range(GRID_H):
-            for x in range(GRID_W):
-                if self.grid[y][x] == FLOOR:
-                    self.pellets.add((x,y))
-        # прибрати пелети біля клітки
-        gx, gy = self.gate_pos
-        for y in range(gy-2, gy+4):
-            for x in range(gx-3, gx+4):
-                if in_bounds(x,y) and (x,y) in self.pellets:
-                    self.pellets.discard((x,y))
+    def reset(self):
+        # Лабіринт, клітка, пелети й таблиця маршрутів — готовий рівень з пулу/кешу
+        level = self.level = self.levels.get(self.next_level_seed())
+        self.grid = level.grid
+        self.gate_pos = level.gate_pos
+        self.nav = level.nav
+        self.pellets = PelletStore(self.grid_w, self.grid_h, level.pellets)
 
         # Пакмен — старт
-        self.pac = Pacman(self.grid, (1, GRID_H-2))
+        self.pac = Pacman(self.grid, (1, self.grid_h-2))
+        # Спільна карта відстаней від Пакмена для всіх привидів
+        self.pac_field = DistanceField(self.nav, self.pac.pos)
+        # Індекс видимості для режиму зору привидів
+        self.sight = VisibilityIndex(self.grid) if GHOST_SIGHT else None
 
         # Привиди — у клітці
-        self.ghosts = []
-        spawn_points = []
-        for y in range(GRID_H):
-            for x in range(GRID_W):
-                if self.grid[y][x] == PEN:
-                    spawn_points.append((x,y))
-        random.shuffle(spawn_points)
-        for i, color in enumerate(GHOST_COLORS):
-            sp = spawn_points[i % len(spawn_points)]
-            self.ghosts.append(Ghost(self.grid, sp, color))
+        spawn_points = list(level.spawn_points)
+        self.rng.spawn.shuffle(spawn_points)
+        starts = [spawn_points[i % len(spawn_points)] for i in range(self.ghost_count)]
+        self.swarm = GhostSwarm(self.grid, starts, self.nav, self.rng.patrol)
+        self.generation += 1
+        if self.planner is not None:
+            self.planner.cancel()
+        self.ghosts = [Ghost(self.swarm, i) for i in range(self.ghost_count)]
 
         # Призначаємо ролі привидам залежно від складності
         self.assign_ghost_roles()
         self.pac_step_acc = 0
         self.ghost_step_acc = 0
+        self.last_step = None  # (звідки, попередній напрямок, чи з'їв пелету, тік привидів)
         self.running = True
         self.win = False
         self.ghost_role_swap_cooldown = 0
+        if self.renderer is not None:
+            self.renderer.rebuild(self.grid, self.pellets)
+        # Лічильники для симуляцій/звітів
+        self.pellets_total = len(self.pellets)
+        self.elapsed_ms = 0
+        self.frames = 0
+        self.pac_steps = 0
+        self.ghost_ticks = 0
+        # Нове вікно перемотування починається з опорного кадру стартового стану
+        if self.rewind is not None:
+            self.rewind.clear()
+            self.rewind.record(self)
 
     def assign_ghost_roles(self):
-        """Призначає ролі привидам на основі поточного рівня складності."""
-        num_ghosts = len(self.ghosts)
-        
-        if self.difficulty <= 1:
-            # Усі переслідувачі
-            for g in self.ghosts:
-                g.role = 'CHASER'
-        
-        elif self.difficulty >= 2:
-            # Половина - переслідувачі, половина - засідники
-            for i, g in enumerate(self.ghosts):
-                if i < num_ghosts // 2:
-                    g.role = 'CHASER'
-                else:
-                    g.role = 'AMBUSHER'
+        """Призначає ролі привидам на основі поточного рівня складності (усім разом)."""
+        self.swarm.assign_roles(self.difficulty)
+
+    def state_hash(self):
+        """SHA-256 ігрового стану: сітка, пелети, сутності, рахунок, таймери."""
+        h = hashlib.sha256()
+        h.update(self.grid.cells)
+        h.update(repr(sorted(self.pellets)).encode())
+        pac = self.pac
+        h.update(repr((pac.pos, pac.last_dir, pac.score, pac.alive, self.win, self.difficulty,
+                       self.pac_step_acc, self.ghost_step_acc, self.ghost_role_swap_cooldown)).encode())
+        for g in self.ghosts:
+            h.update(repr((g.pos, g.dir, g.role, g.memory_seen)).encode())
+        return h.digest()
 
     # ========= Ввід =========
-    def handle_event(self, e):
+    def handle_event(self, e, after_update=False):
+        if self.recorder is not None:
+            self.recorder.event(e, after_update)
         if e.type == pg.QUIT:
             self.running = False
+        elif e.type == pg.VIDEOEXPOSE:
+            # вміст вікна втрачено — наступний кадр малюємо повністю
+            if self.renderer is not None:
+                self.renderer.invalidate()
         elif e.type == pg.KEYDOWN:
             if e.key == pg.K_ESCAPE:
                 self.running = False
             elif e.key == pg.K_r:
                 self.reset()
+            elif e.key == pg.K_BACKSPACE:
+                self.rewind_steps(REWIND_STEPS)
+            elif e.key == pg.K_F6:
+                # автопілот: увімкнути / повернути ручне керування
+                if self.policy is autopilot_policy:
+                    self.policy = None
+                    self.pac.release(self.pac.held_dir)
+                else:
+                    self.policy = autopilot_policy
+            elif e.key == pg.K_F3:
+                self.profiler.set_enabled(not self.profiler.enabled)
+                if self.renderer is not None:
+                    self.renderer.invalidate()  # прибрати/показати панель
+            elif e.key == pg.K_F9:
+                path = self.profiler.toggle_cprofile()
+                print("cProfile: запис..." if path is None else f"cProfile збережено: {path}")
+            elif e.key == pg.K_F10:
+                print(f"Кадри експортовано: {self.profiler.export()}.csv/.json")
+                print(f"Затримку вводу експортовано: {self.latency.export()}.csv/.json")
             elif e.key in DIFFICULTY_KEYS:
                 self.difficulty = DIFFICULTY_KEYS[e.key]
                 self.assign_ghost_roles() # Оновлюємо ролі при зміні складності
@@ -509,160 +3256,254 @@ class Game:
                 d = DIRS[e.key]
                 self.pac.request_step(d)  # одноразовий крок на натискання
                 self.pac.hold(d)          # також позначити як утримуваний (для автоповтору)
+                self.latency.press(d)
+                if INPUT_LOWLAT and not self.late_turn(d):
+                    self.early_step(d)
         elif e.type == pg.KEYUP:
             if e.key in DIRS:
                 d = DIRS[e.key]
                 self.pac.release(d)
 
+    def rewind_steps(self, back):
+        """Перемотати гру на back дискретних кроків назад (у межах вікна буфера)."""
+        if self.rewind is None or not self.rewind.restore(self, back):
+            return
+        self.last_step = None
+        self.generation += 1  # порахований наперед тік привидів уже не актуальний
+        if self.planner is not None:
+            self.planner.cancel()
+        if self.renderer is not None:
+            self.renderer.rebuild(self.grid, self.pellets)
+            self.renderer.invalidate()
+
+    def early_step(self, d):
+        """
+        Низька затримка: зробити крок Пакмена вже зараз, якщо він стоїть (фаза кроку
+        починається з натискання) або до кроку лишилось не більше INPUT_GRACE_MS.
+        Ранній крок забирає ці мс з наступного (pac_step_acc стає від'ємним),
+        тож швидкість Пакмена не змінюється.
+        """
+        pac = self.pac
+        if not pac.alive or self.win or not pac.can_move(d):
+            return
+        if pac.render_from == pac.render_to:
+            self.pac_step_acc = 0  # стояв — нова фаза кроків
+        elif self.pac_step_acc >= PAC_STEP_MS - INPUT_GRACE_MS:
+            self.pac_step_acc -= PAC_STEP_MS
+        else:
+            return
+        # анімація нового кроку починається з того місця, де спрайт зараз, а не стрибком
+        (fx, fy), (tx, ty), t = pac.render_from, pac.render_to, pac.move_t
+        shown = (fx*(1-t) + tx*t, fy*(1-t) + ty*t)
+        self.step_pacman()
+        if pac.render_from != pac.render_to:
+            pac.render_from = shown
+
+    def late_turn(self, d):
+        """
+        Поворот «навздогін»: Пакмен ступив прямо не більше INPUT_GRACE_MS тому, а з
+        попередньої клітинки можна було піти в d — тоді цей крок переробляється в
+        напрямку d. Таймер кроків не змінюється, і привиди за цей час не ходили
+        (інакше поворот не робиться), тож для решти гри це звичайний крок у d.
+        """
+        last, pac = self.last_step, self.pac
+        if (last is None or self.policy is not None or self.win or not pac.alive
+                or self.pac_step_acc > INPUT_GRACE_MS or d == pac.last_dir):
+            return False
+        src, prev_dir, ate, ticks = last
+        if ticks != self.ghost_ticks or self.grid.get(src[0] + d[0], src[1] + d[1]) == WALL:
+            return False
+        # Скасувати крок: пелета, рахунок, знімок перемотування, поле відстаней
+        if ate:
+            self.pellets.add(pac.pos)
+            pac.score -= PELLET_SCORE
+            if self.renderer is not None:
+                self.renderer.restore_pellet(pac.pos)
+        if self.rewind is not None:
+            self.rewind.drop_last()
+        (fx, fy), (tx, ty), t = pac.render_from, pac.render_to, pac.move_t
+        shown = (fx*(1-t) + tx*t, fy*(1-t) + ty*t)
+        pac.x, pac.y = src
+        pac.last_dir = prev_dir
+        self.pac_steps -= 1
+        self.pac_field.move_to(src)
+        # ... і зробити його в напрямку d
+        pac.single_step_queue.clear()
+        pac.single_step_queue.append(d)
+        self.step_pacman()
+        pac.render_from = shown
+        return True
+
+    def apply_policy(self):
+        """Запитати в політики напрямок і «утримати» його, як клавішу."""
+        d = self.policy(self)
+        if d is None:
+            self.pac.release(self.pac.held_dir)
+        else:
+            self.pac.hold(d)
+
     # ========= Оновлення =========
     def update(self, dt):
         # Оновлюємо таймер кулдауну для динамічної зміни ролей 
         if self.ghost_role_swap_cooldown > 0:
             self.ghost_role_swap_cooldown -= dt
             
-        # Пакмен: дискретний крок за таймером
+        # Пакмен: дискретний крок за таймером (не більше MAX_CATCHUP_STEPS за кадр)
         self.pac_step_acc += dt
+        steps = 0
         while self.pac_step_acc >= PAC_STEP_MS and self.pac.alive and not self.win:
+            if steps == MAX_CATCHUP_STEPS:
+                self.pac_step_acc %= PAC_STEP_MS  # решту відставання відкидаємо, фазу кроку лишаємо
+                break
             self.pac_step_acc -= PAC_STEP_MS
-            self.pac.step()
-            # з’їсти пелет
-            if self.pac.pos in self.pellets:
-                self.pellets.remove(self.pac.pos)
-                self.pac.score += PELLET_SCORE
-                if not self.pellets:
-                    self.win = True
+            self.step_pacman()
+            steps += 1
         # оновити інтерполяцію
         self.pac.tick_anim(dt)
+        self.profiler.lap('pacman')
 
         # Привиди: також дискретні кроки
         self.ghost_step_acc += dt
+        steps = 0
         while self.ghost_step_acc >= GHOST_STEP_MS and self.pac.alive and not self.win:
+            if steps == MAX_CATCHUP_STEPS:
+                self.ghost_step_acc %= GHOST_STEP_MS
+                break
+            steps += 1
             self.ghost_step_acc -= GHOST_STEP_MS
+            self.ghost_ticks += 1
             pac_pos = self.pac.pos
             pac_dir = self.pac.last_dir
+            swarm = self.swarm
 
             # --- Рівень 5: Динамічна зміна ролі переслідувача З КУЛДАУНОМ ---
             # Перевіряємо, чи можна змінювати ролі
-            if self.difficulty == 5 and len(self.ghosts) > 1 and self.ghost_role_swap_cooldown <= 0:
+            if self.difficulty == 5 and swarm.n > 1 and self.ghost_role_swap_cooldown <= 0:
                 # Знаходимо найближчого привида
-                closest_ghost = min(self.ghosts, key=lambda g: manhattan(g.pos, pac_pos))
-                
-                # Знаходимо поточного переслідувача
-                current_chaser = None
-                for g in self.ghosts:
-                    if g.role == 'CHASER':
-                        current_chaser = g
-                        break
-                
+                field = self.pac_field
+                closest = min(range(swarm.n), key=lambda i: field.distance(swarm.pos(i)))
+
+                # Знаходимо поточного переслідувача (перший з роллю CHASER)
+                current = swarm.role.find(CHASER)
+
                 # Якщо найближчий - не переслідувач, міняємо ролі
-                if current_chaser and closest_ghost is not current_chaser:
+                if current >= 0 and closest != current:
                     # Простий обмін ролями
-                    current_chaser.role, closest_ghost.role = closest_ghost.role, current_chaser.role
+                    swarm.role[current], swarm.role[closest] = swarm.role[closest], swarm.role[current]
                     # <<< ВСТАНОВЛЮЄМО КУЛДАУН ПІСЛЯ ЗМІНИ
-                    self.ghost_role_swap_cooldown = 3000  # 3000 мс = 3 секунди
-
-            # --- Оновлення ШІ для кожного привида ---
-            order = list(range(len(self.ghosts)))
-            random.shuffle(order)
-            for idx in order:
-                g = self.ghosts[idx]
-                
-                # --- Рівень 0: Активний лише один привид ---
-                if self.difficulty == 0 and idx > 0:
-                    continue # Пропускаємо всіх, крім першого
-                    
-                g.step_ai(self.difficulty, pac_pos, pac_dir, self.pellets)
-
-            # Перевірка зіткнення
-            for g in self.ghosts:
-                if g.pos == self.pac.pos:
-                    self.pac.alive = False
-                    break        
-    
-        # Оновлюємо анімацію для ВСІХ привидів кожен кадр
-        for g in self.ghosts:
-            g.tick_anim(dt)
+                    self.ghost_role_swap_cooldown = ROLE_SWAP_COOLDOWN_MS
+
+            # --- Оновлення ШІ для всіх привидів разом ---
+            # (готовий результат з фонового потоку, якщо його знімок ще актуальний)
+            planner = self.planner
+            planned = planner.take(self.ghost_key()) if planner is not None else None
+            if planned is not None:
+                back, order_rng = planned
+                swarm.adopt(back)
+                self.rng.order.setstate(order_rng.getstate())
+            elif planner is not None:
+                planner.advance(swarm, self.rng.order, self.difficulty, pac_pos, pac_dir,
+                                self.pellets, self.pac_field, self.sight)
+            else:
+                swarm.advance(self.rng.order, self.difficulty, pac_pos, pac_dir,
+                              self.pellets, self.pac_field, self.sight)
+
+            # Перевірка зіткнення — через просторовий хеш клітинок
+            if swarm.count_at(self.pac.pos):
+                self.pac.alive = False
+            if self.rewind is not None:
+                self.rewind.record(self)
+
+        # Анімація всіх привидів — один спільний прогрес
+        self.swarm.tick_anim(dt)
+        self.plan_ghosts()
+        self.profiler.lap('ghosts')
+
+    def step_pacman(self):
+        """Один дискретний крок Пакмена: політика, рух, поле відстаней, пелета, знімок."""
+        if self.policy is not None:
+            self.apply_policy()
+        src, prev_dir = self.pac.pos, self.pac.last_dir
+        self.pac.step()
+        self.pac_steps += 1
+        self.latency.stepped(self.pac)
+        self.pac_field.move_to(self.pac.pos)
+        # крок, який ще можна переробити поворотом «навздогін» (late_turn)
+        ate = self.pac.pos in self.pellets
+        moved = self.pac.pos != src
+        self.last_step = (src, prev_dir, ate, self.ghost_ticks) if moved else None
+        if self.planner is not None and (moved or self.pac.last_dir != prev_dir):
+            self.planner.cancel()  # знімок для тіку привидів зроблено до цього кроку
+        # з’їсти пелет
+        if ate:
+            self.pellets.remove(self.pac.pos)
+            if self.renderer is not None:
+                self.renderer.erase_pellet(self.pac.pos)
+            self.pac.score += PELLET_SCORE
+            if self.rewind is not None:
+                self.rewind.eaten.append(self.pac.pos)
+            if not self.pellets:
+                self.win = True
+        if self.rewind is not None:
+            self.rewind.record(self)
+
+    def ghost_key(self):
+        """Усе, від чого залежить наступний тік привидів (крім самих привидів і генераторів)."""
+        pac = self.pac
+        return (self.generation, self.ghost_ticks, pac.pos, pac.last_dir, self.difficulty,
+                len(self.pellets), bytes(self.swarm.role))
+
+    def plan_ghosts(self):
+        """
+        Віддати наступний тік привидів фоновому потоку, якщо тік дорогий і до нього
+        Пакмен уже не крокуватиме (інакше знімок застаріє — почекаємо кроку Пакмена).
+        """
+        planner = self.planner
+        if planner is None or not planner.worth_planning() or not self.pac.alive or self.win:
+            return
+        if GHOST_STEP_MS - self.ghost_step_acc >= PAC_STEP_MS - self.pac_step_acc:
+            return
+        # ghost_ticks + 1: ключ тіку, який щойно настане
+        key = self.ghost_key()
+        key = key[:1] + (self.ghost_ticks + 1,) + key[2:]
+        planner.plan(key, self.swarm, self.rng.order, self.difficulty, self.pac.pos,
+                     self.pac.last_dir, self.pellets, self.pac_field, self.sight)
 
     # ========= Малювання =========
     def draw_grid(self):
-        # Тло
-        self.screen.fill(BLACK)
-        # Стіни / підлога / ворота
-        for y in range(GRID_H):
-            for x in range(GRID_W):
-                rect = (x*TILE, y*TILE, TILE, TILE)
-                cell = self.grid[y][x]
-                if cell == WALL:
-                    pg.draw.rect(self.screen, BLUE, rect)
-                else:
-                    pg.draw.rect(self.screen, (10,10,10), rect)
-                    if cell == GATE:
-                        pg.draw.rect(self.screen, GREY, rect)
-        # Пелети
-        for (x,y) in self.pellets:
-            cx, cy = x*TILE + TILE//2, y*TILE + TILE//2
-            pg.draw.circle(self.screen, WHITE, (cx,cy), 3)
+        self.renderer.draw_background(self.screen, self.camera)
+
+    def _draw_sprite(self, sprite, pos):
+        """Спрайт із центром у pos (пікселі карти); None, якщо він поза камерою."""
+        rect = sprite.get_rect(center=self.camera.to_screen(pos))
+        if not rect.colliderect(self.screen.get_rect()):
+            return None
+        return self.screen.blit(sprite, rect)
 
     def _draw_pacman(self):
-        px, py = self.pac.render_pos_px()
-        radius = TILE//2 - 2
-        pg.draw.circle(self.screen, self.pac.color, (px,py), radius)
-        # простенька «щелепа» у напрямку руху (мигтить з частотою кроку)
-        dx, dy = self.pac.last_dir
-        if (dx,dy) != (0,0):
-            open_amt = 6  # виріз
-            mouth_rect = pg.Rect(px-2, py-2, 4, 4)
-            if dx<0: mouth_rect.x -= radius-open_amt
-            if dx>0: mouth_rect.x += radius-open_amt
-            if dy<0: mouth_rect.y -= radius-open_amt
-            if dy>0: mouth_rect.y += radius-open_amt
-            pg.draw.rect(self.screen, BLACK, mouth_rect)
-
-    def _draw_ghost(self, ghost: 'Ghost'):
-        gx, gy = ghost.render_pos_px()
-        body_w = TILE - 4
-        body_h = TILE - 2
-        left = gx - body_w//2
-        top  = gy - body_h//2
-
-        # Тіло: округлений прямокутник
-        rect = pg.Rect(left, top, body_w, body_h)
-        pg.draw.rect(self.screen, ghost.color, rect, border_radius=body_w//3)
-
-        # Напівкругла «голова» (додаємо коло зверху)
-        head_r = body_w//2
-        pg.draw.circle(self.screen, ghost.color, (gx, top+head_r//2), head_r//2 + 2)
-
-        # «Бахрома» знизу: 4 півкола
-        scallops = 4
-        step = body_w // scallops
-        for i in range(scallops):
-            cx = left + step//2 + i*step
-            cy = top + body_h - 1
-            pg.draw.circle(self.screen, ghost.color, (cx, cy), step//2)
-
-        # Очі
-        eye_offset_x = body_w//5
-        eye_y = top + body_h//3
-        eye_r = max(3, body_w//8)
-        # зіниці — у напрямку руху
-        dx, dy = ghost.dir
-        pupil_dx = dx * max(1, eye_r//3)
-        pupil_dy = dy * max(1, eye_r//3)
-
-        # Ліве око
-        ex1, ey1 = gx - eye_offset_x, eye_y
-        pg.draw.circle(self.screen, WHITE, (ex1, ey1), eye_r)
-        pg.draw.circle(self.screen, BLACK, (ex1 + pupil_dx, ey1 + pupil_dy), eye_r//2)
-        # Праве око
-        ex2, ey2 = gx + eye_offset_x, eye_y
-        pg.draw.circle(self.screen, WHITE, (ex2, ey2), eye_r)
-        pg.draw.circle(self.screen, BLACK, (ex2 + pupil_dx, ey2 + pupil_dy), eye_r//2)
+        sprite = self.sprites.pacman(self.pac.color, self.pac.last_dir)
+        return self._draw_sprite(sprite, self.pac.render_pos_px())
+
+    def _draw_ghosts(self):
+        """Усі привиди в кадрі камери одним screen.blits(); повертає їхні прямокутники."""
+        swarm, sprites, cam = self.swarm, self.sprites, self.camera
+        view = self.screen.get_rect()
+        half = sprites.half
+        batch = []
+        for i, (px, py) in enumerate(swarm.render_positions()):
+            sx, sy = px - cam.x, py - cam.y
+            # відсікання: спрайт не ширший за 2*half
+            if -half < sx < view.w + half and -half < sy < view.h + half:
+                sprite = sprites.ghost(GHOST_COLORS[swarm.color[i]], STEPS[swarm.dir[i]])
+                batch.append((sprite, sprite.get_rect(center=(sx, sy))))
+        return self.screen.blits(batch) if batch else []
 
     def draw_entities(self):
-        self._draw_pacman()
-        for g in self.ghosts:
-            self._draw_ghost(g)
+        """Малює Пакмена й привидів у кадрі камери; повертає прямокутники, які вони зайняли."""
+        self.sprites = SpriteAtlas.for_tile(TILE)
+        rects = [self._draw_pacman()]
+        rects.extend(self._draw_ghosts())
+        return [r for r in rects if r is not None]
 
     def draw_hud(self):
         fps = self.clock.get_fps()
@@ -673,44 +3514,180 @@ class Game:
             difficulty_name = DIFFICULTY_NAMES[self.difficulty]
 
         txt = f"Score: {self.pac.score}   Pellets left: {len(self.pellets)}   Difficulty: {difficulty_name}   FPS: {fps:.0f}"
-        surf = self.font.render(txt, True, WHITE)
-        self.screen.blit(surf, (8, 4))
+        surf = self.text.render(txt, 20, WHITE)
+        return self.screen.blit(surf, (8, 4))
+
+    def draw_profiler_panel(self):
+        """Панель із p50/p99 кожної фази та пропущеними кадрами (оновлюється раз на 30 кадрів)."""
+        prof = self.profiler
+        if not self.profiler_lines or prof.count % 30 == 0:
+            summary = prof.summary()
+            lines = [f"{p:>9}: p50 {v['p50']:6.2f}  p99 {v['p99']:6.2f} ms" for p, v in summary.items()]
+            lines.append(f"dropped: {prof.dropped_in_window()} / {min(prof.count, prof.size)} frames")
+            lat = self.latency.summary()
+            if lat['n']:
+                lines.append(f"input->move: p50 {lat['p50_ms']:.0f}  p99 {lat['p99_ms']:.0f} ms (n={lat['n']})")
+            if self.planner is not None:
+                p = self.planner
+                lines.append(f"ghost AI ahead: {p.hits} used / {p.planned} planned, {p.stale} stale, "
+                             f"tick {p.tick_ms:.1f} ms")
+            if isinstance(self.policy, Autopilot):
+                st = self.policy.stats()
+                lines.append(f"autopilot: {st['mean_us']:.0f} us/step, p99 {st['p99_us']:.0f} us, "
+                             f"{st['replans']} plans")
+            rw = self.rewind
+            if rw is not None:
+                lines.append(f"rewind: {len(rw)} steps, {rw.nbytes / 1024:.0f} KB, "
+                             f"{rw.bytes_per_step():.0f} B/step")
+            if prof.profile is not None:
+                lines.append("cProfile: REC (F9)")
+            self.profiler_lines = lines
+        x, y = self.screen_w - 260, 30
+        area = pg.Rect(x, y, 0, 0)
+        for line in self.profiler_lines:
+            surf = self.text.render(line, 14, WHITE)
+            area.union_ip(self.screen.blit(surf, (x, y)))
+            y += surf.get_height()
+        return area
 
     def draw_overlay_text(self, text, color):
-        overlay = pg.Surface((SCREEN_W, SCREEN_H), pg.SRCALPHA)
-        overlay.fill((0,0,0,180))
-        self.screen.blit(overlay, (0,0))
-        size = min(SCREEN_W//len(text)*2, SCREEN_H//3)
+        sw, sh = self.screen_w, self.screen_h
+        if self.overlay is None:
+            self.overlay = pg.Surface((sw, sh), pg.SRCALPHA)
+            self.overlay.fill((0,0,0,180))
+        self.screen.blit(self.overlay, (0,0))
+        size = min(sw//len(text)*2, sh//3)
         size = max(36, min(120, size))
-        font = pg.font.SysFont("arial", size, bold=True)
-        surf = font.render(text, True, color)
-        rect = surf.get_rect(center=(SCREEN_W//2, SCREEN_H//2))
+        surf = self.text.render(text, size, color, bold=True)
+        rect = surf.get_rect(center=(sw//2, sh//2))
         self.screen.blit(surf, rect)
-        hint = self.font.render("Натисніть R, щоб перезапустити", True, WHITE)
-        hint_rect = hint.get_rect(center=(SCREEN_W//2, SCREEN_H//2 + size))
+        hint = self.text.render("Натисніть R, щоб перезапустити", 20, WHITE)
+        hint_rect = hint.get_rect(center=(sw//2, sh//2 + size))
         self.screen.blit(hint, hint_rect)
 
     def draw(self):
-        self.draw_grid()
-        self.draw_entities()
-        self.draw_hud()
+        """
+        Малює кадр. Повертає список брудних прямокутників для pg.display.update(rects)
+        або None, якщо перемальовано весь екран (тоді потрібен flip()).
+        """
+        lap = self.profiler.lap
+        self.camera.follow(self.pac.render_pos_px())
+        full = self.renderer.full_redraw or not self.pac.alive or self.win
+        if full:
+            self.draw_grid()
+        else:
+            self.renderer.restore(self.screen)
+        lap('draw_grid')
+        rects = self.draw_entities()
+        lap('entities')
+        rects.append(self.draw_hud())
+        if self.profiler.enabled:
+            rects.append(self.draw_profiler_panel())
         if not self.pac.alive:
             self.draw_overlay_text("GAME OVER", RED)
         if self.win:
             self.draw_overlay_text("YOU WIN!", YELLOW)
+        lap('hud')
+        dirty = self.renderer.commit(rects)
+        return None if full else dirty
+
+    def simulate(self, max_ms=None, dt=1000 / FPS, on_frame=None):
+        """
+        Безголова симуляція: крутить update() з фіксованим кроком dt (мс) без вікна
+        й без очікування реального часу, доки Пакмен живий, не виграв і не минуло max_ms.
+        on_frame(game), якщо задано, викликається після кожного кадру (запис кадрів).
+        Повертає словник із результатами гри.
+        """
+        while self.pac.alive and not self.win and (max_ms is None or self.elapsed_ms < max_ms):
+            self.update(dt)
+            self.elapsed_ms += dt
+            self.frames += 1
+            if on_frame is not None:
+                on_frame(self)
+        return {
+            'survival_ms': self.elapsed_ms,
+            'pellets_eaten': self.pellets_total - len(self.pellets),
+            'pellets_total': self.pellets_total,
+            'score': self.pac.score,
+            'win': self.win,
+            'alive': self.pac.alive,
+            'frames': self.frames,
+            'pac_steps': self.pac_steps,
+            'ghost_ticks': self.ghost_ticks,
+        }
+
+    def idle(self):
+        """Нічого не рухається: гру закінчено, а анімації останнього кроку догравши."""
+        return (not self.pac.alive or self.win) and self.pac.move_t >= 1.0 and self.swarm.move_t >= 1.0
+
+    def wait_idle(self):
+        """
+        Режим очікування для нерухомого екрана: процес спить у pg.event.wait(), доки не
+        прийде подія (клавіша, перекриття вікна). True - подію повернуто в чергу, кадр треба
+        рахувати; False - минув IDLE_WAIT_MS і нічого не сталося.
+        """
+        e = pg.event.wait(IDLE_WAIT_MS)
+        if e.type == pg.NOEVENT:
+            return False
+        pg.event.post(e)
+        return True
 
     def run(self):
+        prof = self.profiler
+        shown = False  # чи показано вже кадр нерухомого екрана
         while self.running:
-            dt = self.clock.tick(FPS)
+            if shown and self.idle():
+                if not self.wait_idle():
+                    continue
+                self.clock.tick()  # час сну не рахуємо за кадр
+            # фіксований крок симуляції: пауза довша за MAX_FRAME_MS не перетворюється на лавину кроків
+            dt = min(self.clock.tick(FPS), MAX_FRAME_MS)
+            prof.begin_frame(dt)
+            if self.recorder is not None:
+                self.recorder.frame(dt)
             for e in pg.event.get():
                 self.handle_event(e)
+            prof.lap('events')
             self.update(dt)
-            self.draw()
-            pg.display.flip()
+            if INPUT_LOWLAT:
+                # ввід, що надійшов під час update(), встигає в цей же кадр
+                for e in pg.event.get():
+                    self.handle_event(e, after_update=True)
+                prof.lap('events')
+            dirty = self.draw()
+            if dirty is None:
+                pg.display.flip()
+            else:
+                pg.display.update(dirty)
+            self.latency.presented()
+            shown = self.idle()
+            prof.lap('flip')
         pg.quit()
 
 
 # (Функції вже вище — просто лишаємо завершальний блок нижче)
 
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Pacman — Python / pygame")
+    ap.add_argument('--seed', type=int, help="сід гри (за замовчуванням випадковий)")
+    ap.add_argument('--record', metavar='LOG', help="записати ввід у бінарний журнал")
+    ap.add_argument('--replay', metavar='LOG', help="безголовий повтор журналу з перевіркою хешу")
+    args = ap.parse_args(argv)
+
+    if args.replay:
+        r = replay(args.replay)
+        sim_s = r['sim_ms'] / 1000
+        print(f"{r['frames']} кадрів, {sim_s:.1f} с гри за {r['wall_s']:.2f} с "
+              f"(x{sim_s / max(r['wall_s'], 1e-9):.0f}); хеш стану: {'OK' if r['ok'] else 'НЕ ЗБІГАЄТЬСЯ'}")
+        return 0 if r['ok'] else 1
+
+    game = Game(seed=args.seed, policy=autopilot_policy if AUTOPILOT else None)
+    if args.record:
+        game.recorder = InputRecorder(game)
+    game.run()
+    if args.record:
+        game.recorder.save(args.record, game.state_hash())
+    return 0
+
 if __name__ == "__main__":
-    Game().run()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,148 @@
+"""
+Прогін багатьох безголових ігор із різними сідами, складністю та розмірами сітки
+у пулі процесів. Результати агрегуються у CSV/JSON-звіт.
+
+З --shared-level усі ігри одного розміру грають один лабіринт (сід --seed): він
+будується й публікується в спільну пам'ять один раз, а воркери під'єднуються до нього
+без копій (pacman.SharedLevel / attach_level) — разом із таблицею маршрутів.
+
+Приклад:
+    python sweep.py --games 1000 --difficulties 0-5 --sizes 27x21,41x31 --out report
+    python sweep.py --games 200 --sizes 101x101 --shared-level --shared-nav-cells 4000
+"""
+import argparse
+import csv
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pacman
+
+
+def parse_sizes(text):
+    """'27x21,41x31' -> [(27, 21), (41, 31)]"""
+    sizes = []
+    for part in text.split(','):
+        w, h = part.lower().split('x')
+        sizes.append((int(w), int(h)))
+    return sizes
+
+def parse_difficulties(text):
+    """'0-5' або '1,3,5' -> список рівнів"""
+    if '-' in text:
+        lo, hi = text.split('-')
+        return list(range(int(lo), int(hi) + 1))
+    return [int(d) for d in text.split(',')]
+
+def play_one(task):
+    """Одна безголова гра. Виконується у процесі-воркері."""
+    seed, difficulty, (w, h), policy_name, max_ms, shared = task
+    policy = pacman.POLICIES[policy_name]
+    if isinstance(policy, pacman.Autopilot):
+        policy.reset_stats()  # власний час автопілота — окремо для кожної гри
+    # під'єднання кешується на воркер; detach_level закриє його, коли воркер завершиться
+    level = pacman.attach_level(shared) if shared else None
+    game = pacman.Game(headless=True, policy=policy, grid_w=w, grid_h=h, difficulty=difficulty,
+                       seed=seed, level=level)
+    t0 = time.perf_counter()
+    result = game.simulate(max_ms=max_ms)
+    wall = time.perf_counter() - t0
+    result.update({
+        'seed': seed,
+        'difficulty': difficulty,
+        'grid_w': w,
+        'grid_h': h,
+        'wall_s': wall,
+        'steps_per_sec': result['frames'] / wall if wall > 0 else 0.0,
+        'policy_us': policy.stats()['mean_us'] if isinstance(policy, pacman.Autopilot) else 0.0,
+        'startup_ms': game.startup_ms,
+    })
+    return result
+
+def aggregate(results):
+    """Групує результати за (розмір, складність) і рахує середні показники."""
+    groups = {}
+    for r in results:
+        groups.setdefault((r['grid_w'], r['grid_h'], r['difficulty']), []).append(r)
+    rows = []
+    for (w, h, d), rs in sorted(groups.items()):
+        survival = [r['survival_ms'] for r in rs]
+        rows.append({
+            'grid': f"{w}x{h}",
+            'difficulty': d,
+            'games': len(rs),
+            'win_rate': sum(r['win'] for r in rs) / len(rs),
+            'survival_ms_mean': statistics.fmean(survival),
+            'survival_ms_median': statistics.median(survival),
+            'pellets_eaten_mean': statistics.fmean(r['pellets_eaten'] for r in rs),
+            'pellets_frac_mean': statistics.fmean(r['pellets_eaten'] / max(1, r['pellets_total']) for r in rs),
+            'steps_per_sec_mean': statistics.fmean(r['steps_per_sec'] for r in rs),
+            'policy_us_mean': statistics.fmean(r['policy_us'] for r in rs),
+            'startup_ms_mean': statistics.fmean(r['startup_ms'] for r in rs),
+        })
+    return rows
+
+def write_report(rows, config, out):
+    with open(out + '.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(out + '.json', 'w') as f:
+        json.dump({'config': config, 'results': rows}, f, indent=2)
+
+def main():
+    ap = argparse.ArgumentParser(description="Прогін безголових ігор Pacman у пулі процесів")
+    ap.add_argument('--games', type=int, default=100, help="ігор на кожну пару (розмір, складність)")
+    ap.add_argument('--difficulties', default='0-5')
+    ap.add_argument('--sizes', default=f"{pacman.GRID_W}x{pacman.GRID_H}")
+    ap.add_argument('--policy', default='greedy', choices=sorted(pacman.POLICIES))
+    ap.add_argument('--max-seconds', type=float, default=300, help="ліміт симульованого часу на гру")
+    ap.add_argument('--seed', type=int, default=0, help="базовий сід")
+    ap.add_argument('--workers', type=int, default=os.cpu_count())
+    ap.add_argument('--out', default='sweep_report')
+    ap.add_argument('--shared-level', action='store_true',
+                    help="один лабіринт на розмір у спільній пам'яті для всіх воркерів")
+    ap.add_argument('--shared-nav-cells', type=int, default=pacman.NAV_TABLE_MAX_CELLS,
+                    help="до скількох клітинок публікувати повну таблицю маршрутів")
+    args = ap.parse_args()
+
+    sizes = parse_sizes(args.sizes)
+    difficulties = parse_difficulties(args.difficulties)
+    max_ms = args.max_seconds * 1000
+    t0 = time.perf_counter()
+    shared = {}
+    if args.shared_level:
+        for w, h in sizes:
+            shared[(w, h)] = pacman.SharedLevel(pacman.build_level(w, h, args.seed), args.shared_nav_cells)
+    tasks = []
+    for size in sizes:
+        name = shared[size].name if size in shared else None
+        for d in difficulties:
+            for i in range(args.games):
+                tasks.append((args.seed + i, d, size, args.policy, max_ms, name))
+
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(play_one, tasks, chunksize=max(1, len(tasks) // (4 * args.workers))))
+    finally:
+        for level in shared.values():
+            level.close()
+    wall = time.perf_counter() - t0
+
+    rows = aggregate(results)
+    config = vars(args) | {'total_games': len(results), 'wall_s': wall,
+                           'shared_bytes': sum(level.nbytes for level in shared.values())}
+    write_report(rows, config, args.out)
+    for row in rows:
+        print(f"{row['grid']:>9}  diff {row['difficulty']}  games {row['games']:5d}  "
+              f"win {row['win_rate']:.2f}  survival {row['survival_ms_mean'] / 1000:7.1f}s  "
+              f"pellets {row['pellets_eaten_mean']:7.1f}  steps/s {row['steps_per_sec_mean']:9.0f}  "
+              f"start {row['startup_ms_mean']:6.1f} ms"
+              + (f"  policy {row['policy_us_mean']:.0f} us/step" if row['policy_us_mean'] else ""))
+    print(f"{len(results)} ігор за {wall:.1f} с -> {args.out}.csv, {args.out}.json")
+
+
+if __name__ == '__main__':
+    main()
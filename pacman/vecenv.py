@@ -0,0 +1,395 @@
+"""
+Векторизоване середовище для навчання агентів: N незалежних ігор у масивах NumPy,
+які крокують разом одним викликом step(actions).
+
+Один крок середовища — один крок Пакмена (PAC_STEP_MS); привиди ходять за своїм
+таймером GHOST_STEP_MS, як у Game.update(). Поведінка привидів та сама, що в
+GhostSwarm.step_ai (GHOST_SIGHT = 0) для всіх рівнів складності: переслідування,
+засідка на 4 клітинки вперед, патруль (рівень 3 — випадкова точка поруч, рівень 4+ —
+випадкова пелета), лише один активний привид на рівні 0 і обмін ролями з кулдауном
+на рівні 5. Випадковість — власний генератор NumPy, тож результати відтворювані
+за сідом, але не збігаються покроково з Game.
+
+Кожна клітинка — плоский індекс y*w + x. Для кожного рівня з пулу тримаються
+таблиці відстаней і перших кроків між усіма прохідними клітинками (з NavTable,
+за її компактною нумерацією), тож крок будь-якого привида в будь-якій грі — це
+одна вибірка з масиву.
+
+Приклад:
+    env = VecEnv(1024, difficulty=3, seed=0)
+    obs = env.reset()
+    obs, reward, done, info = env.step(np.random.randint(0, 5, env.n))
+
+    python vecenv.py --envs 1024 --steps 2000    # заміряти кроки середовища за секунду
+"""
+import argparse
+import time
+
+try:
+    import numpy as np
+except ImportError as e:  # numpy потрібен лише цьому модулю, гра працює без нього
+    raise ImportError("vecenv.py потребує numpy: pip install numpy") from e
+
+import pacman
+
+# Дії: індекси pacman.DIR_LIST (ліво, право, верх, низ) і 4 — нічого не натискати
+NOOP = len(pacman.DIR_LIST)
+NO_STEP = pacman.NO_STEP
+UNREACHABLE = pacman.NAV_UNREACHABLE
+PATROL_OFFSETS = np.array(pacman.PATROL_OFFSETS)
+
+# Канали спостереження
+OBS_WALL, OBS_PELLET, OBS_PACMAN, OBS_GHOST = range(4)
+
+
+class LevelTables:
+    """
+    Пул з M рівнів у вигляді складених масивів (рівень m — рядок m):
+    dist/hop[m, ціль, звідки] за компактними індексами прохідних клітинок
+    (compact[m, клітинка] — компактний індекс або -1 для стіни; таблиці мають
+    розмір найбільшого рівня в пулі, а не w*h), сусіди nbr[m, клітинка, напрямок]
+    (-1 — стіна), стіни, початкові пелети й клітинки клітки.
+    """
+
+    def __init__(self, w, h, size, rng, cache_dir=pacman.LEVEL_CACHE_DIR):
+        self.w, self.h, self.size = w, h, size
+        hw = w * h
+        self.pool = pacman.LevelPool(w, h, cache_dir=cache_dir, background=False)
+        self.rng = rng
+        self.dist = np.full((size, 0, 0), UNREACHABLE, np.uint16)
+        self.hop = np.full((size, 0, 0), NO_STEP, np.uint8)
+        self.compact = np.full((size, hw), -1, np.int32)
+        self.nbr = np.full((size, hw, 4), -1, np.int32)
+        self.walls = np.zeros((size, hw), np.uint8)
+        self.pellets = np.zeros((size, hw), bool)
+        self.pen = []   # плоскі клітинки клітки для кожного рівня
+        self.seeds = [None] * size
+        for m in range(size):
+            self.load(m)
+
+    def _grow(self, n):
+        """Розширити таблиці до n прохідних клітинок (новий рівень більший за всі попередні)."""
+        cap = self.dist.shape[1]
+        if n <= cap:
+            return
+        dist = np.full((self.size, n, n), UNREACHABLE, np.uint16)
+        hop = np.full((self.size, n, n), NO_STEP, np.uint8)
+        dist[:, :cap, :cap] = self.dist
+        hop[:, :cap, :cap] = self.hop
+        self.dist, self.hop = dist, hop
+
+    def distance(self, level, target, source):
+        """Відстань від плоских клітинок source до target (обидві прохідні)."""
+        compact = self.compact
+        return self.dist[level, compact[level, target], compact[level, source]]
+
+    def first_step(self, level, target, source):
+        """Перший крок від source до target; ціль у стіні (патруль рівня 3) — NO_STEP."""
+        t = self.compact[level, target]
+        step = self.hop[level, t, self.compact[level, source]]
+        return np.where(t < 0, NO_STEP, step)
+
+    def load(self, m):
+        """Записати в слот m щойно згенерований (або взятий з дискового кешу) рівень."""
+        w, h = self.w, self.h
+        seed = int(self.rng.integers(2**63))
+        level = self.pool.get(seed)
+        nav = level.nav
+        if not nav.full:
+            raise ValueError(f"VecEnv потребує повної таблиці маршрутів: {nav.n} клітинок > "
+                             f"NAV_TABLE_MAX_CELLS ({pacman.NAV_TABLE_MAX_CELLS})")
+        n = nav.n
+        flat = np.array([y*w + x for x, y in nav.cells], np.int64)
+        self._grow(n)
+        self.dist[m].fill(UNREACHABLE)
+        self.hop[m].fill(NO_STEP)
+        self.dist[m, :n, :n] = np.frombuffer(nav.dist, np.uint16).reshape(n, n)
+        self.hop[m, :n, :n] = np.frombuffer(nav.hop, np.uint8).reshape(n, n)
+        self.compact[m].fill(-1)
+        self.compact[m, flat] = np.arange(n)
+        self.nbr[m].fill(-1)
+        for c, links in enumerate(nav.adj):
+            for k, j in links:
+                self.nbr[m, flat[c], k] = flat[j]
+        self.walls[m] = np.frombuffer(level.grid.to_bytes(), np.uint8) == pacman.WALL
+        self.pellets[m].fill(False)
+        self.pellets[m, [y*w + x for x, y in level.pellets]] = True
+        pen = np.array([y*w + x for x, y in level.spawn_points], np.int64)
+        if m < len(self.pen):
+            self.pen[m] = pen
+        else:
+            self.pen.append(pen)
+        self.seeds[m] = seed
+
+
+class VecEnv:
+    """
+    N ігор, що крокують разом. Стан — масиви по іграх: рівень з пулу, клітинка
+    й останній напрямок Пакмена, маска пелет, клітинки, напрямки й ролі привидів,
+    таймер привидів, кулдаун обміну ролями, рахунок.
+
+    step(actions) повертає (obs, reward, done, info): obs — uint8 [N, 4, h, w]
+    (стіни, пелети, Пакмен, привиди; 0/1), reward — очки за крок,
+    done — гра скінчилася (смерть, перемога або max_steps). Скінчені ігри одразу
+    перезапускаються на іншому рівні з пулу; у info — підсумки скінчених ігор.
+    obs — той самий буфер, що оновлюється на місці лише там, де щось змінилося
+    (скопіюйте, якщо треба зберегти попередній кадр).
+    Кожні refresh_every перезапусків один слот пулу, який ніхто не використовує,
+    заповнюється свіжозгенерованим рівнем.
+    """
+
+    def __init__(self, n_envs, difficulty=pacman.DEFAULT_DIFFICULTY, grid_w=pacman.GRID_W,
+                 grid_h=pacman.GRID_H, ghost_count=pacman.GHOST_COUNT, levels=32, seed=None,
+                 max_steps=None, refresh_every=1024, cache_dir=pacman.LEVEL_CACHE_DIR):
+        self.n = n_envs
+        self.w, self.h = grid_w, grid_h
+        self.g = ghost_count
+        self.max_steps = max_steps
+        self.rng = np.random.default_rng(seed)
+        self.difficulty = np.broadcast_to(np.asarray(difficulty, np.int64), (n_envs,)).copy()
+        self.levels = LevelTables(grid_w, grid_h, levels, self.rng, cache_dir)
+        self.refresh_every = refresh_every
+        self.resets = 0
+        self.retiring = None  # слот, що чекає на заміну (нові ігри його не беруть)
+
+        n, g, hw = n_envs, ghost_count, grid_w * grid_h
+        self.level = np.zeros(n, np.int64)
+        self.pac = np.zeros(n, np.int64)
+        self.pac_dir = np.full(n, NOOP, np.int64)
+        self.pellets = np.zeros((n, hw), bool)
+        self.pellets_left = np.zeros(n, np.int64)
+        self.ghosts = np.zeros((n, g), np.int64)
+        self.ghost_dir = np.zeros((n, g), np.int64)
+        self.roles = np.zeros((n, g), np.uint8)
+        self.ghost_acc = np.zeros(n, np.int64)
+        self.cooldown = np.zeros(n, np.int64)
+        self.score = np.zeros(n, np.int64)
+        self.steps = np.zeros(n, np.int64)
+        self.rows = np.arange(n)
+        self.obs = np.zeros((n, 4, hw), np.uint8)
+        self.env_steps = 0
+
+    # ========= Перезапуск =========
+    def _reset_envs(self, idx):
+        """Нові ігри в іграх idx: випадковий рівень із пулу, старт як у Game.reset()."""
+        if len(idx) == 0:
+            return
+        lv = self.levels
+        choices = np.arange(lv.size)
+        if self.retiring is not None and lv.size > 1:
+            choices = choices[choices != self.retiring]
+        level = self.level[idx] = self.rng.choice(choices, len(idx))
+        self.pac[idx] = (self.h - 2) * self.w + 1
+        self.pac_dir[idx] = NOOP
+        self.pellets[idx] = lv.pellets[level]
+        self.pellets_left[idx] = self.pellets[idx].sum(axis=1)
+        for e, m in zip(idx, level):
+            pen = lv.pen[m]
+            order = self.rng.permutation(len(pen))
+            self.ghosts[e] = pen[order[np.arange(self.g) % len(pen)]]
+        self.ghost_dir[idx] = self.rng.integers(0, 4, (len(idx), self.g))
+        self.roles[idx] = self._roles(self.difficulty[idx])
+        self.ghost_acc[idx] = 0
+        self.cooldown[idx] = 0
+        self.score[idx] = 0
+        self.steps[idx] = 0
+        self.resets += len(idx)
+        self._refresh_levels()
+        # спостереження цих ігор — заново
+        obs = self.obs
+        obs[idx, OBS_WALL] = lv.walls[level]
+        obs[idx, OBS_PELLET] = self.pellets[idx]
+        obs[idx, OBS_PACMAN] = 0
+        obs[idx, OBS_PACMAN, self.pac[idx]] = 1
+        obs[idx, OBS_GHOST] = 0
+        obs[idx[:, None], OBS_GHOST, self.ghosts[idx]] = 1
+
+    def _roles(self, difficulty):
+        """Як GhostSwarm.assign_roles: рівні 0–1 — усі переслідувачі, 2+ — друга половина засідає."""
+        roles = np.zeros((len(difficulty), self.g), np.uint8)
+        roles[:, self.g // 2:] = pacman.AMBUSHER
+        roles[difficulty <= 1] = pacman.CHASER
+        return roles
+
+    def _refresh_levels(self):
+        """Замінити в пулі один рівень свіжим, щойно на ньому не лишиться жодної гри."""
+        lv = self.levels
+        if self.retiring is None:
+            if self.refresh_every and self.resets >= self.refresh_every:
+                self.resets = 0
+                self.retiring = int(self.rng.integers(lv.size))
+            return
+        if not (self.level == self.retiring).any():
+            lv.load(self.retiring)
+            self.retiring = None
+
+    def reset(self):
+        self._reset_envs(self.rows)
+        return self.observe()
+
+    # ========= Крок =========
+    def step(self, actions):
+        actions = np.asarray(actions, np.int64)
+        rows, lv, level = self.rows, self.levels, self.level
+        dt = pacman.PAC_STEP_MS
+        self.cooldown[self.cooldown > 0] -= dt
+
+        # Пакмен: тримаємо напрямок дії, інакше продовжуємо останній (як Pacman.step)
+        nbr = lv.nbr[level, self.pac]                                  # [N, 4]
+        want = np.where(actions < NOOP, actions, self.pac_dir)
+        can_want = (want < NOOP) & (nbr[rows, np.minimum(want, 3)] >= 0)
+        can_last = (self.pac_dir < NOOP) & (nbr[rows, np.minimum(self.pac_dir, 3)] >= 0)
+        move_dir = np.where(can_want, want, np.where(can_last, self.pac_dir, NOOP))
+        moved = move_dir < NOOP
+        self.obs[rows, OBS_PACMAN, self.pac] = 0
+        self.pac = np.where(moved, nbr[rows, np.minimum(move_dir, 3)], self.pac)
+        self.obs[rows, OBS_PACMAN, self.pac] = 1
+        self.obs[rows, OBS_PELLET, self.pac] = 0
+        self.pac_dir = np.where(moved, move_dir, self.pac_dir)
+        eaten = self.pellets[rows, self.pac]
+        self.pellets[rows, self.pac] = False
+        self.pellets_left -= eaten
+        reward = eaten * pacman.PELLET_SCORE
+        self.score += reward
+        win = self.pellets_left == 0
+
+        # Привиди: тіки за таймером (лише в іграх, що тривають)
+        dead = np.zeros(self.n, bool)
+        self.ghost_acc += dt
+        while True:
+            tick = (self.ghost_acc >= pacman.GHOST_STEP_MS) & ~win & ~dead
+            if not tick.any():
+                break
+            self.ghost_acc[tick] -= pacman.GHOST_STEP_MS
+            e = np.flatnonzero(tick)
+            self._ghost_tick(e)
+            dead[e] = (self.ghosts[e] == self.pac[e, None]).any(axis=1)
+        self.ghost_acc[win | dead] = 0
+
+        self.steps += 1
+        self.env_steps += self.n
+        done = win | dead
+        if self.max_steps is not None:
+            done |= self.steps >= self.max_steps
+        info = {}
+        finished = np.flatnonzero(done)
+        if len(finished):
+            info = {
+                'final_score': self.score[finished].copy(),
+                'final_steps': self.steps[finished].copy(),
+                'win': win[finished],
+                'dead': dead[finished],
+                'envs': finished,
+            }
+            self._reset_envs(finished)
+        return self.observe(), reward, done, info
+
+    def _ghost_tick(self, e):
+        """Один тік привидів для ігор e (поведінка GhostSwarm.step_ai)."""
+        lv, rng = self.levels, self.rng
+        w, h, g = self.w, self.h, self.g
+        level = self.level[e][:, None]                 # [E, 1]
+        pac = self.pac[e][:, None]
+        pac_dir = self.pac_dir[e]
+        diff = self.difficulty[e][:, None]
+        ghosts = self.ghosts[e]                        # [E, G]
+        pac_dist = lv.distance(level, pac, ghosts).astype(np.int64)
+
+        # --- Рівень 5: обмін ролями найближчого привида з першим переслідувачем ---
+        roles = self.roles[e]
+        swap = (diff[:, 0] == 5) & (self.cooldown[e] <= 0) & (g > 1)
+        if swap.any():
+            closest = pac_dist.argmin(axis=1)          # перший з найменшою відстанню, як min()
+            is_chaser = roles == pacman.CHASER
+            current = is_chaser.argmax(axis=1)
+            swap &= is_chaser.any(axis=1) & (closest != current)
+            s = np.flatnonzero(swap)
+            a, b = current[s], closest[s]
+            roles[s, a], roles[s, b] = roles[s, b], roles[s, a]
+            self.roles[e] = roles
+            self.cooldown[e[s]] = pacman.ROLE_SWAP_COOLDOWN_MS
+
+        # --- Засідка: до AMBUSH_AHEAD прохідних клітинок уперед від Пакмена ---
+        target = np.broadcast_to(pac, ghosts.shape).copy()
+        ambusher = (diff >= 2) & (roles == pacman.AMBUSHER)
+        if ambusher.any():
+            ahead = self.pac[e]
+            has_dir = pac_dir < NOOP
+            for _ in range(pacman.AMBUSH_AHEAD):
+                nxt = lv.nbr[self.level[e], ahead, np.minimum(pac_dir, 3)]
+                ahead = np.where(has_dir & (nxt >= 0), nxt, ahead)
+            target = np.where(ambusher, ahead[:, None], target)
+
+        # --- Патруль, коли Пакмен далі за PATROL_RADIUS клітинок ---
+        far = pac_dist > pacman.PATROL_RADIUS
+        patrol = far & (((diff >= 3) & (roles == pacman.CHASER)) | ((diff >= 4) & ambusher))
+        if patrol.any():
+            left = self.pellets_left[e][:, None]
+            # Рівень 4+: випадкова пелета (k-та одиниця маски через cumsum + searchsorted)
+            by_pellet = patrol & (diff >= 4) & (left > 0)
+            if by_pellet.any():
+                mask = self.pellets[e]
+                hw = mask.shape[1]
+                cum = mask.cumsum(axis=1) + np.arange(len(e))[:, None] * (hw + 1)
+                k = (rng.random(ghosts.shape) * left).astype(np.int64)
+                base = np.arange(len(e))[:, None] * (hw + 1)
+                pos = np.searchsorted(cum.ravel(), k + 1 + base) - np.arange(len(e))[:, None] * hw
+                target = np.where(by_pellet, np.clip(pos, 0, hw - 1), target)
+            # Рівень 3: випадкова точка за 2–4 клітинки по кожній осі (може бути й стіною)
+            local = patrol & ~by_pellet
+            if local.any():
+                gy, gx = np.divmod(ghosts, w)
+                lx = np.clip(gx + rng.choice(PATROL_OFFSETS, ghosts.shape), 1, w - 2)
+                ly = np.clip(gy + rng.choice(PATROL_OFFSETS, ghosts.shape), 1, h - 2)
+                target = np.where(local, ly * w + lx, target)
+
+        # --- Крок до цілі; застрягли — будь-який можливий хід ---
+        step = lv.first_step(level, target, ghosts).astype(np.int64)
+        nbr = lv.nbr[level, ghosts]                    # [E, G, 4]
+        stuck = step == NO_STEP
+        if stuck.any():
+            valid = nbr >= 0
+            pick = (rng.random(valid.shape) * valid).argmax(axis=2)
+            step = np.where(stuck & valid.any(axis=2), pick, step)
+        active = np.ones(ghosts.shape, bool)
+        active[:, 1:] = diff != 0                      # рівень 0: ходить лише перший привид
+        move = active & (step < NO_STEP)
+        k = np.minimum(step, 3)
+        new = np.take_along_axis(nbr, k[..., None], axis=2)[..., 0]
+        self.ghosts[e] = np.where(move, new, ghosts)
+        self.obs[e[:, None], OBS_GHOST, ghosts] = 0
+        self.obs[e[:, None], OBS_GHOST, self.ghosts[e]] = 1
+        self.ghost_dir[e] = np.where(active, np.where(step < NO_STEP, step, NOOP), self.ghost_dir[e])
+
+    # ========= Спостереження =========
+    def observe(self):
+        """uint8 [N, 4, h, w]: стіни, пелети, Пакмен, привиди (вид на буфер, без копіювання)."""
+        return self.obs.reshape(self.n, 4, self.h, self.w)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Заміряти швидкість векторизованого середовища")
+    ap.add_argument('--envs', type=int, default=1024)
+    ap.add_argument('--steps', type=int, default=1000)
+    ap.add_argument('--difficulty', type=int, default=3)
+    ap.add_argument('--ghosts', type=int, default=pacman.GHOST_COUNT)
+    ap.add_argument('--seed', type=int, default=0)
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    env = VecEnv(args.envs, difficulty=args.difficulty, ghost_count=args.ghosts, seed=args.seed)
+    env.reset()
+    print(f"Підготовка: {time.perf_counter() - t0:.2f} с")
+    rng = np.random.default_rng(args.seed)
+    episodes = 0
+    t0 = time.perf_counter()
+    for _ in range(args.steps):
+        _, _, done, _ = env.step(rng.integers(0, NOOP + 1, env.n))
+        episodes += int(done.sum())
+    wall = time.perf_counter() - t0
+    print(f"{env.env_steps} кроків за {wall:.2f} с: {env.env_steps / wall:,.0f} кроків/с, "
+          f"{episodes} завершених ігор")
+
+
+if __name__ == '__main__':
+    main()